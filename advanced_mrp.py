@@ -1,9 +1,46 @@
+import time
 import pandas as pd
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 from ortools.linear_solver import pywraplp
+from mrp_engine import (CompiledBOM, MaterialMaster, run_llc_mrp, build_item_axis, net_level, make_calendar,
+                        ResultBuffer, run_scenario_mrp, csr_positions, net_events, get_explosion_cache)
+
+# 可选的求解器后端
+SOLVER_BACKENDS = ('GLOP', 'PDLP', 'CBC', 'SCIP', 'CP-SAT')
+
+# 一阶方法PDLP的解只在容差内满足约束，只在手动指定时使用，求解前收紧终止容差，求解后修复库存约束
+PDLP_PARAMETERS = ('termination_criteria { simple_optimality_criteria { '
+                   'eps_optimal_absolute: 1e-8 eps_optimal_relative: 1e-8 } }')
+
+# 整数模型变量数不超过该值时使用CP-SAT
+CP_SAT_MAX_VARIABLES = 5000
+
+# 第二阶段目标函数中的次要权重：总净需求量相同时优先准时生产(在产能允许的最晚时段生产)
+HOLDING_TIE_BREAK = 1e-4
+
+# 蒙特卡洛模拟每批的数组元素数上限，未指定每批样本数时按每个样本的事件数和输出单元数确定批量
+SIMULATION_BATCH_VALUES = 2 ** 22
+
+# 投影库存直方图的分箱数，百分位数在箱内线性插值
+SIMULATION_HISTOGRAM_BINS = 64
+
+# 求解状态名称，只有最优和可行的解会被采用
+SOLVER_STATUS = {
+    pywraplp.Solver.OPTIMAL: '最优',
+    pywraplp.Solver.FEASIBLE: '可行',
+    pywraplp.Solver.INFEASIBLE: '不可行',
+    pywraplp.Solver.UNBOUNDED: '无界',
+    pywraplp.Solver.ABNORMAL: '异常',
+    pywraplp.Solver.NOT_SOLVED: '未求解'
+}
 
 def calculate_advanced_mrp(production_plan, bom_data, inventory_data, purchase_orders=None, 
-                         lead_times=None, lot_sizes=None, capacity_constraints=None):
+                         lead_times=None, lot_sizes=None, capacity_constraints=None,
+                         compiled_bom=None, time_bucket='day', max_workers=None, resource_requirements=None,
+                         solver_backend=None, time_limit=None, mip_gap=None, run_time_limit=None,
+                         model_cache=None, frozen_days=None, slushy_days=None, tail_bucket='month',
+                         planning_date=None, pegging=None):
     """
     高级物料需求计划(MRP)计算函数
     
@@ -13,11 +50,32 @@ def calculate_advanced_mrp(production_plan, bom_data, inventory_data, purchase_o
     - inventory_data: 库存数据DataFrame
     - purchase_orders: 采购订单DataFrame (可选)
     - lead_times: 物料提前期DataFrame (可选)
-    - lot_sizes: 批量大小约束DataFrame (可选)
+    - lot_sizes: 批量大小约束DataFrame (可选)，可额外包含固定批量(FOQ)和订货周期数(POQ)列
     - capacity_constraints: 产能约束DataFrame (可选)
+    - compiled_bom: 预先编译的BOM索引CompiledBOM (可选)，未提供时从bom_data构建
+    - time_bucket: 计划时段模式 'day'、'week'、'month'，或自定义日历BucketCalendar
+    - max_workers: 并行求解整数规划模型的进程数 (可选)，大于1时同层物料分发到进程池求解
+    - resource_requirements: 资源需求DataFrame (可选)，指定每种物料生产所需的资源和单位用量，
+      未提供时假设每个物料每单位消耗每种受约束资源1单位
+    - solver_backend: 指定求解器后端 (可选)，取值见SOLVER_BACKENDS，未提供时按模型类型和规模自动选择
+    - time_limit: 单个模型的求解时间上限(秒) (可选)
+    - mip_gap: 整数规划的相对间隙目标 (可选)，达到后提前停止
+    - run_time_limit: 整次计算的求解时间上限(秒) (可选)，剩余时间按物料数分配给待求解的模型
+    - model_cache: 跨多次计算保留模型的ModelCache (可选)，提供时结构不变的模型只更新右端项并热启动求解，
+      此时模型在主进程中求解，不使用进程池
+    - frozen_days: 冻结期天数 (可选)，提供frozen_days或slushy_days时按滚动计划计算；
+      冻结期内只保留已有订单，不下达新订单，冻结期内的缺口推迟到冻结期后的第一个时段
+    - slushy_days: 半冻结期天数 (可选)，冻结期到半冻结期之间有最小批量或批量倍数的物料使用整数批量模型，
+      未提供时默认为冻结期加上生产计划产品的最长累计提前期；之后的尾段需求按tail_bucket合并为较粗的时段，使用闭式解净算，不考虑批量和产能约束；
+      整数规划模型的规模只与半冻结期长度有关，与计划总长度无关
+    - tail_bucket: 尾段的时段模式 'day'、'week'、'month'，或自定义日历BucketCalendar
+    - planning_date: 计算时间栏的计划日期 (可选)，默认为生产计划中最早的需求日期
+    - pegging: 需求追溯索引PeggingIndex (可选)，提供时按每层的计划订单填充，见run_llc_mrp
     
     返回:
-    - mrp_results: MRP计算结果DataFrame
+    - mrp_results: MRP计算结果DataFrame，求解状态和相对间隙列标记每条记录的求解质量；
+      没有可行解的模型不考虑产能约束，由净算内核计算并标记其求解状态；
+      attrs['求解统计']记录各求解器后端的模型数、求解耗时(秒)和解的最大原始残差
     """
     # 1. 数据预处理和验证
     # 确保所有必要的列都存在
@@ -33,33 +91,51 @@ def calculate_advanced_mrp(production_plan, bom_data, inventory_data, purchase_o
         if missing_cols:
             raise ValueError(f"{df_name}缺少必要的列: {', '.join(missing_cols)}")
     
-    # 2. 处理提前期数据
+    if solver_backend is not None and solver_backend not in SOLVER_BACKENDS:
+        raise ValueError(f"不支持的求解器: {solver_backend}，可选: {', '.join(SOLVER_BACKENDS)}")
+    
+    # 2. 处理提前期数据，默认提前期为0
     if lead_times is not None:
         # 确保提前期数据有必要的列
         if not all(col in lead_times.columns for col in ['物料编码', '生产提前期', '采购提前期']):
             raise ValueError("提前期数据缺少必要的列: 物料编码, 生产提前期, 采购提前期")
-        
-        # 创建提前期映射
-        production_lead_time_map = dict(zip(lead_times['物料编码'], lead_times['生产提前期']))
-        purchase_lead_time_map = dict(zip(lead_times['物料编码'], lead_times['采购提前期']))
-    else:
-        # 默认提前期为0
-        production_lead_time_map = {}
-        purchase_lead_time_map = {}
     
-    # 3. 处理批量大小约束
+    # 3. 处理批量大小约束，默认无批量约束
     if lot_sizes is not None:
         # 确保批量大小数据有必要的列
         if not all(col in lot_sizes.columns for col in ['物料编码', '最小批量', '批量倍数']):
             raise ValueError("批量大小数据缺少必要的列: 物料编码, 最小批量, 批量倍数")
-        
-        # 创建批量大小映射
-        min_lot_size_map = dict(zip(lot_sizes['物料编码'], lot_sizes['最小批量']))
-        lot_multiple_map = dict(zip(lot_sizes['物料编码'], lot_sizes['批量倍数']))
-    else:
-        # 默认无批量约束
-        min_lot_size_map = {}
-        lot_multiple_map = {}
+    
+    # 计划时段日历，所有日期只在读入时转换一次为整数时段
+    calendar = make_calendar(time_bucket)
+    
+    # 滚动计划的时间栏，换算为计划时段
+    rolling = frozen_days is not None or slushy_days is not None
+    if rolling:
+        frozen_days = 0 if frozen_days is None else frozen_days
+        if frozen_days < 0 or (slushy_days is not None and slushy_days < frozen_days):
+            raise ValueError("时间栏设置错误: 冻结期不能为负数，半冻结期不能短于冻结期")
+        if planning_date is None:
+            planning_date = pd.to_datetime(production_plan['需求日期']).min()
+        planning_date = pd.Timestamp(planning_date)
+        frozen_end = int(calendar.to_buckets([planning_date + pd.Timedelta(days=frozen_days)])[0])
+        tail_calendar = make_calendar(tail_bucket)
+    
+    # 构建物料主数据：物料编码只在这里编码一次为物料ID，库存、安全库存、提前期、批量规则和采购到货
+    # 都按物料ID存为对齐的数组，输出结果时才解码为物料编码
+    if compiled_bom is None:
+        compiled_bom = CompiledBOM(bom_data, production_plan['产品编码'].unique())
+    master = MaterialMaster(compiled_bom, inventory_data, purchase_orders, calendar=calendar, lead_times=lead_times,
+                            lot_sizes=lot_sizes, items=production_plan['产品编码'].unique())
+    
+    # 未指定半冻结期时，默认延伸到冻结期后一个累计提前期：在此之后下达的订单还来得及重新安排
+    if rolling:
+        if slushy_days is None:
+            plan_items = master.encode(production_plan['产品编码'].unique())
+            plan_items = plan_items[plan_items < compiled_bom.item_count]
+            cache = get_explosion_cache(compiled_bom, lead_times=master.production_lead_time)
+            slushy_days = frozen_days + int(cache.cumulative_lead_times(plan_items, master.purchase_lead_time).max(initial=0))
+        slushy_end = int(calendar.to_buckets([planning_date + pd.Timedelta(days=slushy_days)])[0])
     
     # 4. 处理产能约束
     if capacity_constraints is not None:
@@ -67,246 +143,1099 @@ def calculate_advanced_mrp(production_plan, bom_data, inventory_data, purchase_o
         if not all(col in capacity_constraints.columns for col in ['资源编码', '日期', '可用产能']):
             raise ValueError("产能约束数据缺少必要的列: 资源编码, 日期, 可用产能")
         
-        # 创建产能约束映射
+        # 创建产能约束映射，同一时段内的产能累加
+        capacity_by_bucket = pd.DataFrame({
+            '资源编码': capacity_constraints['资源编码'].to_numpy(),
+            '时段': calendar.to_buckets(capacity_constraints['日期']),
+            '可用产能': capacity_constraints['可用产能'].to_numpy()
+        }).groupby(['资源编码', '时段'])['可用产能'].sum()
+        
         capacity_map = {}
-        for _, row in capacity_constraints.iterrows():
-            resource = row['资源编码']
-            date = row['日期']
-            capacity = row['可用产能']
-            
-            if resource not in capacity_map:
-                capacity_map[resource] = {}
-            
-            capacity_map[resource][date] = capacity
+        for (resource, bucket), capacity in capacity_by_bucket.items():
+            capacity_map.setdefault(resource, {})[int(bucket)] = capacity
     else:
         # 默认无产能约束
         capacity_map = {}
     
-    # 5. 构建物料清单树结构
-    def build_bom_tree(parent_item, bom_data, level=0, path=None):
-        if path is None:
-            path = []
+    # 创建资源消耗映射 {物料ID: {资源编码: 单位用量}}，只保留有产能约束的资源
+    if resource_requirements is not None:
+        if not all(col in resource_requirements.columns for col in ['物料编码', '资源编码', '单位用量']):
+            raise ValueError("资源需求数据缺少必要的列: 物料编码, 资源编码, 单位用量")
         
-        # 检查循环引用
-        if parent_item in path:
-            raise ValueError(f"检测到BOM循环引用: {' -> '.join(path + [parent_item])}")
+        resource_usage_map = {}
+        for item_id, resource, usage in zip(master.encode(resource_requirements['物料编码']).tolist(),
+                                            resource_requirements['资源编码'], resource_requirements['单位用量']):
+            if item_id >= 0 and resource in capacity_map and usage > 0:
+                resource_usage_map.setdefault(item_id, {})[resource] = usage
+    else:
+        resource_usage_map = None
+    
+    # 5. 创建按列存储的结果缓冲区
+    mrp_results = ResultBuffer({
+        '物料编码': object,
+        '需求周期': 'datetime64[ns]',
+        '下单日期': 'datetime64[ns]',
+        '总需求量': np.float64,
+        '期初库存': np.float64,
+        '安全库存': np.float64,
+        '采购到货': np.float64,
+        '净需求量': np.float64,
+        '期末库存': np.float64,
+        '生产提前期': np.int64,
+        '采购提前期': np.int64,
+        '求解状态': object,
+        '相对间隙': np.float64
+    })
+    
+    # 各求解器后端的模型数和求解耗时
+    solver_stats = {}
+    
+    # 整批添加MRP结果记录，item_ids为每行的物料ID数组，物料编码在这里解码
+    def append_results(item_ids, dates, date_req, projected_inventory, safety_stock, date_po, net_req,
+                       status='最优', gap=0.0):
+        # 考虑采购提前期计算下单日期
+        purchase_lead_times = master.purchase_lead_time[item_ids]
+        production_lead_times = master.production_lead_time[item_ids]
         
-        # 获取所有子项
-        children = bom_data[bom_data['父项编码'] == parent_item]
+        mrp_results.extend({
+            '物料编码': master.codes[item_ids],
+            '需求周期': dates,
+            '下单日期': dates - purchase_lead_times.astype('timedelta64[D]'),
+            '总需求量': date_req,
+            '期初库存': projected_inventory,
+            '安全库存': safety_stock,
+            '采购到货': date_po,
+            '净需求量': net_req,
+            '期末库存': projected_inventory + date_po + net_req - date_req,
+            '生产提前期': production_lead_times,
+            '采购提前期': purchase_lead_times,
+            '求解状态': status,
+            '相对间隙': gap
+        })
+    
+    # 物料消耗的受约束资源及单位用量
+    def item_resource_usage(item_id):
+        if resource_usage_map is None:
+            return {resource: 1 for resource in capacity_map}
+        return resource_usage_map.get(item_id, {})
+    
+    # 只有占用受约束资源的物料才需要整数规划，批量规则由净算内核按时段逐期套用；
+    # 滚动计划的半冻结期内，有最小批量或批量倍数的物料也使用整数批量模型
+    def needs_milp(item_id):
+        if rolling and (master.lot_rules[item_id, 0] > 0 or master.lot_rules[item_id, 1] > 1):
+            return True
+        return bool(item_resource_usage(item_id))
+    
+    # 扣减已占用的产能，下层物料只能使用剩余产能
+    def consume_capacity(item_id, bucket, net_req):
+        for resource, usage in item_resource_usage(item_id).items():
+            bucket_capacity = capacity_map[resource]
+            if bucket in bucket_capacity:
+                bucket_capacity[bucket] = max(bucket_capacity[bucket] - usage * net_req, 0)
+    
+    # 使用净算内核一次性计算多个物料，包括批量规则
+    def net_with_kernel(kernel_items, gross_requirements, planned_orders, status='最优', gap=0.0, **netting_options):
+        level = net_level(kernel_items, gross_requirements, master, **netting_options)
+        events = np.flatnonzero(level['planned'] > 0)
+        rows = level['rows'][events]
+        row_items = level['item_ids'][rows]
+        buckets = level['buckets'][events]
+        net_requirements = level['planned'][events]
+        append_results(row_items, calendar.to_dates(buckets), level['gross'][events], level['opening'][events],
+                       level['safety_stock'][rows], level['receipts'][events], net_requirements, status, gap)
+        
+        for item_id, bucket, net_req in zip(row_items.tolist(), buckets.tolist(), net_requirements.tolist()):
+            planned_orders.setdefault(item_id, {})[bucket] = net_req
+            consume_capacity(item_id, bucket, net_req)
+    
+    # 整次计算的截止时间，剩余时间按待求解物料数分配
+    run_deadline = time.perf_counter() + run_time_limit if run_time_limit is not None else None
+    pending_milp_items = 0
+    
+    def cluster_time_limit(cluster):
+        limits = [time_limit] if time_limit is not None else []
+        if run_deadline is not None:
+            remaining = max(run_deadline - time.perf_counter(), 0)
+            limits.append(remaining * len(cluster) / max(pending_milp_items, len(cluster)))
+        return min(limits) if limits else None
+    
+    # 6. 计算单层物料的净需求
+    def net_zone(item_ids, gross_requirements):
+        nonlocal pending_milp_items
+        planned_orders = {}
         
-        result = {}
-        for _, row in children.iterrows():
-            child_item = row['子项编码']
-            quantity = row['用量']
+        # 6.1 无产能约束的物料一次性使用净算内核
+        kernel_items = [item_id for item_id in item_ids if not needs_milp(item_id)]
+        if kernel_items:
+            net_with_kernel(kernel_items, gross_requirements, planned_orders)
+        
+        # 6.2 有产能约束的物料按共用资源分组，每组建立一个联合模型，互不相关的组可以并行求解
+        milp_items = [item_id for item_id in item_ids if needs_milp(item_id)]
+        if milp_items:
+            # 本层待求解的物料加上更下层可能需要求解的物料
+            pending_milp_items = len(milp_items) + int((pending_milp_levels > item_levels[milp_items[0]]).sum())
+        clusters = group_items_by_resource(milp_items, {item_id: item_resource_usage(item_id) for item_id in milp_items})
+        axes = {}
+        model_inputs = []
+        for cluster in clusters:
+            item_models = []
+            for item_id in cluster:
+                # 物料自身的稀疏时间轴：需求时段和到货时段
+                axis = build_item_axis(gross_requirements[item_id], *master.receipts_of(item_id))
+                axes[item_id] = axis
+                
+                # 模型中的变量以物料编码命名
+                item_models.append({
+                    'item': master.codes[item_id],
+                    'buckets': axis['buckets'],
+                    'demand': axis['demand'],
+                    'receipts': axis['receipts'],
+                    'is_demand': axis['is_demand'],
+                    'current_inventory': master.on_hand[item_id],
+                    'safety_stock': master.safety_stock[item_id],
+                    'min_lot_size': master.lot_rules[item_id, 0],
+                    'lot_multiple': master.lot_rules[item_id, 1],
+                    'resource_usage': item_resource_usage(item_id)
+                })
             
-            # 递归获取子项的子项
-            child_tree = build_bom_tree(child_item, bom_data, level+1, path + [parent_item])
+            resources = {resource for model in item_models for resource in model['resource_usage']}
+            model_inputs.append((item_models, {resource: capacity_map[resource] for resource in resources},
+                                 solver_backend, cluster_time_limit(cluster), mip_gap))
+        
+        # executor.map按提交顺序返回结果，保证并行和串行结果一致
+        if model_cache is not None:
+            outcomes = [model_cache.get(item_models, capacity, backend).solve(limit, gap)
+                        for item_models, capacity, backend, limit, gap in model_inputs]
+        elif executor is not None and len(model_inputs) > 1:
+            outcomes = list(executor.map(solve_cluster_milp, *zip(*model_inputs)))
+        else:
+            outcomes = [solve_cluster_milp(*inputs) for inputs in model_inputs]
+        
+        fallback_items = {}
+        solved = []
+        for cluster, (cluster_solutions, stats) in zip(clusters, outcomes):
+            backend_stats = solver_stats.setdefault(stats['求解器'], {'模型数': 0, '求解耗时': 0.0, '原始残差': 0.0})
+            backend_stats['模型数'] += 1
+            backend_stats['求解耗时'] += stats['求解耗时']
+            backend_stats['原始残差'] = max(backend_stats['原始残差'], stats.get('原始残差', 0.0))
             
-            result[child_item] = {
-                'quantity': quantity,
-                'level': level + 1,
-                'children': child_tree
-            }
-        
-        return result
-    
-    # 6. 计算总需求量，考虑提前期
-    def get_all_requirements(item, quantity, date, bom_tree_node, level=0):
-        """ 递归计算一个物料及其所有子物料的总需求，并考虑提前期 """
-        # 获取物料的生产提前期
-        prod_lead_time = production_lead_time_map.get(item, 0)
-        adjusted_date = pd.to_datetime(date) - pd.Timedelta(days=prod_lead_time)
-
-        # 添加当前物料的需求
-        requirements = [{'物料编码': item, '需求数量': quantity, '需求日期': adjusted_date, '需求级别': level}]
+            # 没有可行解时不考虑产能约束，由净算内核计算并标记求解状态
+            if cluster_solutions is None:
+                fallback_items.setdefault(stats['求解状态'], []).extend(cluster)
+                continue
+            for item_id, net_requirements in zip(cluster, cluster_solutions):
+                solved.append((item_id, net_requirements, stats['求解状态'], stats['相对间隙']))
         
-        # 递归地为所有子物料计算需求
-        for child_item, child_info in bom_tree_node.items():
-            child_quantity = quantity * child_info['quantity']
-            child_level = level + 1
+        for status, status_items in fallback_items.items():
+            net_with_kernel(status_items, gross_requirements, planned_orders, status, np.nan)
+        
+        for item_id, net_requirements, status, gap in solved:
+            axis = axes[item_id]
+            demand = np.asarray(axis['demand'], dtype=np.float64)
+            receipts = np.asarray(axis['receipts'], dtype=np.float64)
+            planned_orders[item_id] = dict(zip(axis['buckets'].tolist(), net_requirements.tolist()))
             
-            # 递归调用，传入子物料的BOM节点
-            child_requirements = get_all_requirements(
-                child_item, 
-                child_quantity, 
-                adjusted_date, # 子项的需求日期基于父项调整后的日期
-                child_info.get('children', {}), # 使用.get避免叶节点出错
-                child_level
-            )
-            requirements.extend(child_requirements)
+            # 沿事件时段重新计算投影库存，只有当净需求大于0时才添加到结果中
+            closing = master.on_hand[item_id] + np.cumsum(receipts + net_requirements - demand)
+            opening = closing - receipts - net_requirements + demand
+            produced = net_requirements > 0
+            append_results(np.full(int(produced.sum()), item_id, dtype=np.int64),
+                           calendar.to_dates(axis['buckets'][produced]), demand[produced], opening[produced],
+                           master.safety_stock[item_id], receipts[produced], net_requirements[produced], status, gap)
             
-        return requirements
+            for bucket, net_req in zip(axis['buckets'][produced].tolist(), net_requirements[produced].tolist()):
+                consume_capacity(item_id, bucket, net_req)
+        
+        return planned_orders
+    
+    # 尾段的需求和到货时段都映射到所在粗时段的起始时段，且不早于半冻结期结束时段
+    def to_tail_buckets(buckets):
+        tail_starts = tail_calendar.to_dates(tail_calendar.to_buckets(calendar.to_dates(buckets)))
+        return np.maximum(calendar.to_buckets(tail_starts), slushy_end)
+    
+    # 滚动计划：冻结期的需求推迟到冻结期边界，半冻结期按上面的方法净算，尾段合并为粗时段后使用闭式解
+    def net_items(item_ids, gross_requirements):
+        if not rolling:
+            return net_zone(item_ids, gross_requirements)
+        
+        # 6.3 按时间栏拆分总需求，尾段时段映射到所在粗时段的起始时段
+        head_requirements, tail_requirements = {}, {}
+        for item_id in item_ids:
+            buckets = np.fromiter(gross_requirements[item_id].keys(), dtype=np.int64)
+            quantities = np.fromiter(gross_requirements[item_id].values(), dtype=np.float64)
+            in_tail = buckets >= slushy_end
+            for target, zone_buckets, zone_quantities in (
+                    (head_requirements, np.maximum(buckets[~in_tail], frozen_end), quantities[~in_tail]),
+                    (tail_requirements, to_tail_buckets(buckets[in_tail]) if in_tail.any() else buckets[in_tail],
+                     quantities[in_tail])):
+                for bucket, quantity in zip(zone_buckets.tolist(), zone_quantities.tolist()):
+                    item_requirements = target.setdefault(item_id, {})
+                    item_requirements[bucket] = item_requirements.get(bucket, 0) + quantity
+        
+        head_items = [item_id for item_id in item_ids if item_id in head_requirements]
+        planned_orders = net_zone(head_items, head_requirements) if head_items else {}
+        
+        # 6.4 尾段从半冻结期末的投影库存开始净算，半冻结期内的到货已计入期初库存，
+        # 尾段的到货与需求映射到同一粗时段，在粗时段内到货早于需求时也能抵减
+        tail_items = [item_id for item_id in item_ids if item_id in tail_requirements]
+        if tail_items:
+            on_hand = []
+            for item_id in tail_items:
+                receipt_buckets, receipt_quantities = master.receipts_of(item_id)
+                on_hand.append(master.on_hand[item_id] + receipt_quantities[receipt_buckets < slushy_end].sum()
+                               + sum(planned_orders.get(item_id, {}).values())
+                               - sum(head_requirements.get(item_id, {}).values()))
+            net_with_kernel(tail_items, tail_requirements, planned_orders, on_hand=np.array(on_hand),
+                            first_bucket=slushy_end, lot_sizing=False, receipt_bucket_map=to_tail_buckets)
+        return planned_orders
+    
+    # 7. 按低层码逐层净算，计划订单按生产提前期展开到下一层
+    # 待求解的物料只统计生产计划产品及其下层物料中需要整数规划的物料，按低层码记录所在层
+    item_levels = np.zeros(master.item_count, dtype=np.int64)
+    item_levels[:compiled_bom.item_count] = compiled_bom.low_level_codes()
+    products = master.encode(production_plan['产品编码'].unique())
+    planned_items = np.union1d(products, compiled_bom.descendants(products[products < compiled_bom.item_count]))
+    pending_milp_levels = item_levels[[item_id for item_id in planned_items.tolist() if needs_milp(item_id)]]
+    
+    # 只有需要求解整数规划时才启动进程池
+    executor = None
+    if max_workers is not None and max_workers > 1 and (capacity_map or rolling) and model_cache is None:
+        executor = ProcessPoolExecutor(max_workers=max_workers)
+    try:
+        run_llc_mrp(production_plan, master, net_items, calendar=calendar, pegging=pegging)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    
+    # 8. 转换结果为DataFrame并返回
+    mrp_results = mrp_results.to_frame()
+    mrp_results.attrs['求解统计'] = solver_stats
+    return mrp_results
+
+# 按共用资源划分子问题
+def group_items_by_resource(items, resource_usage):
+    """
+    按共用资源把物料划分为互不相关的子问题
+    
+    参数:
+    - items: 物料列表，物料编码或物料ID
+    - resource_usage: 物料到{资源编码: 单位用量}的映射
+    
+    返回:
+    - clusters: 物料列表的列表，同组物料直接或间接共用资源，组内顺序与items一致
+    """
+    # 物料和资源作为并查集节点，物料与其消耗的资源合并
+    parent = {}
+    
+    def find(node):
+        while parent[node] != node:
+            parent[node] = parent[parent[node]]
+            node = parent[node]
+        return node
+    
+    for item in items:
+        parent.setdefault(('物料', item), ('物料', item))
+        for resource in resource_usage.get(item, {}):
+            parent.setdefault(('资源', resource), ('资源', resource))
+            parent[find(('物料', item))] = find(('资源', resource))
+    
+    clusters = {}
+    for item in items:
+        clusters.setdefault(find(('物料', item)), []).append(item)
+    return list(clusters.values())
 
-    # 7. 构建所有产品的BOM树
-    all_products = production_plan['产品编码'].unique()
-    bom_trees = {}
-    for product in all_products:
-        bom_trees[product] = build_bom_tree(product, bom_data)
+# 求解器后端选择函数
+def choose_solver_backend(item_models):
+    """
+    根据模型的变量类型、规模和是否含大M约束选择求解器后端
+    
+    参数:
+    - item_models: 物料模型输入列表，格式同ClusterModel
+    
+    返回:
+    - backend: 求解器后端名称
+    """
+    variable_count = 0
+    integer_count = 0
+    has_big_m = False
+    for model in item_models:
+        count = int(np.count_nonzero(model['is_demand']))
+        variable_count += count
+        if model['min_lot_size'] > 0 or model['lot_multiple'] > 1:
+            integer_count += count
+        has_big_m = has_big_m or model['min_lot_size'] > 0
+    
+    # 纯连续模型是线性规划，使用单纯形法GLOP得到精确的顶点解
+    if integer_count == 0:
+        return 'GLOP'
+    
+    # 连续和整数变量混合时使用分支定界
+    if integer_count < variable_count:
+        return 'SCIP'
+    
+    # 小规模纯整数模型使用CP-SAT，大规模时只有批量倍数的模型使用CBC
+    if variable_count <= CP_SAT_MAX_VARIABLES:
+        return 'CP-SAT'
+    return 'SCIP' if has_big_m else 'CBC'
 
-    # 8. 计算总需求
-    all_requirements = []
-    for _, row in production_plan.iterrows():
-        product = row['产品编码']
-        quantity = row['需求数量']
-        date = row['需求日期']
-        
-        # 获取该产品的BOM树
-        product_bom_tree = bom_trees.get(product, {})
-        
-        # 计算产品及其所有子项的需求
-        product_requirements = get_all_requirements(product, quantity, date, product_bom_tree)
-        all_requirements.extend(product_requirements)
-    
-    # 转换为DataFrame
-    gross_requirements_df = pd.DataFrame(all_requirements)
-    
-    # 9. 按物料和日期汇总总需求
-    gross_requirements_summary = gross_requirements_df.groupby(['物料编码', '需求日期']).agg(
-        {'需求数量': 'sum'}
-    ).reset_index()
-    
-    # 10. 考虑库存和安全库存
-    # 创建物料-库存映射
-    inventory_map = dict(zip(inventory_data['物料编码'], inventory_data['库存数量']))
-    safety_stock_map = dict(zip(inventory_data['物料编码'], inventory_data['安全库存']))
-    
-    # 添加采购订单数据
-    if purchase_orders is not None and not purchase_orders.empty:
-        # 确保采购订单有必要的列
-        required_po_cols = ['物料编码', '订单数量', '预计到货日期']
-        missing_po_cols = [col for col in required_po_cols if col not in purchase_orders.columns]
-        if not missing_po_cols:
-            # 按物料和日期汇总采购订单
-            po_summary = purchase_orders.groupby(['物料编码', '预计到货日期']).agg(
-                {'订单数量': 'sum'}
-            ).reset_index()
-        else:
-            po_summary = pd.DataFrame(columns=['物料编码', '预计到货日期', '订单数量'])
-    else:
-        po_summary = pd.DataFrame(columns=['物料编码', '预计到货日期', '订单数量'])
+# 共用资源物料组的联合净需求模型
+class ClusterModel:
+    """
+    共用资源物料组的联合净需求模型
     
-    # 11. 使用OR-Tools优化MRP计算
-    # 获取所有唯一的物料和日期
-    all_items = gross_requirements_summary['物料编码'].unique()
-    all_dates = sorted(gross_requirements_summary['需求日期'].unique())
+    变量和约束在构建时一次创建并保留，库存、到货、需求和产能的变化只需更新约束的右端项，
+    再次求解时以上次的解作为初始提示(热启动)。按字典序分两阶段求解：先最小化总净需求量，
+    再在总净需求量不增加的前提下按次要权重尽量晚生产，相对间隙只按第一阶段的目标计算
     
-    # 创建结果列表
-    mrp_results = []
+    属性:
+    - backend: 求解器后端名称
+    - solver: OR-Tools求解器
+    - key: 模型结构键，结构键相同的输入可以复用该模型
+    """
     
-    # 为每个物料计算MRP
-    for item in all_items:
-        # 获取物料的总需求
-        item_requirements = gross_requirements_summary[gross_requirements_summary['物料编码'] == item]
+    def __init__(self, item_models, capacity, backend=None):
+        """
+        构建模型
         
-        # 获取物料的库存和安全库存
-        current_inventory = inventory_map.get(item, 0)
-        safety_stock = safety_stock_map.get(item, 0)
+        参数:
+        - item_models: 物料模型输入列表，每项包含item、buckets、demand、receipts、is_demand、
+          current_inventory、safety_stock、min_lot_size、lot_multiple和resource_usage
+        - capacity: 资源编码到{时段: 可用产能}的映射
+        - backend: 求解器后端 (可选)，未提供时由choose_solver_backend选择
         
-        # 获取物料的采购订单
-        item_pos = po_summary[po_summary['物料编码'] == item] if not po_summary.empty else pd.DataFrame()
+        抛出:
+        - ValueError: 如果无法创建求解器或求解器不支持批量约束
+        """
+        # 创建优化求解器，线性规划求解器不支持批量约束的整数变量
+        if backend is None:
+            backend = choose_solver_backend(item_models)
+        if backend in ('GLOP', 'PDLP') and any(model['min_lot_size'] > 0 or model['lot_multiple'] > 1
+                                               for model in item_models):
+            raise ValueError(f"求解器 {backend} 不支持批量约束，请使用 {', '.join(SOLVER_BACKENDS[2:])}")
+        solver = pywraplp.Solver.CreateSolver(backend)
+        if not solver:
+            raise ValueError(f"无法创建求解器: {backend}")
+        if backend == 'PDLP':
+            solver.SetSolverSpecificParametersAsString(PDLP_PARAMETERS)
         
-        # 获取物料的批量约束
-        min_lot_size = min_lot_size_map.get(item, 0)
-        lot_multiple = lot_multiple_map.get(item, 1)
+        self.backend = backend
+        self.solver = solver
+        self.key = cluster_model_key(item_models, capacity, backend)
+        self.event_counts = [len(model['demand']) for model in item_models]
+        self.requirements = []
+        self.inventory_constraints = []
+        self.capacity_constraints = {}
+        self.capacity_terms = {}
+        self.objective_weights = {}
+        self.solutions = None
         
-        # 获取物料的采购提前期
-        purchase_lead_time = purchase_lead_time_map.get(item, 0)
+        capacity_terms = self.capacity_terms
+        objective_weights = self.objective_weights
+        for model in item_models:
+            item = model['item']
+            min_lot_size = model['min_lot_size']
+            lot_multiple = model['lot_multiple']
+            
+            # 创建变量：只在需求时段上安排净需求量
+            net_requirements = {}
+            for k in np.flatnonzero(model['is_demand']):
+                # 考虑批量约束
+                if min_lot_size > 0 or lot_multiple > 1:
+                    # 使用整数变量
+                    net_requirements[k] = solver.IntVar(0, solver.infinity(), f'net_req_{item}_{k}')
+                else:
+                    # 使用连续变量
+                    net_requirements[k] = solver.NumVar(0, solver.infinity(), f'net_req_{item}_{k}')
+            
+            # 创建约束
+            # 1. 库存约束：需求时段的期末库存不低于安全库存，库存、到货和需求只出现在右端项
+            inventory_constraints = {}
+            produced = []
+            for k, variable in net_requirements.items():
+                # 批量约束，只有最小批量需要大M方法
+                if min_lot_size > 0:
+                    is_produced = solver.BoolVar(f'is_produced_{item}_{k}')
+                    solver.Add(variable <= is_produced * 999999) # 大M方法
+                    solver.Add(variable >= is_produced * min_lot_size)
+                if lot_multiple > 1:
+                    # 引入一个整数变量来处理批量倍数
+                    lot_multiplier = solver.IntVar(0, solver.infinity(), f'lot_multiplier_{item}_{k}')
+                    solver.Add(variable == lot_multiplier * lot_multiple)
+                
+                # 累计净需求量 >= 安全库存 - 期初库存 - 累计到货 + 累计需求
+                produced.append(variable)
+                constraint = solver.Constraint(-solver.infinity(), solver.infinity(), f'inventory_{item}_{k}')
+                for produced_variable in produced:
+                    constraint.SetCoefficient(produced_variable, 1)
+                inventory_constraints[k] = constraint
+            
+            # 越早生产持有库存越久，权重越大
+            event_count = len(model['demand'])
+            for k, variable in net_requirements.items():
+                objective_weights[variable] = 1 + HOLDING_TIE_BREAK * (event_count - k) / event_count
+            
+            # 收集各资源各时段的产能占用，记录物料序号和事件序号以便检查解的约束残差
+            for resource, usage in model['resource_usage'].items():
+                bucket_capacity = capacity.get(resource, {})
+                for k, variable in net_requirements.items():
+                    bucket = int(model['buckets'][k])
+                    if bucket in bucket_capacity:
+                        capacity_terms.setdefault((resource, bucket), []).append(
+                            (variable, usage, len(self.requirements), k))
+            
+            self.requirements.append(net_requirements)
+            self.inventory_constraints.append(inventory_constraints)
         
-        # 创建优化求解器
-        solver = pywraplp.Solver.CreateSolver('SCIP')
-        if not solver:
-            raise ValueError("无法创建求解器")
-        
-        # 创建变量：每个时间段的净需求量
-        net_requirements = {}
-        for date in all_dates:
-            # 考虑批量约束
-            if min_lot_size > 0 or lot_multiple > 1:
-                # 使用整数变量
-                net_requirements[date] = solver.IntVar(0, solver.infinity(), f'net_req_{item}_{date}')
+        # 2. 产能约束：共用资源的物料合计占用不超过可用产能
+        for (resource, bucket), terms in capacity_terms.items():
+            constraint = solver.Constraint(-solver.infinity(), solver.infinity(), f'capacity_{resource}_{bucket}')
+            for variable, usage, _, _ in terms:
+                constraint.SetCoefficient(variable, usage)
+            self.capacity_constraints[(resource, bucket)] = constraint
+        
+        # 3. 总净需求量约束：第一阶段不限制，第二阶段不超过第一阶段的最优值
+        self.total_constraint = solver.Constraint(-solver.infinity(), solver.infinity(), 'total_net_requirement')
+        for variable in objective_weights:
+            self.total_constraint.SetCoefficient(variable, 1)
+        
+        # 4. 目标函数：最小化总净需求量，第二阶段换为带次要权重的目标，消除多重最优解，使各求解器的解保持一致
+        solver.Objective().SetMinimization()
+        
+        self.update(item_models, capacity)
+    
+    def update(self, item_models, capacity):
+        """
+        按新的输入更新约束右端项，item_models和capacity的结构必须与构建时相同
+        
+        参数:
+        - item_models: 物料模型输入列表
+        - capacity: 资源编码到{时段: 可用产能}的映射
+        """
+        for model, inventory_constraints in zip(item_models, self.inventory_constraints):
+            inventory_level = model['current_inventory'] + np.cumsum(np.asarray(model['receipts'], dtype=float)
+                                                                     - np.asarray(model['demand'], dtype=float))
+            for k, constraint in inventory_constraints.items():
+                constraint.SetLb(model['safety_stock'] - inventory_level[k])
+        
+        for (resource, bucket), constraint in self.capacity_constraints.items():
+            constraint.SetUb(capacity[resource][bucket])
+    
+    def solve(self, time_limit=None, mip_gap=None):
+        """
+        求解模型，已有上次的解时作为整数规划的初始提示
+        
+        先最小化总净需求量，再在总净需求量不增加的前提下按次要权重求解；整数规划的相对间隙由最优界计算，
+        线性规划由对偶目标值计算。PDLP的近似解在返回前修复库存约束，所有解都报告约束的最大违反量
+        
+        参数:
+        - time_limit: 两个阶段合计的求解时间上限(秒) (可选)，超时后采用当前最好的可行解
+        - mip_gap: 整数规划的相对间隙目标 (可选)
+        
+        返回:
+        - solutions: 各物料各事件时段的净需求量数组列表，没有可行解时为None
+        - stats: 求解统计，包含求解器、求解耗时(秒)、求解状态、总净需求量的相对间隙和原始残差，
+          线性规划还包含对偶残差
+        """
+        solver = self.solver
+        objective = solver.Objective()
+        start_time = time.perf_counter()
+        
+        # 1. 第一阶段：只最小化总净需求量
+        for variable in self.objective_weights:
+            objective.SetCoefficient(variable, 1)
+        self.total_constraint.SetUb(solver.infinity())
+        status = self._solve_phase(self.solutions, time_limit, mip_gap)
+        stats = {'求解器': self.backend, '求解状态': SOLVER_STATUS.get(status, '异常')}
+        
+        # 没有最优或可行解时不返回方案
+        if status not in (pywraplp.Solver.OPTIMAL, pywraplp.Solver.FEASIBLE):
+            stats['求解耗时'] = time.perf_counter() - start_time
+            stats['相对间隙'] = np.nan
+            return None, stats
+        
+        # 总净需求量的下界：整数规划为最优界，线性规划为对偶目标值
+        if solver.IsMip():
+            lower_bound = objective.BestBound()
+        else:
+            lower_bound, stats['对偶残差'] = self._dual_bound()
+        solutions = self._solution_values()
+        
+        # 2. 第二阶段：总净需求量不超过第一阶段的值，次要权重消除多重最优解，使各求解器的解保持一致
+        total = objective.Value()
+        self.total_constraint.SetUb(total + 1e-6 * max(abs(total), 1))
+        for variable, weight in self.objective_weights.items():
+            objective.SetCoefficient(variable, weight)
+        remaining = max(time_limit - (time.perf_counter() - start_time), 0) if time_limit is not None else None
+        if self._solve_phase(solutions, remaining, mip_gap) in (pywraplp.Solver.OPTIMAL, pywraplp.Solver.FEASIBLE):
+            solutions = self._solution_values()
+        
+        # PDLP的解只在容差内满足约束，去掉负值和舍入误差后补足低于安全库存的缺口
+        if self.backend == 'PDLP':
+            solutions = self._repair(solutions)
+        
+        total = sum(float(solution.sum()) for solution in solutions)
+        stats['求解耗时'] = time.perf_counter() - start_time
+        stats['相对间隙'] = max(total - lower_bound, 0) / max(abs(total), 1e-9)
+        stats['原始残差'] = self._primal_residual(solutions)
+        self.solutions = solutions
+        return solutions, stats
+    
+    def _solve_phase(self, hint, time_limit, mip_gap):
+        """
+        按时间上限和相对间隙目标求解一次，hint作为整数规划的初始提示
+        """
+        solver = self.solver
+        if hint is not None and solver.IsMip():
+            variables, values = [], []
+            for net_requirements, solution in zip(self.requirements, hint):
+                for k, variable in net_requirements.items():
+                    variables.append(variable)
+                    values.append(float(solution[k]))
+            solver.SetHint(variables, values)
+        
+        # 复用的模型每次都重新设置时间上限，0表示不限时
+        solver.SetTimeLimit(max(int(time_limit * 1000), 1) if time_limit is not None else 0)
+        parameters = pywraplp.MPSolverParameters()
+        if mip_gap is not None and solver.IsMip():
+            parameters.SetDoubleParam(pywraplp.MPSolverParameters.RELATIVE_MIP_GAP, mip_gap)
+        return solver.Solve(parameters)
+    
+    def _solution_values(self):
+        """
+        读取各物料各事件时段的净需求量
+        """
+        solutions = []
+        for net_requirements, event_count in zip(self.requirements, self.event_counts):
+            solution = np.zeros(event_count)
+            for k, variable in net_requirements.items():
+                solution[k] = variable.SolutionValue()
+            solutions.append(solution)
+        return solutions
+    
+    def _dual_bound(self):
+        """
+        由线性规划的对偶解计算总净需求量的下界和对偶残差
+        
+        对偶变量符号与约束的有效边界不符，或者变量的检验数为负时计入对偶残差
+        """
+        constraints = [constraint for inventory_constraints in self.inventory_constraints
+                       for constraint in inventory_constraints.values()]
+        constraints += list(self.capacity_constraints.values()) + [self.total_constraint]
+        lower_bound = 0.0
+        residual = 0.0
+        for constraint in constraints:
+            dual = constraint.dual_value()
+            side = constraint.lb() if dual > 0 else constraint.ub()
+            if dual == 0:
+                continue
+            if np.isinf(side):
+                residual = max(residual, abs(dual))
             else:
-                # 使用连续变量
-                net_requirements[date] = solver.NumVar(0, solver.infinity(), f'net_req_{item}_{date}')
-        
-        # 创建约束
-        # 1. 库存约束
-        inventory_level = current_inventory
-        for i, date in enumerate(all_dates):
-            demand_on_date = item_requirements[item_requirements['需求日期'] == date]['需求数量'].sum() if date in item_requirements['需求日期'].values else 0
-            po_on_date = item_pos[item_pos['预计到货日期'] == date]['订单数量'].sum() if not item_pos.empty and date in item_pos['预计到货日期'].values else 0
-            
-            # 批量约束
-            is_produced = solver.BoolVar(f'is_produced_{item}_{date}')
-            solver.Add(net_requirements[date] <= is_produced * 999999) # 大M方法
-            solver.Add(net_requirements[date] >= is_produced * min_lot_size_map.get(item, 0))
-            if lot_multiple_map.get(item, 1) > 1:
-                # 引入一个整数变量来处理批量倍数
-                lot_multiplier = solver.IntVar(0, solver.infinity(), f'lot_multiplier_{item}_{date}')
-                solver.Add(net_requirements[date] == lot_multiplier * lot_multiple_map.get(item, 1))
+                lower_bound += dual * side
+        for variable in self.objective_weights:
+            residual = max(residual, -variable.reduced_cost())
+        return lower_bound, residual
+    
+    def _repair(self, solutions):
+        """
+        将近似解的净需求量取非负并舍入到1e-6，再在累计净需求量不足的事件时段补足缺口
+        """
+        repaired = []
+        for solution, inventory_constraints in zip(solutions, self.inventory_constraints):
+            solution = np.round(np.maximum(solution, 0), 6)
+            produced = 0.0
+            for k, constraint in inventory_constraints.items():
+                produced += solution[k]
+                shortfall = constraint.lb() - produced
+                if shortfall > 0:
+                    solution[k] += shortfall
+                    produced += shortfall
+            repaired.append(solution)
+        return repaired
+    
+    def _primal_residual(self, solutions):
+        """
+        计算解的原始残差，即库存约束和产能约束的最大违反量
+        """
+        residual = 0.0
+        for solution, inventory_constraints in zip(solutions, self.inventory_constraints):
+            produced = np.cumsum(solution)
+            for k, constraint in inventory_constraints.items():
+                residual = max(residual, constraint.lb() - produced[k])
+        for key, terms in self.capacity_terms.items():
+            used = sum(usage * solutions[item_index][k] for _, usage, item_index, k in terms)
+            residual = max(residual, used - self.capacity_constraints[key].ub())
+        return float(residual)
 
-            # 库存水平更新
-            inventory_level += po_on_date + net_requirements[date] - demand_on_date
-            solver.Add(inventory_level >= safety_stock)
+# 模型结构键计算函数
+def cluster_model_key(item_models, capacity, backend):
+    """
+    计算联合净需求模型的结构键
+    
+    结构键包含物料、事件时间轴、批量规则、资源用量和受约束的产能时段，
+    不包含库存、到货、需求和产能数值，这些只影响约束右端项
+    
+    参数:
+    - item_models: 物料模型输入列表
+    - capacity: 资源编码到{时段: 可用产能}的映射
+    - backend: 求解器后端名称
+    
+    返回:
+    - key: 可比较的结构键
+    """
+    item_keys = []
+    capacity_keys = set()
+    for model in item_models:
+        buckets = np.asarray(model['buckets'])
+        is_demand = np.asarray(model['is_demand'], dtype=bool)
+        item_keys.append((model['item'], buckets.tobytes(), is_demand.tobytes(), model['min_lot_size'],
+                          model['lot_multiple'], tuple(sorted(model['resource_usage'].items()))))
+        for resource in model['resource_usage']:
+            bucket_capacity = capacity.get(resource, {})
+            capacity_keys.update((resource, bucket) for bucket in buckets[is_demand].tolist() if bucket in bucket_capacity)
+    return backend, tuple(item_keys), tuple(sorted(capacity_keys))
 
-        # 2. 产能约束
-        for resource, date_capacity in capacity_map.items():
-            for date, capacity in date_capacity.items():
-                if date in all_dates:
-                    # 假设每个物料消耗1单位资源
-                    solver.Add(net_requirements[date] <= capacity)
-        
-        # 3. 目标函数：最小化总净需求量和库存持有成本
-        objective = solver.Objective()
+class ModelCache:
+    """
+    跨多次计算保留的联合净需求模型
+    
+    按物料组保存ClusterModel，物料组的模型结构不变时只更新右端项并热启动求解，
+    结构变化时重新构建；缓存的求解器对象不能在进程间传输，使用缓存时在主进程中求解
+    """
+    
+    def __init__(self):
+        self.models = {}
+    
+    def get(self, item_models, capacity, backend=None):
+        """
+        获取可复用的模型，并按输入更新右端项
         
-        # 净需求成本权重
-        for date in all_dates:
-            objective.SetCoefficient(net_requirements[date], 1)
+        参数:
+        - item_models: 物料模型输入列表
+        - capacity: 资源编码到{时段: 可用产能}的映射
+        - backend: 求解器后端 (可选)，未提供时由choose_solver_backend选择
         
-        objective.SetMinimization()
+        返回:
+        - model: ClusterModel
+        """
+        if backend is None:
+            backend = choose_solver_backend(item_models)
+        items = tuple(model['item'] for model in item_models)
+        model = self.models.get(items)
+        if model is not None and model.key == cluster_model_key(item_models, capacity, backend):
+            model.update(item_models, capacity)
+            return model
         
-        # 求解
-        status = solver.Solve()
+        model = ClusterModel(item_models, capacity, backend)
+        self.models[items] = model
+        return model
+
+# 共用资源物料组的整数规划求解函数
+def solve_cluster_milp(item_models, capacity, backend=None, time_limit=None, mip_gap=None):
+    """
+    为共用资源的一组物料构建并求解联合净需求模型
+    
+    每个物料的输入都是按物料事件时段对齐的数组，便于在进程池中传输；
+    同一资源同一时段内各物料按单位用量合计占用产能
+    
+    参数:
+    - item_models: 物料模型输入列表，格式同ClusterModel
+    - capacity: 资源编码到{时段: 可用产能}的映射
+    - backend: 求解器后端 (可选)，未提供时由choose_solver_backend选择
+    - time_limit: 求解时间上限(秒) (可选)，超时后采用当前最好的可行解
+    - mip_gap: 整数规划的相对间隙目标 (可选)
+    
+    返回:
+    - solutions: 与item_models对应的各事件时段净需求量数组列表，没有可行解时为None
+    - stats: 求解统计，包含求解器、求解耗时(秒)、求解状态、相对间隙和原始残差
+    
+    抛出:
+    - ValueError: 如果无法创建求解器或求解器不支持批量约束
+    """
+    return ClusterModel(item_models, capacity, backend).solve(time_limit, mip_gap)
+
+# 需求和提前期不确定性的蒙特卡洛模拟
+def simulate_demand_uncertainty(production_plan, bom_data, inventory_data, purchase_orders=None, lead_times=None,
+                                lot_sizes=None, compiled_bom=None, time_bucket='day', samples=1000, demand_cv=0.1,
+                                lead_time_cv=0.2, percentiles=(5, 50, 95), max_workers=None, batch_size=None, seed=None):
+    """
+    蒙特卡洛模拟需求数量和提前期不确定性下各物料的缺货概率
+    
+    先按名义需求和提前期计算基准计划，基准计划的计划订单作为已承诺的供给；每个样本按抽样的需求数量和提前期
+    重新逐层展开和净算得到各物料的总需求，采购订单和计划订单按抽样提前期与名义提前期之差延迟到货，
+    投影库存低于0即为缺货。每批样本的每个(样本, 物料)为一行，只在有需求或到货的时段上有事件，
+    不展开为完整的时段数组；各批只返回缺货次数和投影库存的直方图，不保留原始样本，可以分发到进程池
+    
+    参数:
+    - production_plan: 生产计划DataFrame
+    - bom_data: BOM数据DataFrame
+    - inventory_data: 库存数据DataFrame
+    - purchase_orders: 采购订单DataFrame (可选)
+    - lead_times: 物料提前期DataFrame (可选)，有子项的物料按生产提前期到货，其余物料按采购提前期到货
+    - lot_sizes: 批量大小约束DataFrame (可选)
+    - compiled_bom: 预先编译的BOM索引CompiledBOM (可选)，未提供时从bom_data构建
+    - time_bucket: 计划时段模式 'day'、'week'、'month'，或自定义日历BucketCalendar
+    - samples: 样本数
+    - demand_cv: 需求数量的变异系数，每个样本的每行生产计划独立按正态分布抽样，截断为非负
+    - lead_time_cv: 提前期的变异系数，每个样本的每个物料独立抽样，取整并截断为非负
+    - percentiles: 输出的投影库存百分位数，由直方图估计，误差不超过所在箱的宽度
+    - max_workers: 并行模拟的进程数 (可选)，大于1时各批样本分发到进程池
+    - batch_size: 每批的样本数 (可选)，未提供时使每批的事件和输出单元合计约为SIMULATION_BATCH_VALUES个
+    - seed: 随机种子 (可选)，相同种子和每批样本数的结果与进程数无关
+    
+    返回:
+    - simulation: DataFrame，每个物料和基准计划需求时段一行，包含物料编码、需求周期、总需求量、期末库存(基准计划)、
+      缺货概率以及各百分位的投影库存；attrs['模拟次数']记录样本数
+    
+    抛出:
+    - ValueError: 如果缺少必要的列或参数无效
+    """
+    # 1. 数据验证
+    required_columns = {
+        'production_plan': ['产品编码', '需求数量', '需求日期'],
+        'bom_data': ['父项编码', '子项编码', '用量'],
+        'inventory_data': ['物料编码', '库存数量', '安全库存']
+    }
+    
+    for df_name, cols in required_columns.items():
+        df = eval(df_name)
+        missing_cols = [col for col in cols if col not in df.columns]
+        if missing_cols:
+            raise ValueError(f"{df_name}缺少必要的列: {', '.join(missing_cols)}")
+    
+    if lead_times is not None and not all(col in lead_times.columns for col in ['物料编码', '生产提前期', '采购提前期']):
+        raise ValueError("提前期数据缺少必要的列: 物料编码, 生产提前期, 采购提前期")
+    if samples < 1 or (batch_size is not None and batch_size < 1):
+        raise ValueError("样本数和每批样本数必须大于0")
+    if demand_cv < 0 or lead_time_cv < 0:
+        raise ValueError("变异系数不能为负数")
+    
+    # 2. 按名义需求和提前期计算基准计划
+    calendar = make_calendar(time_bucket)
+    products = production_plan['产品编码'].unique()
+    if compiled_bom is None:
+        compiled_bom = CompiledBOM(bom_data, products)
+    master = MaterialMaster(compiled_bom, inventory_data, purchase_orders, calendar=calendar, lead_times=lead_times,
+                            lot_sizes=lot_sizes, items=products)
+    baseline = run_scenario_mrp({'基准': production_plan}, master, calendar=calendar)
+    
+    # 3. 构建模拟模型，只包含产品及其所有下层物料，物料按局部下标存为数组
+    product_ids = master.encode(products).astype(np.int64)
+    item_ids = np.union1d(product_ids, compiled_bom.descendants(product_ids[product_ids < compiled_bom.item_count]))
+    local_ids = np.full(master.item_count, -1, dtype=np.int64)
+    local_ids[item_ids] = np.arange(len(item_ids))
+    
+    llc = np.zeros(master.item_count, dtype=np.int64)
+    llc[:compiled_bom.item_count] = compiled_bom.low_level_codes()
+    bom_item_ids = np.where(item_ids < compiled_bom.item_count, item_ids, 0)
+    edge_counts = np.where(item_ids < compiled_bom.item_count,
+                           compiled_bom.offsets[bom_item_ids + 1] - compiled_bom.offsets[bom_item_ids], 0)
+    positions, _ = compiled_bom.edge_positions(item_ids[edge_counts > 0])
+    
+    baseline_buckets = calendar.to_buckets(baseline['需求周期']).astype(np.int64)
+    first_bucket = int(baseline_buckets.min()) if len(baseline) else 0
+    baseline_items = local_ids[master.encode(baseline['物料编码'])]
+    supplied = baseline['净需求量'].to_numpy() > 0
+    receipt_positions, receipt_items = csr_positions(master.receipt_offsets, item_ids)
+    demand_ids = local_ids[master.encode(production_plan['产品编码'])]
+    
+    model = {
+        'calendar': calendar,
+        'first_bucket': first_bucket,
+        'last_bucket': int(baseline_buckets.max()) if len(baseline) else first_bucket,
+        'llc': llc[item_ids],
+        'on_hand': master.on_hand[item_ids],
+        'safety_stock': master.safety_stock[item_ids],
+        'lot_rules': master.lot_rules[item_ids],
+        'has_lot_rules': master.has_lot_rules[item_ids],
+        'production_lead_time': master.production_lead_time[item_ids],
+        'purchase_lead_time': master.purchase_lead_time[item_ids],
+        'made': edge_counts > 0,
+        'edge_offsets': np.concatenate([[0], np.cumsum(edge_counts)]),
+        'edge_children': local_ids[compiled_bom.children[positions]],
+        'edge_quantities': compiled_bom.quantities[positions],
+        'demand_items': demand_ids,
+        'demand_buckets': calendar.to_buckets(production_plan['需求日期']).astype(np.int64),
+        'demand_quantities': production_plan['需求数量'].to_numpy(dtype=np.float64),
+        'receipt_items': receipt_items,
+        'receipt_buckets': master.receipt_buckets[receipt_positions].astype(np.int64),
+        'receipt_quantities': master.receipt_quantities[receipt_positions],
+        'supply_items': baseline_items[supplied],
+        'supply_buckets': baseline_buckets[supplied],
+        'supply_quantities': baseline['净需求量'].to_numpy()[supplied],
+        'cell_items': baseline_items,
+        'cell_buckets': baseline_buckets,
+        'demand_cv': demand_cv,
+        'lead_time_cv': lead_time_cv
+    }
+    
+    # 4. 按批模拟，每批使用独立的随机种子；第一批确定直方图的取值范围，其余各批按顺序分为每个进程一组，
+    # 每组累加为一个直方图，直方图的合并顺序不影响结果，结果与进程数无关
+    if batch_size is None:
+        values_per_sample = len(baseline) + len(model['demand_items']) + len(model['receipt_items']) + len(
+            model['supply_items'])
+        batch_size = max(SIMULATION_BATCH_VALUES // max(values_per_sample, 1), 1)
+    batch_sizes = [min(batch_size, samples - start) for start in range(0, samples, batch_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(batch_sizes))
+    histogram = simulate_batch(model, seeds[:1], batch_sizes[:1], max_count=samples)
+    groups = [(group_seeds, group_sizes) for group_seeds, group_sizes in
+              zip(*(np.array_split(np.asarray(values, dtype=object), max(max_workers or 1, 1))
+                    for values in (seeds[1:], batch_sizes[1:]))) if len(group_sizes)]
+    options = {'lower': histogram.lower, 'upper': histogram.upper, 'max_count': samples}
+    if max_workers is not None and max_workers > 1 and len(groups) > 1:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(simulate_batch, model, list(group_seeds), list(group_sizes), **options)
+                       for group_seeds, group_sizes in groups]
+            for future in futures:
+                histogram.merge(future.result())
+    else:
+        for group_seeds, group_sizes in groups:
+            histogram.merge(simulate_batch(model, list(group_seeds), list(group_sizes), **options))
+    
+    # 5. 汇总缺货概率和投影库存百分位数
+    simulation = baseline[['物料编码', '需求周期', '总需求量', '期末库存']].copy()
+    simulation['缺货概率'] = histogram.shortage_counts / samples
+    for percentile, values in zip(percentiles, histogram.percentiles(percentiles)):
+        simulation[f'投影库存P{percentile:g}'] = values
+    simulation.attrs['模拟次数'] = samples
+    return simulation
+
+class ProjectionHistogram:
+    """
+    各输出单元(物料, 时段)投影库存的分箱直方图，按批累加，不保留原始样本
+    
+    每个单元在[lower, upper]之间等宽分箱，超出范围的值计入两端的箱，同时记录精确的最小值和最大值，
+    两端的箱按最小值和最大值插值。直方图的计数可以相加，合并顺序不影响结果；
+    总样本数小于65536时计数使用uint16，每个单元占用分箱数 x 2字节
+    
+    属性:
+    - lower: 各单元分箱范围的下限数组
+    - upper: 各单元分箱范围的上限数组
+    - counts: 各单元各箱的样本数 (单元 x 分箱数)
+    - minimum: 各单元投影库存的最小值数组
+    - maximum: 各单元投影库存的最大值数组
+    - shortage_counts: 各单元投影库存低于0的样本数
+    - sample_count: 已累加的样本数
+    """
+    
+    def __init__(self, lower, upper, bins=SIMULATION_HISTOGRAM_BINS, max_count=None):
+        """
+        创建空的直方图
         
-        # 处理结果
-        if status == pywraplp.Solver.OPTIMAL:
-            # 重新计算每个时间段的投影库存和净需求
-            projected_inventory = current_inventory
-            for date in all_dates:
-                # 当前日期的需求
-                date_req = item_requirements[item_requirements['需求日期'] == date]['需求数量'].sum() if date in item_requirements['需求日期'].values else 0
-                
-                # 当前日期的采购到货
-                date_po = item_pos[item_pos['预计到货日期'] == date]['订单数量'].sum() if not item_pos.empty and date in item_pos['预计到货日期'].values else 0
-                
-                # 计算净需求
-                net_req = net_requirements[date].SolutionValue()
-                
-                # 考虑采购提前期计算下单日期
-                order_date = pd.to_datetime(date) - pd.Timedelta(days=purchase_lead_time)
-                
-                # 只有当净需求大于0时才添加到结果中
-                if net_req > 0:
-                    mrp_results.append({
-                        '物料编码': item,
-                        '需求周期': date,
-                        '下单日期': order_date,
-                        '总需求量': date_req,
-                        '期初库存': projected_inventory,
-                        '安全库存': safety_stock,
-                        '采购到货': date_po,
-                        '净需求量': net_req,
-                        '期末库存': projected_inventory + date_po + net_req - date_req,
-                        '生产提前期': production_lead_time_map.get(item, 0),
-                        '采购提前期': purchase_lead_time
-                    })
-                
-                # 更新投影库存
-                projected_inventory = projected_inventory + date_po + net_req - date_req
-        else:
-            raise ValueError(f"无法为物料 {item} 找到最优解")
+        参数:
+        - lower: 各单元分箱范围的下限数组
+        - upper: 各单元分箱范围的上限数组
+        - bins: 分箱数
+        - max_count: 累加的总样本数上限 (可选)，决定计数的数据类型
+        """
+        self.lower = np.asarray(lower, dtype=np.float64)
+        self.upper = np.maximum(np.asarray(upper, dtype=np.float64), self.lower)
+        dtype = np.uint16 if max_count is not None and max_count < 2 ** 16 else np.uint32
+        self.counts = np.zeros((len(self.lower), bins), dtype=dtype)
+        self.minimum = np.full(len(self.lower), np.inf)
+        self.maximum = np.full(len(self.lower), -np.inf)
+        self.shortage_counts = np.zeros(len(self.lower), dtype=np.int64)
+        self.sample_count = 0
+    
+    def add(self, projected):
+        """
+        累加一批样本的投影库存 (样本 x 单元)
+        """
+        cell_count, bins = self.counts.shape
+        width = (self.upper - self.lower) / bins
+        scaled = (projected - self.lower) / np.where(width > 0, width, 1)
+        bin_ids = np.clip(np.floor(scaled), 0, bins - 1).astype(np.int64)
+        
+        # 按单元分块计数，每块的临时计数数组不超过SIMULATION_BATCH_VALUES个元素
+        chunk = max(SIMULATION_BATCH_VALUES // bins, 1)
+        for start in range(0, cell_count, chunk):
+            stop = min(start + chunk, cell_count)
+            flat_ids = (np.arange(stop - start) * bins + bin_ids[:, start:stop]).ravel()
+            chunk_counts = np.bincount(flat_ids, minlength=(stop - start) * bins).reshape(stop - start, bins)
+            self.counts[start:stop] += chunk_counts.astype(self.counts.dtype)
+        self.minimum = np.minimum(self.minimum, projected.min(axis=0, initial=np.inf))
+        self.maximum = np.maximum(self.maximum, projected.max(axis=0, initial=-np.inf))
+        self.shortage_counts += (projected < 0).sum(axis=0)
+        self.sample_count += len(projected)
+    
+    def merge(self, other):
+        """
+        合并分箱范围相同的另一个直方图
+        """
+        self.counts += other.counts
+        self.minimum = np.minimum(self.minimum, other.minimum)
+        self.maximum = np.maximum(self.maximum, other.maximum)
+        self.shortage_counts += other.shortage_counts
+        self.sample_count += other.sample_count
+    
+    def percentiles(self, percentiles):
+        """
+        估计各单元的百分位数，与np.percentile的线性插值约定一致，误差不超过所在箱的宽度
+        
+        参数:
+        - percentiles: 百分位数列表
+        
+        返回:
+        - values: 各百分位数的数组列表，每个数组按单元排列
+        """
+        cell_count, bins = self.counts.shape
+        edges = self.lower[:, None] + (self.upper - self.lower)[:, None] * np.arange(bins + 1) / bins
+        edges[:, 0] = np.minimum(edges[:, 0], self.minimum)
+        edges[:, -1] = np.maximum(edges[:, -1], self.maximum)
+        cumulative = np.cumsum(self.counts, axis=1, dtype=np.int64)
+        cells = np.arange(cell_count)
+        values = []
+        for percentile in percentiles:
+            rank = percentile / 100 * (self.sample_count - 1)
+            bin_ids = np.minimum((cumulative <= rank).sum(axis=1), bins - 1)
+            before = cumulative[cells, bin_ids] - self.counts[cells, bin_ids]
+            fraction = (rank - before + 0.5) / np.maximum(self.counts[cells, bin_ids], 1)
+            estimate = edges[cells, bin_ids] + fraction * (edges[cells, bin_ids + 1] - edges[cells, bin_ids])
+            values.append(np.clip(estimate, self.minimum, self.maximum))
+        return values
+
+def simulate_batch(model, seeds, sample_counts, lower=None, upper=None, max_count=None):
+    """
+    依次模拟一组批次的样本，累加为一个投影库存直方图，每批的投影库存累加后即丢弃
+    
+    参数:
+    - model: 模拟模型字典，见simulate_demand_uncertainty
+    - seeds: 各批的随机种子列表
+    - sample_counts: 各批的样本数列表
+    - lower: 直方图各单元分箱范围的下限 (可选)，与upper都未提供时按第一批的取值范围向两侧各放宽一半确定
+    - upper: 直方图各单元分箱范围的上限 (可选)
+    - max_count: 直方图累加的总样本数上限 (可选)，见ProjectionHistogram
+    
+    返回:
+    - histogram: 这组样本的ProjectionHistogram
+    """
+    histogram = None
+    for seed, sample_count in zip(seeds, sample_counts):
+        projected = simulate_projection(model, seed, sample_count)
+        if histogram is None:
+            if lower is None or upper is None:
+                lower, upper = projected.min(axis=0), projected.max(axis=0)
+                margin = (upper - lower) / 2
+                lower, upper = lower - margin, upper + margin
+            histogram = ProjectionHistogram(lower, upper, max_count=max_count)
+        histogram.add(projected)
+    return histogram
+
+def simulate_projection(model, seed, sample_count):
+    """
+    模拟一批样本在各输出单元上的投影库存
+    
+    每个(样本, 物料)为一行，行号为样本序号 x 物料数 + 物料下标；总需求、到货和计划订单都是(行, 时段, 数量)的
+    稀疏记录，逐层只在有需求的时段上净算，投影库存为输出单元及之前各时段净流量的累计
+    
+    参数:
+    - model: 模拟模型字典，见simulate_demand_uncertainty
+    - seed: 本批的随机种子
+    - sample_count: 本批样本数
+    
+    返回:
+    - projected: 各样本在输出单元上的投影库存 (样本 x 输出单元)
+    """
+    rng = np.random.default_rng(seed)
+    calendar = model['calendar']
+    first_bucket, last_bucket = model['first_bucket'], model['last_bucket']
+    item_count = len(model['llc'])
+    samples = np.arange(sample_count)
+    
+    # 1. 抽样需求数量和提前期
+    demand_factors = np.maximum(rng.normal(1.0, model['demand_cv'], (sample_count, len(model['demand_items']))), 0)
+    production_lead_time = np.maximum(np.rint(model['production_lead_time'] * (
+        1 + rng.normal(0.0, model['lead_time_cv'], (sample_count, item_count)))), 0).astype(np.int64)
+    purchase_lead_time = np.maximum(np.rint(model['purchase_lead_time'] * (
+        1 + rng.normal(0.0, model['lead_time_cv'], (sample_count, item_count)))), 0).astype(np.int64)
+    
+    # 转换为(行, 时段, 数量)记录，早于计划起点的计入第一个时段，晚于计划终点的舍弃
+    def records(sample_ids, items, buckets, quantities):
+        buckets = np.maximum(np.asarray(buckets, dtype=np.int64), first_bucket)
+        in_horizon = buckets <= last_bucket
+        return (sample_ids[in_horizon] * item_count + items[in_horizon], buckets[in_horizon],
+                np.asarray(quantities, dtype=np.float64)[in_horizon])
+    
+    # 按抽样提前期与名义提前期之差延迟到货
+    def delayed(items, buckets, quantities, delays):
+        sample_ids = np.repeat(samples, len(items))
+        shifted = calendar.shift(np.tile(buckets, sample_count), -delays[:, items].ravel())
+        return records(sample_ids, np.tile(items, sample_count), shifted, np.tile(quantities, sample_count))
+    
+    def pack(rows, buckets):
+        return (rows << 32) | (buckets + 2 ** 31)
+    
+    # 2. 独立需求按物料的低层码分配到各层
+    level_count = int(model['llc'].max()) + 1 if item_count else 0
+    level_records = [[] for _ in range(level_count)]
+    
+    def add_gross(rows, buckets, quantities):
+        positive = quantities > 0
+        rows, buckets, quantities = rows[positive], buckets[positive], quantities[positive]
+        levels = model['llc'][rows % item_count]
+        for level in np.unique(levels).tolist():
+            in_level = levels == level
+            level_records[level].append((rows[in_level], buckets[in_level], quantities[in_level]))
+    
+    add_gross(*records(np.repeat(samples, len(model['demand_items'])), np.tile(model['demand_items'], sample_count),
+                       np.tile(model['demand_buckets'], sample_count),
+                       (demand_factors * model['demand_quantities']).ravel()))
+    
+    # 3. 采购订单按抽样的采购提前期延迟到货
+    purchase_delay = purchase_lead_time - model['purchase_lead_time']
+    receipt_rows, receipt_buckets, receipt_quantities = delayed(model['receipt_items'], model['receipt_buckets'],
+                                                                model['receipt_quantities'], purchase_delay)
+    receipt_keys = pack(receipt_rows, receipt_buckets)
+    flows = [(receipt_rows, receipt_buckets, receipt_quantities)]
+    
+    # 4. 逐层净算所有样本，每行只在有需求的时段上有事件，到货计入同一行当天或之后的第一个事件；
+    # 计划订单按抽样的生产提前期展开到子项
+    for level in range(level_count):
+        if not level_records[level]:
+            continue
+        rows, buckets, quantities = (np.concatenate(parts) for parts in zip(*level_records[level]))
+        flows.append((rows, buckets, -quantities))
+        
+        event_keys, entry_events = np.unique(pack(rows, buckets), return_inverse=True)
+        gross = np.bincount(entry_events, weights=quantities, minlength=len(event_keys))
+        level_rows, event_row_ids = np.unique(event_keys >> 32, return_inverse=True)
+        offsets = np.searchsorted(event_row_ids, np.arange(len(level_rows) + 1))
+        
+        receipt_row_ids = np.searchsorted(level_rows, receipt_rows)
+        in_level = receipt_row_ids < len(level_rows)
+        in_level[in_level] = level_rows[receipt_row_ids[in_level]] == receipt_rows[in_level]
+        receipt_events = np.searchsorted(event_keys, receipt_keys[in_level])
+        in_horizon = receipt_events < offsets[receipt_row_ids[in_level] + 1]
+        receipts = np.bincount(receipt_events[in_horizon], weights=receipt_quantities[in_level][in_horizon],
+                               minlength=len(event_keys))
+        
+        items = level_rows % item_count
+        planned, _ = net_events(offsets, gross, receipts, model['on_hand'][items], model['safety_stock'][items],
+                                model['lot_rules'][items] if model['has_lot_rules'][items].any() else None)
+        
+        ordered = np.flatnonzero(planned > 0)
+        order_rows = level_rows[event_row_ids[ordered]]
+        sample_ids, parents = order_rows // item_count, order_rows % item_count
+        release_buckets = calendar.shift(((event_keys[ordered] & 0xFFFFFFFF) - 2 ** 31),
+                                         production_lead_time[sample_ids, parents])
+        positions, sources = csr_positions(model['edge_offsets'], parents)
+        add_gross(*records(sample_ids[sources], model['edge_children'][positions], release_buckets[sources],
+                           planned[ordered][sources] * model['edge_quantities'][positions]))
+    
+    # 5. 基准计划订单按抽样提前期延迟到货，有子项的物料为生产提前期，其余为采购提前期
+    supply_delay = np.where(model['made'], production_lead_time - model['production_lead_time'], purchase_delay)
+    flows.append(delayed(model['supply_items'], model['supply_buckets'], model['supply_quantities'], supply_delay))
     
-    # 12. 转换结果为DataFrame并返回
-    return pd.DataFrame(mrp_results)
+    # 6. 按(行, 时段)排序净流量并累计，输出单元的投影库存为同一行截至该时段的累计净流量
+    rows, buckets, quantities = (np.concatenate(parts) for parts in zip(*flows))
+    flow_keys = pack(rows, buckets)
+    order = np.argsort(flow_keys, kind='stable')
+    flow_keys = flow_keys[order]
+    cumulative = np.concatenate([[0.0], np.cumsum(quantities[order])])
+    cell_rows = samples[:, None] * item_count + model['cell_items'][None, :]
+    ends = np.searchsorted(flow_keys, pack(cell_rows, model['cell_buckets'][None, :]), side='right')
+    starts = np.searchsorted(flow_keys, cell_rows << 32)
+    return model['on_hand'][model['cell_items']][None, :] + cumulative[ends] - cumulative[starts]
 
 # 批量约束处理函数
 def apply_lot_sizing(quantity, min_lot_size, lot_multiple):
@@ -1,18 +1,17 @@
 import streamlit as st
 import pandas as pd
 import numpy as np
-import io
 import base64
-import datetime
-import os
-from ortools.linear_solver import pywraplp
+from mrp_engine import (CompiledBOM, MaterialMaster, run_llc_mrp, net_level, make_calendar, input_digests,
+                        NetChangeSnapshot, ResultBuffer, iter_plan_chunks, run_scenario_mrp, compare_scenarios)
+from utils import load_csv_cached, validate_mrp_data
 
 # 设置页面配置
 st.set_page_config(page_title="物料需求计划(MRP)系统", page_icon="📊", layout="wide")
 
 # 应用标题
 st.title("物料需求计划(MRP)系统")
-st.markdown("基于Streamlit和OR-Tools的物料需求计划计算工具")
+st.markdown("基于Streamlit的物料需求计划计算工具，按低层码逐层展开BOM并净算物料需求")
 
 # 初始化会话状态
 if 'production_plan' not in st.session_state:
@@ -25,6 +24,8 @@ if 'purchase_orders' not in st.session_state:
     st.session_state.purchase_orders = None
 if 'mrp_results' not in st.session_state:
     st.session_state.mrp_results = None
+if 'mrp_snapshot' not in st.session_state:
+    st.session_state.mrp_snapshot = NetChangeSnapshot()
 
 # 侧边栏 - 数据上传区域
 with st.sidebar:
@@ -35,7 +36,7 @@ with st.sidebar:
     production_plan_file = st.file_uploader("选择生产计划CSV文件", type="csv", key="production_plan_uploader")
     if production_plan_file is not None:
         try:
-            production_plan = pd.read_csv(production_plan_file)
+            production_plan = load_csv_cached(production_plan_file, table='production_plan')
             st.session_state.production_plan = production_plan
             st.success(f"成功加载生产计划: {production_plan.shape[0]}行 x {production_plan.shape[1]}列")
         except Exception as e:
@@ -46,7 +47,7 @@ with st.sidebar:
     bom_file = st.file_uploader("选择BOM CSV文件", type="csv", key="bom_uploader")
     if bom_file is not None:
         try:
-            bom_data = pd.read_csv(bom_file)
+            bom_data = load_csv_cached(bom_file, table='bom')
             st.session_state.bom_data = bom_data
             st.success(f"成功加载BOM数据: {bom_data.shape[0]}行 x {bom_data.shape[1]}列")
         except Exception as e:
@@ -57,7 +58,7 @@ with st.sidebar:
     inventory_file = st.file_uploader("选择库存CSV文件", type="csv", key="inventory_uploader")
     if inventory_file is not None:
         try:
-            inventory_data = pd.read_csv(inventory_file)
+            inventory_data = load_csv_cached(inventory_file, table='inventory')
             st.session_state.inventory_data = inventory_data
             st.success(f"成功加载库存数据: {inventory_data.shape[0]}行 x {inventory_data.shape[1]}列")
         except Exception as e:
@@ -68,33 +69,48 @@ with st.sidebar:
     purchase_orders_file = st.file_uploader("选择采购订单CSV文件", type="csv", key="purchase_orders_uploader")
     if purchase_orders_file is not None:
         try:
-            purchase_orders = pd.read_csv(purchase_orders_file)
+            purchase_orders = load_csv_cached(purchase_orders_file, table='purchase_orders')
             st.session_state.purchase_orders = purchase_orders
             st.success(f"成功加载采购订单数据: {purchase_orders.shape[0]}行 x {purchase_orders.shape[1]}列")
         except Exception as e:
             st.error(f"加载采购订单数据时出错: {e}")
 
     # MRP计算函数
-    def calculate_mrp(production_plan, bom_data, inventory_data, purchase_orders=None):
+    def calculate_mrp(production_plan, bom_data, inventory_data, purchase_orders=None, compiled_bom=None,
+                      time_bucket='day', snapshot=None, chunksize=None, pegging=None):
         """
         计算物料需求计划(MRP)
         
         参数:
-        - production_plan: 生产计划DataFrame，包含产品、数量和需求日期
+        - production_plan: 生产计划DataFrame，包含产品、数量和需求日期；也可以是CSV文件路径或DataFrame块的
+          可迭代对象，此时按块流式读取并累加到物料 x 时段的需求中，不会一次载入整个生产计划
         - bom_data: BOM数据DataFrame，包含父项、子项和用量
         - inventory_data: 库存数据DataFrame，包含物料和库存量
         - purchase_orders: 采购订单DataFrame，包含物料、数量和预计到货日期
+        - compiled_bom: 预先编译的BOM索引CompiledBOM (可选)，未提供时从bom_data构建
+        - time_bucket: 计划时段模式 'day'、'week'、'month'，或自定义日历BucketCalendar
+        - snapshot: 上次计算的快照NetChangeSnapshot (可选)，提供时只重新净算输入变化的物料及其下层物料，
+          计算完成后更新快照；流式读取生产计划时不支持
+        - chunksize: 流式读取生产计划时每块的行数 (可选)
+        - pegging: 需求追溯索引PeggingIndex (可选)，提供时在逐层净算时填充，可从物料需求查到驱动它的生产计划行；
+          追溯关系需要全部重算，同时提供快照时不做净改变计算
         
         返回:
         - mrp_results: MRP计算结果DataFrame
         """
         # 1. 数据预处理和验证
+        # 生产计划不是DataFrame时流式读取，逐块验证必要的列
+        streaming = not isinstance(production_plan, pd.DataFrame)
+        if streaming and snapshot is not None:
+            raise ValueError("净改变计算需要完整的生产计划DataFrame，不支持流式读取")
+        
         # 确保所有必要的列都存在
         required_columns = {
-            'production_plan': ['产品编码', '需求数量', '需求日期'],
             'bom_data': ['父项编码', '子项编码', '用量'],
             'inventory_data': ['物料编码', '库存数量', '安全库存']
         }
+        if not streaming:
+            required_columns['production_plan'] = ['产品编码', '需求数量', '需求日期']
         
         for df_name, cols in required_columns.items():
             df = eval(df_name)
@@ -103,221 +119,161 @@ with st.sidebar:
                 raise ValueError(f"{df_name}缺少必要的列: {', '.join(missing_cols)}")
         
         # 转换日期列为datetime对象
-        production_plan['需求日期'] = pd.to_datetime(production_plan['需求日期'])
+        if not streaming:
+            production_plan['需求日期'] = pd.to_datetime(production_plan['需求日期'])
         if purchase_orders is not None and not purchase_orders.empty:
             purchase_orders['预计到货日期'] = pd.to_datetime(purchase_orders['预计到货日期'])
         
-        # 2. 构建物料清单树结构
-        def build_bom_tree(parent_item, bom_data, level=0, path=None):
-            if path is None:
-                path = []
-            
-            # 检查循环引用
-            if parent_item in path:
-                raise ValueError(f"检测到BOM循环引用: {' -> '.join(path + [parent_item])}")
-            
-            # 获取所有子项
-            children = bom_data[bom_data['父项编码'] == parent_item]
-            
-            result = {}
-            for _, row in children.iterrows():
-                child_item = row['子项编码']
-                quantity = row['用量']
-                
-                # 递归获取子项的子项
-                child_tree = build_bom_tree(child_item, bom_data, level+1, path + [parent_item])
-                
-                result[child_item] = {
-                    'quantity': quantity,
-                    'level': level + 1,
-                    'children': child_tree
-                }
-            
-            return result
+        # 2. 构建物料主数据，物料编码编码为物料ID，库存、安全库存和采购到货按物料ID存为数组
+        # 假设子项需要提前一周准备 (可以后续配置为物料相关的提前期)
+        default_lead_time = 7
+        calendar = make_calendar(time_bucket)
+        products = None if streaming else production_plan['产品编码'].unique()
+        if compiled_bom is None:
+            compiled_bom = CompiledBOM(bom_data, products)
+        master = MaterialMaster(compiled_bom, inventory_data, purchase_orders, calendar=calendar,
+                                default_lead_time=default_lead_time, items=products)
+        
+        # 创建按列存储的结果缓冲区
+        mrp_results = ResultBuffer({
+            '物料编码': object,
+            '需求周期': 'datetime64[ns]',
+            '总需求量': np.float64,
+            '期初库存': np.float64,
+            '安全库存': np.float64,
+            '采购到货': np.float64,
+            '净需求量': np.float64,
+            '期末库存': np.float64
+        })
+        all_planned_orders = {}
         
-        # 3. 计算总需求量
-        def get_all_requirements(item, quantity, date, bom_tree_node, level=0):
-            """ 递归计算一个物料及其所有子物料的总需求 """
-            # 添加当前物料的需求
-            requirements = [{'物料编码': item, '需求数量': quantity, '需求日期': date, '需求级别': level}]
+        # 3. 使用净算内核一次计算单层所有物料的净需求
+        def net_items(item_ids, gross_requirements):
+            level = net_level(item_ids, gross_requirements, master)
             
-            # 递归地为所有子物料计算需求
-            for child_item, child_info in bom_tree_node.items():
-                child_quantity = quantity * child_info['quantity']
-                child_level = level + 1
-                
-                # 假设子项需要提前一周准备 (可以后续配置为物料相关的提前期)
-                child_date = pd.to_datetime(date) - pd.Timedelta(days=7)
-                
-                # 递归调用，传入子物料的BOM节点
-                child_requirements = get_all_requirements(
-                    child_item, 
-                    child_quantity, 
-                    child_date, 
-                    child_info.get('children', {}), # 使用.get避免叶节点出错
-                    child_level
-                )
-                requirements.extend(child_requirements)
-                
-            return requirements
-
-        # 4. 构建所有产品的BOM树
-        all_products = production_plan['产品编码'].unique()
-        bom_trees = {}
-        for product in all_products:
-            bom_trees[product] = build_bom_tree(product, bom_data)
-
-        # 5. 计算总需求
-        all_requirements = []
-        for _, row in production_plan.iterrows():
-            product = row['产品编码']
-            quantity = row['需求数量']
-            date = row['需求日期']
+            # 只有当净需求大于0时才添加到结果中，整层一次写入结果缓冲区，物料编码在这里解码
+            events = np.flatnonzero(level['planned'] > 0)
+            rows = level['rows'][events]
+            row_items = level['item_ids'][rows]
+            buckets = level['buckets'][events]
+            net_requirements = level['planned'][events]
+            mrp_results.extend({
+                '物料编码': master.codes[row_items],
+                '需求周期': calendar.to_dates(buckets),
+                '总需求量': level['gross'][events],
+                '期初库存': level['opening'][events],
+                '安全库存': level['safety_stock'][rows],
+                '采购到货': level['receipts'][events],
+                '净需求量': net_requirements,
+                '期末库存': level['closing'][events]
+            })
             
-            # 获取该产品的BOM树
-            product_bom_tree = bom_trees.get(product, {})
+            planned_orders = {}
+            for item_id, bucket, net_req in zip(row_items.tolist(), buckets.tolist(), net_requirements.tolist()):
+                planned_orders.setdefault(item_id, {})[bucket] = net_req
             
-            # 计算产品及其所有子项的需求
-            product_requirements = get_all_requirements(product, quantity, date, product_bom_tree)
-            all_requirements.extend(product_requirements)
+            all_planned_orders.update(planned_orders)
+            return planned_orders
         
-        # 转换为DataFrame
-        gross_requirements_df = pd.DataFrame(all_requirements)
+        # 4. 按低层码逐层净算，只将计划订单展开到下一层
+        # 净改变计算：与快照比较输入，只重新净算受影响的物料
+        settings = (compiled_bom.fingerprint(), calendar.key(), default_lead_time)
+        digests = input_digests(production_plan, inventory_data, purchase_orders) if snapshot is not None else None
+        dirty_items = snapshot.dirty_items(settings, digests, master) if snapshot is not None and pegging is None else None
+        previous_orders = snapshot.planned_orders if snapshot is not None else None
+        if streaming:
+            production_plan = iter_plan_chunks(production_plan, chunksize)
+        run_llc_mrp(production_plan, master, net_items, calendar=calendar, dirty_items=dirty_items,
+                    previous_orders=previous_orders, pegging=pegging)
         
-        # 6. 按物料和日期汇总总需求
-        gross_requirements_summary = gross_requirements_df.groupby(['物料编码', '需求日期']).agg(
-            {'需求数量': 'sum'}
-        ).reset_index()
+        # 5. 转换结果为DataFrame并返回，净改变计算时合并快照中未受影响物料的结果
+        mrp_results = mrp_results.to_frame()
+        if snapshot is not None:
+            mrp_results = snapshot.update(settings, digests, all_planned_orders, mrp_results, master, dirty_items)
+        return mrp_results
+
+    # 多场景MRP计算函数
+    def calculate_scenario_mrp(scenarios, bom_data, inventory_data, purchase_orders=None, compiled_bom=None,
+                               time_bucket='day'):
+        """
+        一次计算多个需求场景的物料需求计划，例如基准、需求上浮20%、新品提前上市
         
-        # 7. 考虑库存和安全库存
-        # 创建物料-库存映射
-        inventory_map = dict(zip(inventory_data['物料编码'], inventory_data['库存数量']))
-        safety_stock_map = dict(zip(inventory_data['物料编码'], inventory_data['安全库存']))
+        参数:
+        - scenarios: 需求场景 {场景名称: 生产计划DataFrame}，各场景共用BOM、库存和采购订单
+        - bom_data: BOM数据DataFrame，包含父项、子项和用量
+        - inventory_data: 库存数据DataFrame，包含物料和库存量
+        - purchase_orders: 采购订单DataFrame，包含物料、数量和预计到货日期
+        - compiled_bom: 预先编译的BOM索引CompiledBOM (可选)，未提供时从bom_data构建
+        - time_bucket: 计划时段模式 'day'、'week'、'month'，或自定义日历BucketCalendar
         
-        # 添加采购订单数据
-        if purchase_orders is not None and not purchase_orders.empty:
-            # 确保采购订单有必要的列
-            required_po_cols = ['物料编码', '订单数量', '预计到货日期']
-            missing_po_cols = [col for col in required_po_cols if col not in purchase_orders.columns]
-            if not missing_po_cols:
-                # 按物料和日期汇总采购订单
-                po_summary = purchase_orders.groupby(['物料编码', '预计到货日期']).agg(
-                    {'订单数量': 'sum'}
-                ).reset_index()
-            else:
-                po_summary = pd.DataFrame(columns=['物料编码', '预计到货日期', '订单数量'])
-        else:
-            po_summary = pd.DataFrame(columns=['物料编码', '预计到货日期', '订单数量'])
+        返回:
+        - mrp_results: 各场景的MRP计算结果DataFrame，列与calculate_mrp相同并在最前面增加场景列
+        - comparison: 各场景并排对比的总需求量和净需求量DataFrame，见compare_scenarios
+        """
+        # 1. 数据预处理和验证
+        required_columns = {
+            'bom_data': ['父项编码', '子项编码', '用量'],
+            'inventory_data': ['物料编码', '库存数量', '安全库存']
+        }
         
-        # 8. 使用OR-Tools优化MRP计算
-        # 获取所有唯一的物料和日期
-        all_items = gross_requirements_summary['物料编码'].unique()
-        all_dates = sorted(gross_requirements_summary['需求日期'].unique())
+        for df_name, cols in required_columns.items():
+            df = eval(df_name)
+            missing_cols = [col for col in cols if col not in df.columns]
+            if missing_cols:
+                raise ValueError(f"{df_name}缺少必要的列: {', '.join(missing_cols)}")
         
-        # 创建结果列表
-        mrp_results = []
+        if purchase_orders is not None and not purchase_orders.empty:
+            purchase_orders = purchase_orders.assign(预计到货日期=pd.to_datetime(purchase_orders['预计到货日期']))
         
-        # 为每个物料计算MRP
-        for item in all_items:
-            # 获取物料的总需求
-            item_requirements = gross_requirements_summary[gross_requirements_summary['物料编码'] == item]
-            
-            # 获取物料的库存和安全库存
-            current_inventory = inventory_map.get(item, 0)
-            safety_stock = safety_stock_map.get(item, 0)
-            
-            # 获取物料的采购订单
-            item_pos = po_summary[po_summary['物料编码'] == item] if not po_summary.empty else pd.DataFrame()
-            
-            # 创建优化求解器
-            solver = pywraplp.Solver.CreateSolver('SCIP')
-            if not solver:
-                raise ValueError("无法创建求解器")
-            
-            # 创建变量：每个时间段的净需求量
-            net_requirements = {}
-            for date in all_dates:
-                net_requirements[date] = solver.NumVar(0, solver.infinity(), f'net_req_{item}_{date}')
-            
-            # 创建约束
-            # 1. 库存约束：每个时间段的期末库存必须大于等于安全库存
-            inventory_level = current_inventory
-            for i, date in enumerate(all_dates):
-                # 需求
-                demand_on_date = item_requirements[item_requirements['需求日期'] == date]['需求数量'].sum() if date in item_requirements['需求日期'].values else 0
-                # 采购到货
-                po_on_date = item_pos[item_pos['预计到货日期'] == date]['订单数量'].sum() if not item_pos.empty and date in item_pos['预计到货日期'].values else 0
-                
-                # 定义期末库存的表达式
-                # 期末库存 = 期初库存 + 采购到货 + 本期计划产出 - 本期需求
-                inventory_level += po_on_date + net_requirements[date] - demand_on_date
-                
-                # 添加约束：期末库存 >= 安全库存
-                solver.Add(inventory_level >= safety_stock)
-            
-            # 2. 目标函数：最小化总净需求量
-            objective = solver.Objective()
-            for date in all_dates:
-                objective.SetCoefficient(net_requirements[date], 1)
-            objective.SetMinimization()
-            
-            # 求解
-            status = solver.Solve()
-            
-            # 处理结果
-            if status == pywraplp.Solver.OPTIMAL:
-                # 重新计算每个时间段的投影库存和净需求
-                projected_inventory = current_inventory
-                for date in all_dates:
-                    # 当前日期的需求
-                    date_req = item_requirements[item_requirements['需求日期'] == date]['需求数量'].sum() if date in item_requirements['需求日期'].values else 0
-                    
-                    # 当前日期的采购到货
-                    date_po = item_pos[item_pos['预计到货日期'] == date]['订单数量'].sum() if not item_pos.empty and date in item_pos['预计到货日期'].values else 0
-                    
-                    # 计算净需求
-                    net_req = net_requirements[date].SolutionValue()
-                    
-                    # 只有当净需求大于0时才添加到结果中
-                    if net_req > 0:
-                        mrp_results.append({
-                            '物料编码': item,
-                            '需求周期': date,
-                            '总需求量': date_req,
-                            '期初库存': projected_inventory,
-                            '安全库存': safety_stock,
-                            '采购到货': date_po,
-                            '净需求量': net_req,
-                            '期末库存': projected_inventory + date_po + net_req - date_req
-                        })
-                    
-                    # 更新投影库存
-                    projected_inventory = projected_inventory + date_po + net_req - date_req
-            else:
-                raise ValueError(f"无法为物料 {item} 找到最优解")
+        # 2. 各场景共用BOM索引和物料主数据，提前期与calculate_mrp一致
+        default_lead_time = 7
+        calendar = make_calendar(time_bucket)
+        if compiled_bom is None:
+            compiled_bom = CompiledBOM(bom_data)
+        master = MaterialMaster(compiled_bom, inventory_data, purchase_orders, calendar=calendar,
+                                default_lead_time=default_lead_time)
         
-        # 9. 转换结果为DataFrame并返回
-        return pd.DataFrame(mrp_results)
+        # 3. 所有场景一次逐层净算，只保留净需求大于0的记录
+        scenario_results = run_scenario_mrp(scenarios, master, calendar=calendar)
+        comparison = compare_scenarios(scenario_results, list(scenarios))
+        mrp_results = scenario_results[scenario_results['净需求量'] > 0].reset_index(drop=True)
+        return mrp_results, comparison
 
     # 计算按钮
     st.subheader("5. 运行MRP计算")
+    time_bucket = st.selectbox("计划时段", ['day', 'week', 'month'],
+                               format_func={'day': '日', 'week': '周', 'month': '月'}.get, key="time_bucket_select")
+    net_change = st.checkbox("净改变计算(只重算输入变化的物料)", value=True, key="net_change_checkbox")
     if st.button("计算物料需求", key="calculate_mrp_button"):
         if (st.session_state.production_plan is not None and 
             st.session_state.bom_data is not None and 
             st.session_state.inventory_data is not None):
-            with st.spinner("正在计算物料需求..."):
-                try:
-                    # 调用MRP计算函数
-                    mrp_results = calculate_mrp(
-                        st.session_state.production_plan,
-                        st.session_state.bom_data,
-                        st.session_state.inventory_data,
-                        st.session_state.purchase_orders
-                    )
-                    st.session_state.mrp_results = mrp_results
-                    st.success("MRP计算完成!")
-                except Exception as e:
-                    st.error(f"MRP计算过程中出错: {e}")
+            # 一次验证所有上传的数据，报告全部问题
+            is_valid, validation_report = validate_mrp_data(
+                st.session_state.production_plan,
+                st.session_state.bom_data,
+                st.session_state.inventory_data,
+                st.session_state.purchase_orders
+            )
+            if not is_valid:
+                st.error(f"数据验证发现{len(validation_report)}个问题，请修正后重新上传")
+                st.dataframe(validation_report)
+            else:
+                with st.spinner("正在计算物料需求..."):
+                    try:
+                        # 调用MRP计算函数
+                        mrp_results = calculate_mrp(
+                            st.session_state.production_plan,
+                            st.session_state.bom_data,
+                            st.session_state.inventory_data,
+                            st.session_state.purchase_orders,
+                            time_bucket=time_bucket,
+                            snapshot=st.session_state.mrp_snapshot if net_change else None
+                        )
+                        st.session_state.mrp_results = mrp_results
+                        st.success("MRP计算完成!")
+                    except Exception as e:
+                        st.error(f"MRP计算过程中出错: {e}")
         else:
             st.warning("请先上传所有必要的数据文件(生产计划、BOM和库存)")
 
@@ -394,9 +350,10 @@ if __name__ == "__main__":
     st.sidebar.info("""
     ### 关于本应用
     
-    这是一个基于Streamlit和OR-Tools的物料需求计划(MRP)系统。
+    这是一个基于Streamlit的物料需求计划(MRP)系统，按低层码逐层展开多层级BOM并净算物料需求。
     
-    上传您的生产计划、BOM、库存和采购订单数据，系统将计算物料需求并提供可视化结果。
+    上传您的生产计划、BOM、库存和采购订单数据，选择计划时段后计算物料需求并查看可视化结果。
     
-    支持多层级BOM结构和优化计算。
+    - 计划时段: 按日、周或月汇总需求和到货，提前期按时段平移
+    - 净改变计算: 只重新净算输入变化的物料及其下层物料；计划时段或BOM改变时全部重算
     """)
\ No newline at end of file
@@ -0,0 +1,1627 @@
+import hashlib
+import os
+import pandas as pd
+import numpy as np
+
+class CompiledBOM:
+    """
+    编译后的BOM邻接索引
+
+    物料编码被整数编码为物料ID，父项到子项的边按CSR格式存储：
+    物料i的子项为children[offsets[i]:offsets[i+1]]，对应用量为quantities中的同一区间
+
+    属性:
+    - codes: 物料编码数组，下标即物料ID
+    - code_to_id: 字典 {物料编码: 物料ID}
+    - offsets: 每个物料的子项起始位置 (int64, 长度为物料数+1)
+    - children: 子项物料ID (int32)
+    - quantities: 子项用量 (float64)
+    """
+
+    def __init__(self, bom_data, items=None):
+        """
+        从BOM数据一次性构建邻接索引
+
+        参数:
+        - bom_data: BOM数据DataFrame
+        - items: 需要额外编码的物料编码 (可选)，例如没有BOM的产品
+        """
+        parents = bom_data['父项编码'].to_numpy(dtype=object)
+        children = bom_data['子项编码'].to_numpy(dtype=object)
+        extra_items = np.asarray([] if items is None else list(items), dtype=object)
+
+        # 一次factorize完成所有物料的整数编码
+        ids, codes = pd.factorize(np.concatenate([parents, children, extra_items]))
+        edge_count = len(parents)
+        parent_ids = ids[:edge_count]
+        child_ids = ids[edge_count:2 * edge_count]
+
+        # 按父项ID稳定排序得到CSR数组
+        order = np.argsort(parent_ids, kind='stable')
+        counts = np.bincount(parent_ids, minlength=len(codes))
+
+        self.codes = np.asarray(codes, dtype=object)
+        self.code_to_id = {code: item_id for item_id, code in enumerate(self.codes)}
+        self.offsets = np.zeros(len(codes) + 1, dtype=np.int64)
+        np.cumsum(counts, out=self.offsets[1:])
+        self.children = child_ids[order].astype(np.int32)
+        self.quantities = bom_data['用量'].to_numpy(dtype=np.float64)[order]
+        self._fingerprint = None
+        self._low_level_codes = None
+
+    @property
+    def item_count(self):
+        """物料数量"""
+        return len(self.codes)
+
+    @property
+    def edge_count(self):
+        """BOM边数量"""
+        return len(self.children)
+
+    def encode(self, items):
+        """
+        将物料编码转换为物料ID数组，未知物料返回-1
+        """
+        return np.fromiter((self.code_to_id.get(item, -1) for item in items), dtype=np.int32)
+
+    def children_of(self, item_id):
+        """
+        获取物料的子项ID和用量
+
+        返回:
+        - children: 子项物料ID数组
+        - quantities: 对应的用量数组
+        """
+        start, end = self.offsets[item_id], self.offsets[item_id + 1]
+        return self.children[start:end], self.quantities[start:end]
+
+    def edge_positions(self, item_ids):
+        """
+        获取一组物料所有出边在CSR数组中的位置
+
+        参数:
+        - item_ids: 物料ID数组
+
+        返回:
+        - positions: 边位置数组，可用于索引children和quantities
+        - sources: 每条边对应的物料在item_ids中的下标
+        """
+        return csr_positions(self.offsets, item_ids)
+
+    def descendants(self, item_ids):
+        """
+        获取一组物料及其所有下层物料的ID
+
+        参数:
+        - item_ids: 物料ID数组
+
+        返回:
+        - descendant_ids: 排序后的物料ID数组，包含item_ids本身
+        """
+        reached = np.zeros(self.item_count, dtype=bool)
+        frontier = np.unique(np.asarray(item_ids, dtype=np.int64))
+        while len(frontier):
+            reached[frontier] = True
+            positions, _ = self.edge_positions(frontier)
+            children = np.unique(self.children[positions])
+            frontier = children[~reached[children]]
+        return np.flatnonzero(reached)
+
+    def fingerprint(self):
+        """
+        计算BOM内容指纹，BOM结构或用量相同的索引得到相同的指纹
+        """
+        if self._fingerprint is None:
+            digest = hashlib.sha1()
+            digest.update('\x1f'.join(str(code) for code in self.codes).encode('utf-8'))
+            for array in (self.offsets, self.children, self.quantities):
+                digest.update(array.tobytes())
+            self._fingerprint = digest.hexdigest()
+        return self._fingerprint
+
+    def low_level_codes(self):
+        """
+        计算所有物料的低层码(LLC)，即物料在所有BOM中出现的最深层级
+
+        按层同步的拓扑排序：物料在第k轮入度降为0，说明从成品到它的最长路径为k。
+        结果在索引上缓存，BOM分析、展开和各MRP引擎共用同一份低层码
+
+        返回:
+        - llc: 只读的低层码数组 (int32)，下标为物料ID
+
+        抛出:
+        - ValueError: 如果检测到循环引用
+        """
+        if self._low_level_codes is not None:
+            return self._low_level_codes
+
+        in_degree = np.bincount(self.children, minlength=self.item_count)
+        llc = np.zeros(self.item_count, dtype=np.int32)
+        frontier = np.flatnonzero(in_degree == 0)
+        processed = 0
+        level = 0
+        while len(frontier):
+            llc[frontier] = level
+            processed += len(frontier)
+
+            positions, _ = self.edge_positions(frontier)
+            reached = self.children[positions]
+            np.subtract.at(in_degree, reached, 1)
+            reached = np.unique(reached)
+            frontier = reached[in_degree[reached] == 0]
+            level += 1
+
+        if processed < self.item_count:
+            cyclic_items = sorted(str(item) for item in self.codes[in_degree > 0])
+            raise ValueError(f"检测到BOM循环引用，涉及物料: {', '.join(cyclic_items)}")
+
+        llc.setflags(write=False)
+        self._low_level_codes = llc
+        return llc
+
+def csr_positions(offsets, item_ids):
+    """
+    获取一组物料在CSR数组中的全部位置及每个位置对应的物料下标
+    """
+    item_ids = np.asarray(item_ids, dtype=np.int64)
+    starts = offsets[item_ids]
+    lengths = offsets[item_ids + 1] - starts
+    total = int(lengths.sum())
+    sources = np.repeat(np.arange(len(item_ids)), lengths)
+    positions = np.arange(total) - np.repeat(np.cumsum(lengths) - lengths, lengths) + np.repeat(starts, lengths)
+    return positions, sources
+
+class BucketCalendar:
+    """
+    计划时段日历
+
+    日期在进入计算前一次性转换为int32时段编号，计算全程使用整数时段，输出时再转换回时段起始日期
+
+    支持的时段模式:
+    - day: 按日
+    - week: 按ISO周，周一为时段起始日期
+    - month: 按自然月
+    - custom: 自定义计划日历，由各时段起始日期定义，早于第一个时段的日期归入第一个时段
+    """
+
+    MODES = ('day', 'week', 'month', 'custom')
+
+    def __init__(self, mode='day', period_starts=None):
+        """
+        参数:
+        - mode: 时段模式
+        - period_starts: 自定义日历各时段的起始日期 (mode为custom时必填)
+        """
+        if mode not in self.MODES:
+            raise ValueError(f"不支持的时段模式: {mode}，可选: {', '.join(self.MODES)}")
+
+        self.mode = mode
+        self.period_starts = None
+        if mode == 'custom':
+            if period_starts is None or len(period_starts) == 0:
+                raise ValueError("自定义计划日历需要提供各时段的起始日期")
+            self.period_starts = np.unique(np.asarray(pd.to_datetime(period_starts), dtype='datetime64[D]'))
+
+    def to_buckets(self, dates):
+        """
+        将日期数组转换为时段编号数组 (int32)
+        """
+        days = np.asarray(pd.to_datetime(dates), dtype='datetime64[D]')
+        if self.mode == 'day':
+            buckets = days.astype(np.int64)
+        elif self.mode == 'week':
+            # 1970-01-01为周四，偏移3天使时段从周一开始
+            buckets = (days.astype(np.int64) + 3) // 7
+        elif self.mode == 'month':
+            buckets = days.astype('datetime64[M]').astype(np.int64)
+        else:
+            # 早于日历起点的日期归入第一个时段(拖期需求)
+            buckets = np.maximum(np.searchsorted(self.period_starts, days, side='right') - 1, 0)
+
+        return buckets.astype(np.int32)
+
+    def to_dates(self, buckets):
+        """
+        将时段编号数组转换为时段起始日期 (datetime64[ns]数组)
+        """
+        buckets = np.asarray(buckets, dtype=np.int64)
+        if self.mode == 'day':
+            days = buckets.astype('datetime64[D]')
+        elif self.mode == 'week':
+            days = (buckets * 7 - 3).astype('datetime64[D]')
+        elif self.mode == 'month':
+            days = buckets.astype('datetime64[M]').astype('datetime64[D]')
+        else:
+            days = self.period_starts[buckets]
+
+        return days.astype('datetime64[ns]')
+
+    def key(self):
+        """
+        日历的比较键，相同的键表示相同的时段划分
+        """
+        return self.mode, None if self.period_starts is None else self.period_starts.tobytes()
+
+    def shift(self, buckets, days):
+        """
+        将时段向前偏移指定天数，返回偏移后日期所在的时段编号；days可以是与buckets等长的数组
+        """
+        days = np.asarray(days, dtype=np.int64)
+        if self.mode == 'day':
+            return (np.asarray(buckets, dtype=np.int64) - days).astype(np.int32)
+        return self.to_buckets(self.to_dates(buckets) - days.astype('timedelta64[D]'))
+
+def make_calendar(time_bucket='day'):
+    """
+    根据时段模式名称或已有日历得到BucketCalendar
+    """
+    if isinstance(time_bucket, BucketCalendar):
+        return time_bucket
+    return BucketCalendar(time_bucket)
+
+def summarize_receipts(purchase_orders, calendar):
+    """
+    按物料和到货时段汇总采购订单
+
+    参数:
+    - purchase_orders: 采购订单DataFrame (可选)
+    - calendar: 计划时段日历BucketCalendar
+
+    返回:
+    - po_summary: DataFrame，包含物料编码、到货时段、订单数量；缺少必要列时为空
+    """
+    required_po_cols = ['物料编码', '订单数量', '预计到货日期']
+    if (purchase_orders is None or purchase_orders.empty
+            or any(col not in purchase_orders.columns for col in required_po_cols)):
+        return pd.DataFrame({'物料编码': pd.Series(dtype=object),
+                             '到货时段': pd.Series(dtype=np.int32),
+                             '订单数量': pd.Series(dtype=np.float64)})
+
+    receipts = pd.DataFrame({
+        '物料编码': purchase_orders['物料编码'].to_numpy(),
+        '到货时段': calendar.to_buckets(purchase_orders['预计到货日期']),
+        '订单数量': purchase_orders['订单数量'].to_numpy(dtype=np.float64)
+    })
+    return receipts.groupby(['物料编码', '到货时段'], sort=True)['订单数量'].sum().reset_index()
+
+class MaterialMaster:
+    """
+    物料主数据
+
+    加载数据时为每个物料编码分配int32物料ID，BOM中的物料沿用CompiledBOM的物料ID，其余物料依次追加；
+    库存、安全库存、提前期和批量规则按物料ID存为对齐的数组，采购到货按物料ID存为CSR数组。
+    计算过程只使用物料ID，输出结果时再用codes解码为物料编码
+
+    属性:
+    - compiled_bom: 编译后的BOM索引CompiledBOM
+    - codes: 物料编码数组，下标即物料ID
+    - on_hand: 库存数量 (float64)
+    - safety_stock: 安全库存 (float64)
+    - production_lead_time: 生产提前期(天) (int64)
+    - purchase_lead_time: 采购提前期(天) (int64)
+    - lot_rules: 批量规则矩阵 (物料数 x 4, float64)，列为最小批量、批量倍数、固定批量、订货周期数
+    - has_lot_rules: 是否配置了批量规则 (bool)
+    - receipt_offsets: 每个物料的到货记录起始位置 (int64, 长度为物料数+1)
+    - receipt_buckets: 到货时段 (int32)
+    - receipt_quantities: 到货数量 (float64)
+    """
+
+    def __init__(self, compiled_bom, inventory_data, purchase_orders=None, calendar=None, lead_times=None,
+                 lot_sizes=None, default_lead_time=0, items=None):
+        """
+        参数:
+        - compiled_bom: 编译后的BOM索引CompiledBOM
+        - inventory_data: 库存数据DataFrame，包含物料编码、库存数量、安全库存
+        - purchase_orders: 采购订单DataFrame (可选)
+        - calendar: 计划时段日历BucketCalendar (可选)，默认按日
+        - lead_times: 物料提前期DataFrame，包含物料编码、生产提前期、采购提前期 (可选)
+        - lot_sizes: 批量大小约束DataFrame，包含物料编码、最小批量、批量倍数，
+          可选固定批量(FOQ)和订货周期数(POQ) (可选)
+        - default_lead_time: 未配置提前期的物料使用的生产提前期(天)
+        - items: 需要额外编码的物料编码 (可选)，例如生产计划中的产品
+        """
+        if calendar is None:
+            calendar = BucketCalendar('day')
+        self.compiled_bom = compiled_bom
+        self.default_lead_time = int(default_lead_time)
+
+        # 1. 物料字典
+        tables = [inventory_data, purchase_orders, lead_times, lot_sizes]
+        code_parts = [compiled_bom.codes] + [table['物料编码'].to_numpy(dtype=object) for table in tables
+                                             if table is not None and '物料编码' in table.columns]
+        if items is not None:
+            code_parts.append(np.asarray(list(items), dtype=object))
+        self.codes = np.asarray(pd.unique(np.concatenate(code_parts)), dtype=object)
+        self._index = pd.Index(self.codes)
+        item_count = len(self.codes)
+
+        # 2. 库存和安全库存
+        self.on_hand = np.zeros(item_count)
+        self.safety_stock = np.zeros(item_count)
+        item_ids = self.encode(inventory_data['物料编码'])
+        self.on_hand[item_ids] = inventory_data['库存数量'].to_numpy(dtype=np.float64)
+        self.safety_stock[item_ids] = inventory_data['安全库存'].to_numpy(dtype=np.float64)
+
+        # 3. 提前期
+        self.production_lead_time = np.full(item_count, int(default_lead_time), dtype=np.int64)
+        self.purchase_lead_time = np.zeros(item_count, dtype=np.int64)
+        if lead_times is not None and not lead_times.empty:
+            item_ids = self.encode(lead_times['物料编码'])
+            self.production_lead_time[item_ids] = lead_times['生产提前期'].to_numpy(dtype=np.int64)
+            self.purchase_lead_time[item_ids] = lead_times['采购提前期'].to_numpy(dtype=np.int64)
+
+        # 4. 批量规则，默认无批量约束
+        self.lot_rules = np.tile(np.array([0, 1, 0, 1], dtype=np.float64), (item_count, 1))
+        self.has_lot_rules = np.zeros(item_count, dtype=bool)
+        if lot_sizes is not None and not lot_sizes.empty:
+            item_ids = self.encode(lot_sizes['物料编码'])
+            self.lot_rules[item_ids, 0] = lot_sizes['最小批量'].to_numpy(dtype=np.float64)
+            self.lot_rules[item_ids, 1] = lot_sizes['批量倍数'].to_numpy(dtype=np.float64)
+            if '固定批量' in lot_sizes.columns:
+                self.lot_rules[item_ids, 2] = lot_sizes['固定批量'].to_numpy(dtype=np.float64)
+            if '订货周期数' in lot_sizes.columns:
+                self.lot_rules[item_ids, 3] = lot_sizes['订货周期数'].to_numpy(dtype=np.float64)
+            self.has_lot_rules[item_ids] = True
+
+        # 5. 采购到货按物料ID排序存为CSR数组
+        po_summary = summarize_receipts(purchase_orders, calendar)
+        item_ids = self.encode(po_summary['物料编码'])
+        order = np.argsort(item_ids, kind='stable')
+        self.receipt_offsets = np.zeros(item_count + 1, dtype=np.int64)
+        np.cumsum(np.bincount(item_ids, minlength=item_count), out=self.receipt_offsets[1:])
+        self.receipt_buckets = po_summary['到货时段'].to_numpy(dtype=np.int32)[order]
+        self.receipt_quantities = po_summary['订单数量'].to_numpy(dtype=np.float64)[order]
+
+    @property
+    def item_count(self):
+        """物料数量"""
+        return len(self.codes)
+
+    def encode(self, items):
+        """
+        将物料编码转换为物料ID数组 (int32)，未知物料返回-1
+        """
+        return self._index.get_indexer(np.asarray(items, dtype=object)).astype(np.int32)
+
+    def add_items(self, items):
+        """
+        编码物料，物料字典中没有的物料追加到末尾，按没有库存、批量规则和采购到货的物料处理
+
+        参数:
+        - items: 物料编码数组
+
+        返回:
+        - item_ids: 物料ID数组 (int32)
+        """
+        item_ids = self.encode(items)
+        if (item_ids >= 0).all():
+            return item_ids
+
+        new_codes = np.asarray(pd.unique(np.asarray(items, dtype=object)[item_ids < 0]), dtype=object)
+        count = len(new_codes)
+        self.codes = np.concatenate([self.codes, new_codes])
+        self._index = pd.Index(self.codes)
+        self.on_hand = np.concatenate([self.on_hand, np.zeros(count)])
+        self.safety_stock = np.concatenate([self.safety_stock, np.zeros(count)])
+        self.production_lead_time = np.concatenate([self.production_lead_time,
+                                                    np.full(count, self.default_lead_time, dtype=np.int64)])
+        self.purchase_lead_time = np.concatenate([self.purchase_lead_time, np.zeros(count, dtype=np.int64)])
+        self.lot_rules = np.concatenate([self.lot_rules, np.tile(np.array([0, 1, 0, 1], dtype=np.float64), (count, 1))])
+        self.has_lot_rules = np.concatenate([self.has_lot_rules, np.zeros(count, dtype=bool)])
+        self.receipt_offsets = np.concatenate([self.receipt_offsets, np.full(count, self.receipt_offsets[-1])])
+        return self.encode(items)
+
+    def receipts_of(self, item_id):
+        """
+        获取物料的到货记录
+
+        返回:
+        - buckets: 到货时段数组，按时段排序
+        - quantities: 到货数量数组
+        """
+        start, end = self.receipt_offsets[item_id], self.receipt_offsets[item_id + 1]
+        return self.receipt_buckets[start:end], self.receipt_quantities[start:end]
+
+# 从CSV流式读取生产计划时每块的默认行数
+PLAN_CHUNK_SIZE = 100000
+
+def iter_plan_chunks(production_plan, chunksize=None):
+    """
+    将生产计划统一为DataFrame块的迭代器，用于流式计算
+
+    参数:
+    - production_plan: 生产计划DataFrame、CSV文件路径，或DataFrame块的可迭代对象
+      (例如pd.read_csv(..., chunksize=n)的返回值)
+    - chunksize: 每块的行数 (可选)，读取CSV时默认PLAN_CHUNK_SIZE，DataFrame默认整体作为一块
+
+    返回:
+    - chunks: 生产计划DataFrame块的生成器
+
+    抛出:
+    - ValueError: 生产计划块缺少必要的列
+    """
+    if isinstance(production_plan, pd.DataFrame):
+        step = chunksize or max(len(production_plan), 1)
+        chunks = (production_plan.iloc[start:start + step] for start in range(0, len(production_plan), step))
+    elif isinstance(production_plan, (str, os.PathLike)):
+        chunks = pd.read_csv(production_plan, chunksize=chunksize or PLAN_CHUNK_SIZE)
+    else:
+        chunks = production_plan
+
+    required_columns = ['产品编码', '需求数量', '需求日期']
+    for chunk in chunks:
+        missing_cols = [col for col in required_columns if col not in chunk.columns]
+        if missing_cols:
+            raise ValueError(f"生产计划缺少必要的列: {', '.join(missing_cols)}")
+        yield chunk
+
+class DemandAccumulator:
+    """
+    物料 x 时段的需求累加器
+
+    每块数据先在块内合并，再并入累加器，内存只与不同的(物料ID, 时段)数量有关，与展开的需求行数无关；
+    (物料ID, 时段)打包为一个int64键，高32位为物料ID，低32位为时段
+
+    属性:
+    - keys: 排序后的打包键 (int64)
+    - quantities: 对应的累计需求数量 (float64)
+    """
+
+    def __init__(self):
+        self.keys = np.zeros(0, dtype=np.int64)
+        self.quantities = np.zeros(0)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, item_ids, buckets, quantities):
+        """
+        将一批需求累加到对应的物料和时段
+
+        参数:
+        - item_ids: 物料ID数组
+        - buckets: 时段编号数组
+        - quantities: 需求数量数组
+        """
+        keys = (np.asarray(item_ids, dtype=np.int64) << 32) | (np.asarray(buckets, dtype=np.int64) & 0xFFFFFFFF)
+        keys, inverse = np.unique(np.concatenate([self.keys, keys]), return_inverse=True)
+        weights = np.concatenate([self.quantities, np.asarray(quantities, dtype=np.float64)])
+        self.quantities = np.bincount(inverse, weights=weights, minlength=len(keys))
+        self.keys = keys
+
+    def items(self):
+        """
+        返回:
+        - item_ids: 物料ID数组 (int32)，按物料ID和时段排序
+        - buckets: 时段编号数组 (int32)
+        - quantities: 累计需求数量数组 (float64)
+        """
+        return ((self.keys >> 32).astype(np.int32), (self.keys & 0xFFFFFFFF).astype(np.uint32).astype(np.int32),
+                self.quantities)
+
+    def to_dict(self):
+        """
+        返回:
+        - requirements: 字典 {物料ID: {时段: 累计需求数量}}
+        """
+        requirements = {}
+        item_ids, buckets, quantities = self.items()
+        for item_id, bucket, quantity in zip(item_ids.tolist(), buckets.tolist(), quantities.tolist()):
+            requirements.setdefault(item_id, {})[bucket] = quantity
+        return requirements
+
+class ExplosionCache:
+    """
+    物料单位展开向量缓存
+
+    每个物料的展开向量包含其自身及所有下层物料：(物料ID, 累计单位用量, 累计提前期偏移天数)，
+    共用组件的子树只展开一次，任意需求的展开都是对向量的缩放
+    """
+
+    def __init__(self, compiled_bom, lead_times):
+        """
+        参数:
+        - compiled_bom: 编译后的BOM索引CompiledBOM
+        - lead_times: 每个物料的提前期数组(天)，下标为物料ID
+        """
+        # 先做一次拓扑检查，保证展开不会陷入循环
+        compiled_bom.low_level_codes()
+
+        self.compiled_bom = compiled_bom
+        self.lead_times = np.asarray(lead_times, dtype=np.int64)
+        self._vectors = {}
+
+    def vector(self, item_id):
+        """
+        获取物料的单位展开向量
+
+        返回:
+        - component_ids: 物料ID数组 (int32)
+        - quantities: 每单位该物料对应的累计用量 (float64)
+        - offsets: 相对该物料需求日期的累计提前期偏移天数 (int64)
+        """
+        stack = [int(item_id)]
+        while stack:
+            node = stack[-1]
+            if node in self._vectors:
+                stack.pop()
+                continue
+
+            # 子项向量未计算时先计算子项
+            child_ids, child_quantities = self.compiled_bom.children_of(node)
+            pending = [int(child) for child in child_ids if int(child) not in self._vectors]
+            if pending:
+                stack.extend(pending)
+                continue
+
+            stack.pop()
+            component_parts = [np.array([node], dtype=np.int32)]
+            quantity_parts = [np.ones(1)]
+            offset_parts = [np.zeros(1, dtype=np.int64)]
+            for child, quantity in zip(child_ids, child_quantities):
+                child_components, child_vector_quantities, child_offsets = self._vectors[int(child)]
+                component_parts.append(child_components)
+                quantity_parts.append(child_vector_quantities * quantity)
+                offset_parts.append(child_offsets + self.lead_times[node])
+
+            self._vectors[node] = _merge_explosion_vector(
+                np.concatenate(component_parts),
+                np.concatenate(quantity_parts),
+                np.concatenate(offset_parts)
+            )
+
+        return self._vectors[int(item_id)]
+
+    def explode(self, item_ids, quantities):
+        """
+        批量展开需求
+
+        参数:
+        - item_ids: 需求物料ID数组
+        - quantities: 需求数量数组
+
+        返回:
+        - source_rows: 每条展开结果对应的需求下标
+        - component_ids: 展开得到的物料ID
+        - component_quantities: 展开得到的需求数量
+        - offsets: 相对需求日期提前的天数
+        """
+        item_ids = np.asarray(item_ids, dtype=np.int64)
+        quantities = np.asarray(quantities, dtype=np.float64)
+
+        source_parts, component_parts, quantity_parts, offset_parts = [], [], [], []
+        for item_id in np.unique(item_ids):
+            rows = np.flatnonzero(item_ids == item_id)
+            vector_components, vector_quantities, vector_offsets = self.vector(item_id)
+            source_parts.append(np.repeat(rows, len(vector_components)))
+            component_parts.append(np.tile(vector_components, len(rows)))
+            quantity_parts.append(np.outer(quantities[rows], vector_quantities).ravel())
+            offset_parts.append(np.tile(vector_offsets, len(rows)))
+
+        if not source_parts:
+            return (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int32),
+                    np.zeros(0), np.zeros(0, dtype=np.int64))
+
+        return (np.concatenate(source_parts), np.concatenate(component_parts),
+                np.concatenate(quantity_parts), np.concatenate(offset_parts))
+
+    def cumulative_lead_times(self, item_ids, purchase_lead_times):
+        """
+        计算物料的累计提前期(天)，即从下达最早的采购订单到完成该物料所需的最长时间
+
+        展开向量中每个组件的累计提前期偏移加上组件自身的提前期，取最大值；有子项的组件按生产提前期，
+        没有子项的组件按采购提前期
+
+        参数:
+        - item_ids: 物料ID数组
+        - purchase_lead_times: 每个物料的采购提前期数组(天)，下标为物料ID
+
+        返回:
+        - cumulative_lead_times: 各物料的累计提前期数组(天) (int64)
+        """
+        purchase_lead_times = np.asarray(purchase_lead_times, dtype=np.int64)
+        bom_offsets = self.compiled_bom.offsets
+        cumulative_lead_times = np.zeros(len(item_ids), dtype=np.int64)
+        for index, item_id in enumerate(np.asarray(item_ids, dtype=np.int64).tolist()):
+            component_ids, _, offsets = self.vector(item_id)
+            made = bom_offsets[component_ids + 1] > bom_offsets[component_ids]
+            own_lead_times = np.where(made, self.lead_times[component_ids], purchase_lead_times[component_ids])
+            cumulative_lead_times[index] = (offsets + own_lead_times).max()
+        return cumulative_lead_times
+
+def _merge_explosion_vector(component_ids, quantities, offsets):
+    """
+    合并展开向量中物料和偏移相同的项
+    """
+    keys = (component_ids.astype(np.int64) << 32) | offsets
+    unique_keys, inverse = np.unique(keys, return_inverse=True)
+    merged_quantities = np.bincount(inverse, weights=quantities, minlength=len(unique_keys))
+    return ((unique_keys >> 32).astype(np.int32), merged_quantities, unique_keys & 0xFFFFFFFF)
+
+# 展开向量缓存，键为(BOM指纹, 提前期指纹)，只有BOM或提前期变化时才重新展开
+_EXPLOSION_CACHES = {}
+_MAX_EXPLOSION_CACHES = 8
+
+def get_explosion_cache(compiled_bom, lead_time_map=None, default_lead_time=0, lead_times=None):
+    """
+    获取BOM和提前期对应的展开向量缓存
+
+    参数:
+    - compiled_bom: 编译后的BOM索引CompiledBOM
+    - lead_time_map: 物料提前期映射(天) (可选)
+    - default_lead_time: 未在lead_time_map中配置的物料使用的提前期(天)
+    - lead_times: 按BOM物料ID对齐的提前期数组(天) (可选)，例如MaterialMaster的生产提前期，
+      提供时忽略lead_time_map和default_lead_time
+
+    返回:
+    - cache: ExplosionCache
+    """
+    if lead_times is not None:
+        lead_times = np.asarray(lead_times, dtype=np.int64)[:compiled_bom.item_count]
+    else:
+        lead_times = np.full(compiled_bom.item_count, int(default_lead_time), dtype=np.int64)
+        if lead_time_map:
+            for item, lead_time in lead_time_map.items():
+                item_id = compiled_bom.code_to_id.get(item)
+                if item_id is not None:
+                    lead_times[item_id] = int(lead_time)
+
+    key = (compiled_bom.fingerprint(), hashlib.sha1(lead_times.tobytes()).hexdigest())
+    cache = _EXPLOSION_CACHES.get(key)
+    if cache is None:
+        if len(_EXPLOSION_CACHES) >= _MAX_EXPLOSION_CACHES:
+            _EXPLOSION_CACHES.pop(next(iter(_EXPLOSION_CACHES)))
+        cache = ExplosionCache(compiled_bom, lead_times)
+        _EXPLOSION_CACHES[key] = cache
+
+    return cache
+
+def calculate_gross_requirements(production_plan, compiled_bom, lead_time_map=None, default_lead_time=0,
+                                 calendar=None, chunksize=None):
+    """
+    通过展开向量缓存计算所有物料的总需求(不做库存净算)
+
+    生产计划逐块展开并累加到物料 x 时段的累加器中，不会一次生成全部展开行
+
+    参数:
+    - production_plan: 生产计划DataFrame、CSV文件路径或DataFrame块的可迭代对象，见iter_plan_chunks
+    - compiled_bom: 编译后的BOM索引CompiledBOM
+    - lead_time_map: 物料提前期映射(天) (可选)
+    - default_lead_time: 未在lead_time_map中配置的物料使用的提前期(天)
+    - calendar: 计划时段日历BucketCalendar (可选)，默认按日，需求日期汇总到所在时段的起始日期
+    - chunksize: 流式读取时每块的行数 (可选)
+
+    返回:
+    - gross_requirements: 总需求DataFrame，包含物料编码、需求日期、需求数量
+
+    抛出:
+    - ValueError: 生产计划中的产品未包含在BOM索引中
+    """
+    cache = get_explosion_cache(compiled_bom, lead_time_map, default_lead_time)
+    if calendar is None:
+        calendar = BucketCalendar('day')
+
+    accumulator = DemandAccumulator()
+    for chunk in iter_plan_chunks(production_plan, chunksize):
+        item_ids = compiled_bom.encode(chunk['产品编码'])
+        if (item_ids < 0).any():
+            unknown = chunk['产品编码'][item_ids < 0].unique()
+            raise ValueError(f"以下产品未包含在BOM索引中: {', '.join(map(str, unknown))}")
+
+        # 展开结果只在块内存在，立即按物料和时段并入累加器
+        source_rows, component_ids, quantities, offsets = cache.explode(item_ids, chunk['需求数量'].to_numpy())
+        demand_dates = np.asarray(pd.to_datetime(chunk['需求日期']), dtype='datetime64[D]')
+        accumulator.add(component_ids, calendar.to_buckets(demand_dates[source_rows] - offsets.astype('timedelta64[D]')),
+                        quantities)
+
+    item_ids, buckets, quantities = accumulator.items()
+    return pd.DataFrame({
+        '物料编码': compiled_bom.codes[item_ids],
+        '需求日期': calendar.to_dates(buckets),
+        '需求数量': quantities
+    }).sort_values(['物料编码', '需求日期'], ignore_index=True)
+
+class PeggingIndex:
+    """
+    需求追溯(pegging)索引
+
+    由run_llc_mrp在逐层净算时填充：独立需求按生产计划行记录，每层物料的计划订单按该物料所满足时段的
+    总需求中各生产计划行的占比分摊，再随计划订单按用量和提前期展开到子项。因此追溯到的数量与净算后
+    各物料各时段的总需求一致，库存和到货抵减掉的部分不会继续向下追溯。
+    按(物料ID, 需求时段, 生产计划行号)合并后以数组形式保存，既可以从物料和时段查到驱动它的生产计划行，
+    也可以从生产计划行查到它产生的所有物料需求，查询时不需要重新计算
+
+    属性:
+    - item_ids: 物料ID数组 (int32)，按(物料ID, 需求时段, 生产计划行号)排序
+    - buckets: 需求时段数组 (int32)
+    - rows: 生产计划行号数组 (int64)，即生产计划中的位置下标，流式读取时为所有块中的序号
+    - quantities: 该行生产计划带来的需求数量 (float64)
+    - fractions: 该行生产计划在物料该时段总需求中的占比 (float64)
+    """
+
+    def __init__(self):
+        self.codes = np.zeros(0, dtype=object)
+        self.calendar = BucketCalendar('day')
+        self.item_ids = np.zeros(0, dtype=np.int32)
+        self.buckets = np.zeros(0, dtype=np.int32)
+        self.rows = np.zeros(0, dtype=np.int64)
+        self.quantities = np.zeros(0)
+        self.fractions = np.zeros(0)
+        self._code_to_id = {}
+        self._keys = np.zeros(0, dtype=np.int64)
+        self._row_order = np.zeros(0, dtype=np.int64)
+        self._row_offsets = np.zeros(1, dtype=np.int64)
+
+    def build(self, item_ids, buckets, rows, quantities, row_count, codes, calendar):
+        """
+        由追溯记录构建索引，同一(物料ID, 需求时段, 生产计划行号)的记录合并
+
+        参数:
+        - item_ids、buckets、rows、quantities: 追溯记录数组
+        - row_count: 生产计划行数
+        - codes: 物料编码数组，下标即物料ID，见MaterialMaster.codes
+        - calendar: 计划时段日历BucketCalendar
+        """
+        self.codes = codes
+        self.calendar = calendar
+        self._code_to_id = {code: item_id for item_id, code in enumerate(codes)}
+
+        # 1. 按(物料ID, 需求时段, 生产计划行号)合并
+        item_ids, buckets, rows, quantities = _merge_pegs(item_ids, buckets, rows, quantities)
+        self.item_ids = item_ids.astype(np.int32)
+        self.buckets = buckets.astype(np.int32)
+        self.rows = rows
+        self.quantities = quantities
+
+        # 2. 每个(物料, 时段)分组的占比
+        self._keys = self._pack(self.item_ids, self.buckets)
+        self.fractions = quantities / _group_totals(self._keys, quantities)
+
+        # 3. 按生产计划行号的反向索引 (CSR)
+        self._row_order = np.argsort(self.rows, kind='stable')
+        self._row_offsets = np.zeros(row_count + 1, dtype=np.int64)
+        np.cumsum(np.bincount(self.rows, minlength=row_count), out=self._row_offsets[1:])
+
+    @staticmethod
+    def _pack(item_ids, buckets):
+        return (np.asarray(item_ids, dtype=np.int64) << 32) + np.asarray(buckets, dtype=np.int64)
+
+    def demand_rows(self, item, date):
+        """
+        查询驱动物料在某时段总需求的生产计划行
+
+        参数:
+        - item: 物料编码
+        - date: 日期，按日历归入所在时段
+
+        返回:
+        - pegging: DataFrame，包含生产计划行、需求数量和占比，占比可用于按比例分摊短缺
+        """
+        item_id = self._code_to_id.get(item, -1)
+        bucket = self.calendar.to_buckets([date])[0]
+        key = self._pack(item_id, bucket)
+        start, end = np.searchsorted(self._keys, [key, key + 1])
+        return pd.DataFrame({
+            '生产计划行': self.rows[start:end],
+            '需求数量': self.quantities[start:end],
+            '占比': self.fractions[start:end]
+        })
+
+    def requirements_of(self, row):
+        """
+        查询一行生产计划产生的所有物料需求
+
+        参数:
+        - row: 生产计划行号，即生产计划中的位置下标
+
+        返回:
+        - requirements: DataFrame，包含物料编码、需求日期、需求数量和占比
+        """
+        positions = self._row_order[self._row_offsets[row]:self._row_offsets[row + 1]]
+        return pd.DataFrame({
+            '物料编码': self.codes[self.item_ids[positions]],
+            '需求日期': self.calendar.to_dates(self.buckets[positions]),
+            '需求数量': self.quantities[positions],
+            '占比': self.fractions[positions]
+        })
+
+def _merge_pegs(item_ids, buckets, rows, quantities):
+    """
+    合并(物料ID, 需求时段, 生产计划行号)相同的追溯记录，结果按这三列排序
+    """
+    item_ids = np.asarray(item_ids, dtype=np.int64)
+    buckets = np.asarray(buckets, dtype=np.int64)
+    rows = np.asarray(rows, dtype=np.int64)
+    quantities = np.asarray(quantities, dtype=np.float64)
+    order = np.lexsort((rows, buckets, item_ids))
+    item_ids, buckets, rows, quantities = item_ids[order], buckets[order], rows[order], quantities[order]
+    if len(order):
+        starts = np.flatnonzero(np.concatenate([[True], (np.diff(item_ids) != 0) | (np.diff(buckets) != 0)
+                                                | (np.diff(rows) != 0)]))
+        quantities = np.add.reduceat(quantities, starts)
+        item_ids, buckets, rows = item_ids[starts], buckets[starts], rows[starts]
+    return item_ids, buckets, rows, quantities
+
+def _group_totals(keys, quantities):
+    """
+    计算已排序的键中每组的合计，按记录返回所在组的合计
+    """
+    if not len(keys):
+        return np.zeros(0)
+    starts = np.flatnonzero(np.concatenate([[True], np.diff(keys) != 0]))
+    totals = np.add.reduceat(quantities, starts)
+    return np.repeat(totals, np.diff(np.append(starts, len(keys))))
+
+def build_item_axis(item_requirements, receipt_buckets=None, receipt_quantities=None):
+    """
+    构建物料自身的稀疏时间轴
+
+    时间轴只包含该物料的需求时段和在最后一个需求时段之前(含)的到货时段，
+    期末库存在这些事件之间顺序滚动计算；晚于最后一个需求时段的到货不影响计划
+
+    参数:
+    - item_requirements: 物料总需求 {需求时段: 总需求量}
+    - receipt_buckets: 该物料的到货时段数组 (可选)，见MaterialMaster.receipts_of
+    - receipt_quantities: 对应的到货数量数组 (可选)
+
+    返回:
+    - axis: 字典，包含buckets(事件时段数组)、demand(需求量数组)、receipts(到货量数组)、
+      is_demand(是否为需求时段的布尔数组)
+    """
+    demand_buckets = np.array(sorted(item_requirements), dtype=np.int32)
+    if receipt_buckets is None or not len(demand_buckets):
+        receipt_buckets = np.zeros(0, dtype=np.int32)
+        receipt_quantities = np.zeros(0)
+    else:
+        receipt_buckets = np.asarray(receipt_buckets, dtype=np.int32)
+        receipt_quantities = np.asarray(receipt_quantities, dtype=np.float64)
+        in_horizon = receipt_buckets <= demand_buckets[-1]
+        receipt_buckets, receipt_quantities = receipt_buckets[in_horizon], receipt_quantities[in_horizon]
+
+    buckets = np.union1d(demand_buckets, receipt_buckets).astype(np.int32)
+    receipt_totals = np.zeros(len(buckets))
+    np.add.at(receipt_totals, np.searchsorted(buckets, receipt_buckets), receipt_quantities)
+
+    return {
+        'buckets': buckets,
+        'demand': np.array([item_requirements.get(bucket, 0) for bucket in buckets.tolist()], dtype=np.float64),
+        'receipts': receipt_totals,
+        'is_demand': np.isin(buckets, demand_buckets)
+    }
+
+def netting_kernel(gross, receipts, on_hand, safety_stock, active=None):
+    """
+    净需求计算内核，一次计算所有物料的计划订单
+
+    不考虑批量时，最小化总净需求且每期期末库存不低于安全库存的问题有闭式解：
+    累计计划订单量 = 累计缺口的前缀最大值(不小于0)，计划订单为其逐期差分
+
+    参数:
+    - gross: 总需求矩阵 (物料 × 时段)
+    - receipts: 采购到货矩阵 (物料 × 时段)
+    - on_hand: 期初库存数组 (物料,)
+    - safety_stock: 安全库存数组 (物料,)
+    - active: 需要满足安全库存约束的时段掩码 (物料 × 时段)，默认所有时段
+
+    返回:
+    - planned: 计划订单矩阵 (物料 × 时段)
+    - closing: 期末投影库存矩阵 (物料 × 时段)
+    """
+    gross = np.asarray(gross, dtype=np.float64)
+    receipts = np.asarray(receipts, dtype=np.float64)
+    on_hand = np.asarray(on_hand, dtype=np.float64)
+    safety_stock = np.asarray(safety_stock, dtype=np.float64)
+
+    # 不补货时的期末库存及相对安全库存的累计缺口
+    uncovered = on_hand[:, None] + np.cumsum(receipts - gross, axis=1)
+    shortage = safety_stock[:, None] - uncovered
+    if active is not None:
+        shortage = np.where(active, shortage, -np.inf)
+
+    cumulative_planned = np.maximum(np.maximum.accumulate(shortage, axis=1), 0)
+    planned = np.diff(cumulative_planned, axis=1, prepend=0)
+    closing = uncovered + cumulative_planned
+    return planned, closing
+
+def lot_sizing_kernel(gross, receipts, on_hand, safety_stock, active=None, min_lot_size=None,
+                      lot_multiple=None, fixed_lot_size=None, order_periods=None):
+    """
+    带批量规则的净需求计算内核，一次计算所有物料的计划订单
+
+    按时段顺序推进，每个时段对所有物料同时计算缺口并套用批量规则，
+    批量带来的多余数量计入投影库存，抵减后续时段的净需求。批量规则按以下顺序生效:
+    - 周期订货量(POQ): order_periods > 1时，一次订货覆盖从当前时段起order_periods个时段的净需求
+    - 固定批量(FOQ): fixed_lot_size > 0时，订货量向上取整为固定批量的整数倍
+    - 最小批量: 订货量不低于min_lot_size
+    - 批量倍数: lot_multiple > 1时，订货量向上取整为批量倍数的整数倍
+    未配置任何规则的物料即为按需订货(L4L)，结果与netting_kernel相同
+
+    参数:
+    - gross: 总需求矩阵 (物料 × 时段)
+    - receipts: 采购到货矩阵 (物料 × 时段)
+    - on_hand: 期初库存数组 (物料,)
+    - safety_stock: 安全库存数组 (物料,)
+    - active: 需要满足安全库存约束的时段掩码 (物料 × 时段)，默认所有时段
+    - min_lot_size: 最小批量数组 (物料,) (可选)
+    - lot_multiple: 批量倍数数组 (物料,) (可选)
+    - fixed_lot_size: 固定批量数组 (物料,) (可选)
+    - order_periods: 周期订货的时段数数组 (物料,) (可选)
+
+    返回:
+    - planned: 计划订单矩阵 (物料 × 时段)
+    - closing: 期末投影库存矩阵 (物料 × 时段)
+    """
+    gross = np.asarray(gross, dtype=np.float64)
+    receipts = np.asarray(receipts, dtype=np.float64)
+    item_count, period_count = gross.shape
+    inventory = np.array(on_hand, dtype=np.float64)
+    safety_stock = np.asarray(safety_stock, dtype=np.float64)
+    if active is None:
+        active = np.ones(gross.shape, dtype=bool)
+
+    def rule_array(values, default):
+        if values is None:
+            return np.full(item_count, default, dtype=np.float64)
+        return np.asarray(values, dtype=np.float64)
+
+    min_lot_size = rule_array(min_lot_size, 0)
+    lot_multiple = rule_array(lot_multiple, 1)
+    fixed_lot_size = rule_array(fixed_lot_size, 0)
+    order_periods = rule_array(order_periods, 1).astype(np.int64)
+
+    net_flow = receipts - gross
+    cumulative_flow = np.cumsum(net_flow, axis=1)
+
+    # 周期订货：预先计算每个时段起order_periods个时段内累计净流量的最小值
+    use_periods = order_periods > 1
+    if use_periods.any():
+        masked_flow = np.where(active, cumulative_flow, np.inf)
+        window_min = masked_flow.copy()
+        for shift in range(1, int(order_periods.max())):
+            shifted = np.full_like(masked_flow, np.inf)
+            shifted[:, :-shift] = masked_flow[:, shift:]
+            in_window = (shift < order_periods)[:, None]
+            window_min = np.where(in_window, np.minimum(window_min, shifted), window_min)
+
+    planned = np.zeros_like(gross)
+    closing = np.zeros_like(gross)
+    previous_flow = np.zeros(item_count)
+    for period in range(period_count):
+        available = inventory + net_flow[:, period]
+        need = np.where(active[:, period], np.maximum(safety_stock - available, 0), 0)
+        ordering = need > 0
+        quantity = need
+
+        if use_periods.any():
+            window_need = safety_stock - inventory + previous_flow - window_min[:, period]
+            quantity = np.where(use_periods, np.maximum(quantity, window_need), quantity)
+
+        quantity = np.where(fixed_lot_size > 0,
+                            np.ceil(quantity / np.where(fixed_lot_size > 0, fixed_lot_size, 1) - 1e-9) * fixed_lot_size,
+                            quantity)
+        quantity = np.maximum(quantity, min_lot_size)
+        quantity = np.where(lot_multiple > 1,
+                            np.ceil(quantity / np.maximum(lot_multiple, 1) - 1e-9) * lot_multiple,
+                            quantity)
+        quantity = np.where(ordering, quantity, 0)
+
+        planned[:, period] = quantity
+        inventory = available + quantity
+        closing[:, period] = inventory
+        previous_flow = cumulative_flow[:, period]
+
+    return planned, closing
+
+def net_level(item_ids, gross_requirements, master, on_hand=None, first_bucket=None, lot_sizing=True,
+              receipt_bucket_map=None):
+    """
+    将一层物料的总需求整理为按物料分段的事件轴并调用净算内核
+
+    每个物料只在自身的需求时段上有事件，事件按物料连续存放(CSR)，offsets[i]:offsets[i + 1]为第i个物料的事件；
+    采购到货计入该物料自身当天或之后的第一个需求时段，最后一个需求时段之后的到货不影响计划
+
+    参数:
+    - item_ids: 物料ID列表
+    - gross_requirements: 总需求 {物料ID: {需求时段: 总需求量}}
+    - master: 物料主数据MaterialMaster，有批量规则时使用lot_sizing_kernel
+    - on_hand: 各物料的期初库存数组 (可选)，默认使用物料主数据中的库存，例如滚动计划中前一区段的期末库存
+    - first_bucket: 只计入该时段及之后的采购到货 (可选)，更早的到货已计入on_hand
+    - lot_sizing: 是否套用批量规则，为False时总是使用闭式解netting_kernel
+    - receipt_bucket_map: 到货时段的映射函数 (可选)，例如滚动计划尾段将到货时段映射到所在粗时段的起始时段
+
+    返回:
+    - level: 字典，包含item_ids、offsets(每个物料的事件起止位置)、rows(事件所属物料的下标)、buckets(事件时段)、
+      gross、receipts、planned、opening、closing(均为按事件的一维数组)、on_hand、safety_stock(按物料)
+    """
+    item_ids = np.asarray(item_ids, dtype=np.int64)
+    counts = [len(gross_requirements[item_id]) for item_id in item_ids.tolist()]
+    rows = np.repeat(np.arange(len(item_ids)), counts)
+    item_buckets = np.concatenate([np.fromiter(gross_requirements[item_id].keys(), dtype=np.int32, count=count)
+                                   for item_id, count in zip(item_ids.tolist(), counts)])
+    quantities = np.concatenate([np.fromiter(gross_requirements[item_id].values(), dtype=np.float64, count=count)
+                                 for item_id, count in zip(item_ids.tolist(), counts)])
+    return _net_rows(item_ids, rows, item_buckets, quantities, master, on_hand=on_hand, first_bucket=first_bucket,
+                     lot_sizing=lot_sizing, receipt_bucket_map=receipt_bucket_map)
+
+def _net_rows(item_ids, rows, item_buckets, quantities, master, on_hand=None, first_bucket=None, lot_sizing=True,
+              receipt_bucket_map=None):
+    """
+    按稀疏的总需求记录构建每行自身的事件轴并调用净算内核，同一物料可以占用多行(例如不同的需求场景)
+
+    事件轴见net_events，补零的空间不超过实际事件数，与各行的需求时段是否重叠无关
+
+    参数:
+    - item_ids: 每行对应的物料ID数组
+    - rows: 每条总需求记录所在的行
+    - item_buckets: 每条总需求记录的需求时段
+    - quantities: 每条总需求记录的需求数量
+    - master: 物料主数据MaterialMaster
+    - on_hand、first_bucket、lot_sizing、receipt_bucket_map: 见net_level
+
+    返回:
+    - level: 字典，见net_level
+    """
+    item_ids = np.asarray(item_ids, dtype=np.int64)
+    row_count = len(item_ids)
+
+    # (行, 时段)打包排序去重，每个键为一个事件，同一行的事件连续且按时段排序
+    entry_keys = (np.asarray(rows, dtype=np.int64) << 32) | (np.asarray(item_buckets, dtype=np.int64) + 2 ** 31)
+    event_keys, entry_events = np.unique(entry_keys, return_inverse=True)
+    event_rows = event_keys >> 32
+    event_buckets = ((event_keys & 0xFFFFFFFF) - 2 ** 31).astype(np.int32)
+    offsets = np.searchsorted(event_rows, np.arange(row_count + 1))
+    gross = np.bincount(entry_events, weights=quantities, minlength=len(event_keys))
+
+    # 采购到货直接从CSR数组取出，计入同一行当天或之后的第一个事件
+    positions, po_rows = csr_positions(master.receipt_offsets, item_ids)
+    po_buckets = master.receipt_buckets[positions]
+    if first_bucket is not None:
+        later = po_buckets >= first_bucket
+        positions, po_rows, po_buckets = positions[later], po_rows[later], po_buckets[later]
+    if receipt_bucket_map is not None and len(po_buckets):
+        po_buckets = np.asarray(receipt_bucket_map(po_buckets))
+    po_events = np.searchsorted(event_keys, (po_rows << 32) | (po_buckets.astype(np.int64) + 2 ** 31))
+    in_horizon = po_events < offsets[po_rows + 1]
+    receipts = np.bincount(po_events[in_horizon], weights=master.receipt_quantities[positions][in_horizon],
+                           minlength=len(event_keys))
+
+    on_hand = master.on_hand[item_ids] if on_hand is None else np.asarray(on_hand, dtype=np.float64)
+    safety_stock = master.safety_stock[item_ids]
+    use_lot_sizing = lot_sizing and master.has_lot_rules[item_ids].any()
+
+    planned, closing = net_events(offsets, gross, receipts, on_hand, safety_stock,
+                                  master.lot_rules[item_ids] if use_lot_sizing else None)
+
+    # 期初库存为同一行上一事件的期末库存，每行第一个事件为期初库存
+    opening = np.empty_like(closing)
+    opening[1:] = closing[:-1]
+    has_events = np.diff(offsets) > 0
+    opening[offsets[:-1][has_events]] = on_hand[has_events]
+
+    return {
+        'item_ids': item_ids,
+        'offsets': offsets,
+        'rows': event_rows,
+        'buckets': event_buckets,
+        'gross': gross,
+        'receipts': receipts,
+        'planned': planned,
+        'opening': opening,
+        'closing': closing,
+        'on_hand': on_hand,
+        'safety_stock': safety_stock
+    }
+
+def net_events(offsets, gross, receipts, on_hand, safety_stock, lot_rules=None):
+    """
+    按行分段的事件轴调用净算内核，offsets[i]:offsets[i + 1]为第i行的事件，每个事件都是需求时段
+
+    净算内核按事件数的2的幂分档，每档拼成宽度相同的矩阵计算，填充的列不是需求时段，
+    因此补零的空间不超过实际事件数
+
+    参数:
+    - offsets: 每行事件的起止位置数组 (行数 + 1,)
+    - gross: 每个事件的总需求量数组
+    - receipts: 每个事件的到货量数组
+    - on_hand: 每行的期初库存数组
+    - safety_stock: 每行的安全库存数组
+    - lot_rules: 每行的批量规则数组 (行 × 4: 最小批量、批量倍数、固定批量、周期订货时段数) (可选)，
+      提供时使用lot_sizing_kernel，否则使用闭式解netting_kernel
+
+    返回:
+    - planned: 每个事件的计划订单量数组
+    - closing: 每个事件的期末投影库存数组
+    """
+    planned = np.zeros(len(gross))
+    closing = np.zeros(len(gross))
+    widths = np.diff(offsets)
+    width_classes = np.ceil(np.log2(np.maximum(widths, 1))).astype(np.int64)
+    for width_class in np.unique(width_classes[widths > 0]).tolist():
+        class_rows = np.flatnonzero((width_classes == width_class) & (widths > 0))
+        events, block_rows = csr_positions(offsets, class_rows)
+        block_columns = events - offsets[class_rows][block_rows]
+        shape = (len(class_rows), 2 ** width_class)
+        block_gross, block_receipts = np.zeros(shape), np.zeros(shape)
+        block_active = np.zeros(shape, dtype=bool)
+        block_gross[block_rows, block_columns] = gross[events]
+        block_receipts[block_rows, block_columns] = receipts[events]
+        block_active[block_rows, block_columns] = True
+
+        if lot_rules is not None:
+            block_rules = lot_rules[class_rows]
+            block_planned, block_closing = lot_sizing_kernel(
+                block_gross, block_receipts, on_hand[class_rows], safety_stock[class_rows], block_active,
+                min_lot_size=block_rules[:, 0], lot_multiple=block_rules[:, 1],
+                fixed_lot_size=block_rules[:, 2], order_periods=block_rules[:, 3])
+        else:
+            block_planned, block_closing = netting_kernel(block_gross, block_receipts, on_hand[class_rows],
+                                                          safety_stock[class_rows], block_active)
+        planned[events] = block_planned[block_rows, block_columns]
+        closing[events] = block_closing[block_rows, block_columns]
+    return planned, closing
+
+def _propagate_pegs(pegs, planned_orders, master, calendar):
+    """
+    将一层物料的计划订单按追溯占比分摊到生产计划行，并随计划订单展开为子项的追溯记录
+
+    计划订单对应该物料在订单时段当天或之后最近的有需求的时段，没有时对应最后一个有需求的时段；
+    净算内核的计划订单都在需求时段上，整数规划提前生产时追溯到它所满足的需求
+
+    参数:
+    - pegs: 本层物料合并后的追溯记录 (物料ID, 需求时段, 生产计划行号, 数量)，见_merge_pegs
+    - planned_orders: 本层物料的计划订单 {物料ID: {需求时段: 计划订单量}}
+    - master: 物料主数据MaterialMaster
+    - calendar: 计划时段日历BucketCalendar
+
+    返回:
+    - child_pegs: 子项的追溯记录 (物料ID, 需求时段, 生产计划行号, 数量)
+    """
+    item_ids, buckets, rows, quantities = pegs
+    compiled_bom = master.compiled_bom
+    empty = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0))
+
+    # 1. 有子项的物料的计划订单
+    parents = [item_id for item_id, orders in planned_orders.items() if item_id < compiled_bom.item_count and orders]
+    if not parents or not len(item_ids):
+        return empty
+    counts = [len(planned_orders[item_id]) for item_id in parents]
+    order_items = np.repeat(np.asarray(parents, dtype=np.int64), counts)
+    order_buckets = np.concatenate([np.fromiter(planned_orders[item_id].keys(), dtype=np.int64, count=count)
+                                    for item_id, count in zip(parents, counts)])
+    order_quantities = np.concatenate([np.fromiter(planned_orders[item_id].values(), dtype=np.float64, count=count)
+                                       for item_id, count in zip(parents, counts)])
+    positive = order_quantities > 0
+    order_items, order_buckets, order_quantities = order_items[positive], order_buckets[positive], order_quantities[positive]
+
+    # 2. 每个计划订单对应的(物料, 需求时段)分组
+    keys = PeggingIndex._pack(item_ids, buckets)
+    group_starts = np.flatnonzero(np.concatenate([[True], np.diff(keys) != 0]))
+    group_offsets = np.append(group_starts, len(keys))
+    group_items = item_ids[group_starts]
+    groups = np.searchsorted(keys[group_starts], PeggingIndex._pack(order_items, order_buckets))
+    later = (groups == len(group_starts)) | (group_items[np.minimum(groups, len(group_starts) - 1)] != order_items)
+    groups[later] -= 1
+    pegged = (groups >= 0) & (group_items[groups] == order_items)
+    order_items, order_buckets, order_quantities, groups = (
+        order_items[pegged], order_buckets[pegged], order_quantities[pegged], groups[pegged])
+
+    # 3. 计划订单按组内占比分摊到生产计划行，再沿BOM边按用量展开到下达时段
+    positions, sources = csr_positions(group_offsets, groups)
+    totals = np.add.reduceat(quantities, group_starts) if len(group_starts) else np.zeros(0)
+    shares = order_quantities[sources] * quantities[positions] / totals[groups[sources]]
+    release_buckets = calendar.shift(order_buckets, master.production_lead_time[order_items])
+    edge_positions, edge_sources = compiled_bom.edge_positions(order_items[sources])
+    return (compiled_bom.children[edge_positions].astype(np.int64),
+            np.asarray(release_buckets, dtype=np.int64)[sources][edge_sources],
+            rows[positions][edge_sources],
+            shares[edge_sources] * compiled_bom.quantities[edge_positions])
+
+def run_llc_mrp(production_plan, master, net_items, calendar=None, dirty_items=None, previous_orders=None,
+                pegging=None):
+    """
+    按低层码逐层计算物料需求
+
+    每一层先汇总该层所有物料的总需求，由net_items完成净需求计算，
+    再只将计划订单按提前期展开到下一层子项的总需求中；全程使用物料ID
+
+    参数:
+    - production_plan: 生产计划DataFrame、CSV文件路径或DataFrame块的可迭代对象，见iter_plan_chunks；
+      逐块汇总为独立需求，内存只与物料 x 时段的数量有关
+    - master: 物料主数据MaterialMaster，计划订单下达日期 = 需求日期 - 生产提前期；
+      生产计划中不在物料字典中的产品会被追加，见MaterialMaster.add_items
+    - net_items: 净需求计算函数，签名为net_items(item_ids, gross_requirements)，
+      gross_requirements为{物料ID: {需求时段: 总需求量}}，
+      返回{物料ID: {需求时段: 计划订单量}}
+    - calendar: 计划时段日历BucketCalendar (可选)，默认按日
+    - dirty_items: 净改变计算时需要重新净算的物料ID集合 (可选)，
+      其余物料沿用previous_orders中的计划订单，只展开到需要重新净算的子项
+    - previous_orders: 上次计算的计划订单 {物料ID: {需求时段: 计划订单量}} (可选)
+    - pegging: 需求追溯索引PeggingIndex (可选)，提供时按每层的计划订单记录追溯关系，计算完成后填充该索引
+
+    返回:
+    - gross_requirements: 重新净算物料的总需求 {物料ID: {需求时段: 总需求量}}
+
+    抛出:
+    - ValueError: 净改变计算时要求记录需求追溯，追溯关系需要全部重算
+    """
+    if calendar is None:
+        calendar = BucketCalendar('day')
+    if pegging is not None and dirty_items is not None:
+        raise ValueError("需求追溯需要全部重算，不能与净改变计算同时使用")
+    compiled_bom = master.compiled_bom
+
+    # 1. 逐块汇总独立需求，编码和日期只在这里转换一次为物料ID和整数时段；记录追溯时每行生产计划按行号记录
+    accumulator = DemandAccumulator()
+    plan_pegs = []
+    row_count = 0
+    for chunk in iter_plan_chunks(production_plan):
+        chunk_items = master.add_items(chunk['产品编码'])
+        chunk_buckets = calendar.to_buckets(chunk['需求日期'])
+        chunk_quantities = chunk['需求数量'].to_numpy(dtype=np.float64)
+        accumulator.add(chunk_items, chunk_buckets, chunk_quantities)
+        if pegging is not None:
+            plan_pegs.append((chunk_items, chunk_buckets, np.arange(row_count, row_count + len(chunk)), chunk_quantities))
+        row_count += len(chunk)
+    gross_requirements = accumulator.to_dict()
+
+    # 2. 计算低层码，不在BOM中的物料没有子项，视为第0层
+    llc = np.zeros(master.item_count, dtype=np.int64)
+    llc[:len(compiled_bom.codes)] = compiled_bom.low_level_codes()
+    bom_item_count = len(compiled_bom.codes)
+
+    # 追溯记录按物料所在层暂存，处理到该层时合并
+    level_pegs = {}
+    all_pegs = []
+
+    def add_pegs(pegs):
+        item_levels = llc[pegs[0]]
+        for item_level in np.unique(item_levels).tolist():
+            selected = item_levels == item_level
+            level_pegs.setdefault(item_level, []).append(tuple(np.asarray(part)[selected] for part in pegs))
+
+    for pegs in plan_pegs:
+        add_pegs(pegs)
+
+    # 3. 逐层净算并展开计划订单
+    for level in range(int(llc.max()) + 1 if len(llc) else 1):
+        level_ids = np.flatnonzero(llc == level).tolist()
+
+        # 净改变计算时只净算受影响的物料
+        level_items = [item_id for item_id in level_ids
+                       if item_id in gross_requirements and (dirty_items is None or item_id in dirty_items)]
+        planned_orders = {}
+        if level_items:
+            planned_orders = net_items(level_items, {item_id: gross_requirements[item_id] for item_id in level_items})
+
+        # 未受影响的物料沿用上次的计划订单，其总需求与上次相同
+        if dirty_items is not None:
+            for item_id in level_ids:
+                if item_id not in dirty_items and item_id in previous_orders:
+                    planned_orders[item_id] = previous_orders[item_id]
+
+        # 计划订单按本层总需求中各生产计划行的占比追溯，并随计划订单展开到子项
+        if pegging is not None and level in level_pegs:
+            pegs = _merge_pegs(*(np.concatenate(parts) for parts in zip(*level_pegs.pop(level))))
+            all_pegs.append(pegs)
+            add_pegs(_propagate_pegs(pegs, planned_orders, master, calendar))
+
+        for item_id, orders in planned_orders.items():
+            if item_id >= bom_item_count:
+                continue
+
+            child_ids, child_quantities = compiled_bom.children_of(item_id)
+            if dirty_items is not None:
+                needed = np.fromiter((child_id in dirty_items for child_id in child_ids.tolist()), dtype=bool,
+                                     count=len(child_ids))
+                child_ids, child_quantities = child_ids[needed], child_quantities[needed]
+            if not len(child_ids):
+                continue
+
+            order_buckets = [bucket for bucket, order_quantity in orders.items() if order_quantity > 0]
+            if not order_buckets:
+                continue
+
+            # 计划订单下达时段 = 需求时段向前偏移提前期
+            release_buckets = calendar.shift(order_buckets, int(master.production_lead_time[item_id]))
+            for bucket, release_bucket in zip(order_buckets, release_buckets.tolist()):
+                order_quantity = orders[bucket]
+                for child_id, quantity in zip(child_ids.tolist(), child_quantities.tolist()):
+                    child_requirements = gross_requirements.setdefault(child_id, {})
+                    child_requirements[release_bucket] = child_requirements.get(release_bucket, 0) + order_quantity * quantity
+
+    if pegging is not None:
+        pegs = [np.concatenate(parts) for parts in zip(*all_pegs)] if all_pegs else [np.zeros(0, dtype=np.int64)] * 4
+        pegging.build(*pegs, row_count=row_count, codes=master.codes, calendar=calendar)
+
+    return gross_requirements
+
+def run_scenario_mrp(scenarios, master, calendar=None):
+    """
+    一次计算多个需求场景的物料需求
+
+    各场景共用BOM索引和物料主数据，(场景, 物料)作为净算的行，每行只在自身的需求时段上有事件；
+    每层所有场景的所有物料一次调用净算内核，计划订单沿BOM边按生产提前期一次性展开到下一层
+
+    参数:
+    - scenarios: 需求场景 {场景名称: 生产计划}，生产计划可以是DataFrame、CSV文件路径或DataFrame块的可迭代对象
+    - master: 物料主数据MaterialMaster，生产计划中不在物料字典中的产品会被追加
+    - calendar: 计划时段日历BucketCalendar (可选)，默认按日
+
+    返回:
+    - results: DataFrame，每个场景、物料和需求时段一行，包含场景、物料编码、需求周期、总需求量、期初库存、
+      安全库存、采购到货、净需求量、期末库存
+
+    抛出:
+    - ValueError: 没有提供任何场景
+    """
+    if not scenarios:
+        raise ValueError("至少需要提供一个需求场景")
+    if calendar is None:
+        calendar = BucketCalendar('day')
+    compiled_bom = master.compiled_bom
+    names = list(scenarios)
+
+    # 1. 汇总各场景的独立需求，所有产品编码完成后物料数量才确定
+    demands = []
+    for name in names:
+        demand = DemandAccumulator()
+        for chunk in iter_plan_chunks(scenarios[name]):
+            demand.add(master.add_items(chunk['产品编码']), calendar.to_buckets(chunk['需求日期']),
+                       chunk['需求数量'].to_numpy(dtype=np.float64))
+        demands.append(demand.items())
+
+    # 行键 = 场景序号 * 物料数 + 物料ID
+    item_count = master.item_count
+    accumulator = DemandAccumulator()
+    for scenario, (item_ids, buckets, quantities) in enumerate(demands):
+        accumulator.add(scenario * item_count + item_ids.astype(np.int64), buckets, quantities)
+
+    # 2. 计算低层码，不在BOM中的物料没有子项，视为第0层
+    llc = np.zeros(item_count, dtype=np.int64)
+    llc[:compiled_bom.item_count] = compiled_bom.low_level_codes()
+
+    results = ResultBuffer({
+        '场景': np.int64,
+        '物料ID': np.int64,
+        '需求时段': np.int32,
+        '总需求量': np.float64,
+        '期初库存': np.float64,
+        '安全库存': np.float64,
+        '采购到货': np.float64,
+        '净需求量': np.float64,
+        '期末库存': np.float64
+    })
+
+    # 3. 逐层净算所有场景，再将计划订单展开到下一层
+    for level in range(int(llc.max()) + 1 if len(llc) else 1):
+        row_keys, entry_buckets, quantities = accumulator.items()
+        in_level = llc[row_keys % item_count] == level
+        if not in_level.any():
+            continue
+
+        level_keys, entry_rows = np.unique(row_keys[in_level].astype(np.int64), return_inverse=True)
+        row_scenarios = level_keys // item_count
+        netted = _net_rows(level_keys % item_count, entry_rows, entry_buckets[in_level], quantities[in_level], master)
+
+        # 每个场景、物料在自身需求时段上的记录
+        rows = netted['rows']
+        results.extend({
+            '场景': row_scenarios[rows],
+            '物料ID': level_keys[rows] % item_count,
+            '需求时段': netted['buckets'],
+            '总需求量': netted['gross'],
+            '期初库存': netted['opening'],
+            '安全库存': netted['safety_stock'][rows],
+            '采购到货': netted['receipts'],
+            '净需求量': netted['planned'],
+            '期末库存': netted['closing']
+        })
+
+        # 计划订单下达时段 = 需求时段向前偏移提前期，子项需求 = 计划订单量 * 用量
+        events = np.flatnonzero(netted['planned'] > 0)
+        parent_ids = level_keys[rows[events]] % item_count
+        has_children = parent_ids < compiled_bom.item_count
+        events, parent_ids = events[has_children], parent_ids[has_children]
+        release_buckets = calendar.shift(netted['buckets'][events], master.production_lead_time[parent_ids])
+        positions, sources = compiled_bom.edge_positions(parent_ids)
+        accumulator.add(row_scenarios[rows[events]][sources] * item_count + compiled_bom.children[positions],
+                        release_buckets[sources], netted['planned'][events][sources] * compiled_bom.quantities[positions])
+
+    # 4. 输出时解码场景名称、物料编码和日期
+    results = results.to_frame()
+    results.insert(0, '场景', np.asarray(names, dtype=object)[results.pop('场景').to_numpy()])
+    results.insert(1, '物料编码', master.codes[results.pop('物料ID').to_numpy()])
+    results.insert(2, '需求周期', calendar.to_dates(results.pop('需求时段').to_numpy()))
+    return results
+
+def compare_scenarios(results, scenario_names=None):
+    """
+    生成各场景并排对比的总需求和净需求表
+
+    参数:
+    - results: run_scenario_mrp返回的结果DataFrame
+    - scenario_names: 场景的列顺序 (可选)，默认按结果中出现的顺序
+
+    返回:
+    - comparison: DataFrame，行为物料编码和需求周期，列为(指标, 场景)两层索引，
+      指标为总需求量和净需求量，某场景没有该物料时段的需求时为0
+    """
+    if scenario_names is None:
+        scenario_names = list(pd.unique(results['场景']))
+    comparison = results.pivot_table(index=['物料编码', '需求周期'], columns='场景', values=['总需求量', '净需求量'],
+                                     aggfunc='sum', fill_value=0)
+    columns = pd.MultiIndex.from_product([['总需求量', '净需求量'], scenario_names], names=['指标', '场景'])
+    return comparison.reindex(columns=columns, fill_value=0)
+
+class ResultBuffer:
+    """
+    按列存储的结果缓冲区
+
+    每个输出列是预先分配的定型NumPy数组，按块整批追加，容量不足时按倍数扩容；
+    to_frame直接用各列的有效切片构造DataFrame，不再经过逐行字典
+
+    属性:
+    - columns: 字典 {列名: dtype}，决定输出列的顺序和类型
+    - size: 已写入的行数
+    """
+
+    def __init__(self, columns, capacity=1024):
+        """
+        参数:
+        - columns: 字典 {列名: dtype}
+        - capacity: 初始容量(行)
+        """
+        self.columns = dict(columns)
+        self.size = 0
+        self._arrays = {name: np.empty(capacity, dtype=dtype) for name, dtype in self.columns.items()}
+
+    def _reserve(self, count):
+        capacity = len(next(iter(self._arrays.values()))) if self._arrays else 0
+        if self.size + count <= capacity:
+            return
+
+        new_capacity = max(capacity * 2, self.size + count)
+        for name, array in self._arrays.items():
+            grown = np.empty(new_capacity, dtype=array.dtype)
+            grown[:self.size] = array[:self.size]
+            self._arrays[name] = grown
+
+    def extend(self, values):
+        """
+        追加一批行
+
+        参数:
+        - values: 字典 {列名: 数组或标量}，数组长度必须一致，标量广播到整批
+        """
+        lengths = {len(value) for value in values.values() if np.ndim(value) > 0}
+        if len(lengths) > 1:
+            raise ValueError(f"追加的各列长度不一致: {sorted(lengths)}")
+        count = lengths.pop() if lengths else 1
+        if count == 0:
+            return
+
+        missing = [name for name in self.columns if name not in values]
+        if missing:
+            raise ValueError(f"追加的结果缺少列: {', '.join(missing)}")
+
+        self._reserve(count)
+        for name, array in self._arrays.items():
+            array[self.size:self.size + count] = values[name]
+        self.size += count
+
+    def to_frame(self):
+        """
+        转换为DataFrame，各列直接引用缓冲区的有效切片
+        """
+        return pd.DataFrame({name: array[:self.size] for name, array in self._arrays.items()}, copy=False)
+
+def input_digests(production_plan, inventory_data, purchase_orders=None):
+    """
+    按物料计算输入数据的摘要，用于比较两次计算之间哪些物料的输入发生了变化
+
+    每行数据先计算行哈希，再按物料排序后合并，行顺序不影响摘要
+
+    参数:
+    - production_plan: 生产计划DataFrame
+    - inventory_data: 库存数据DataFrame
+    - purchase_orders: 采购订单DataFrame (可选)
+
+    返回:
+    - digests: 字典 {物料编码: (生产计划摘要, 库存摘要, 采购订单摘要)}，没有数据的部分为空字符串
+    """
+    digests = {}
+    sources = [(production_plan, '产品编码'), (inventory_data, '物料编码'), (purchase_orders, '物料编码')]
+    for position, (data, key) in enumerate(sources):
+        if data is None or data.empty:
+            continue
+
+        row_hashes = pd.util.hash_pandas_object(data, index=False).to_numpy()
+        item_codes, items = pd.factorize(data[key].to_numpy(dtype=object))
+        order = np.lexsort((row_hashes, item_codes))
+        bounds = np.flatnonzero(np.diff(item_codes[order])) + 1
+        for item, hashes in zip(items, np.split(row_hashes[order], bounds)):
+            digests.setdefault(item, ['', '', ''])[position] = hashlib.sha1(hashes.tobytes()).hexdigest()
+
+    return {item: tuple(digest) for item, digest in digests.items()}
+
+class NetChangeSnapshot:
+    """
+    上一次MRP计算的快照，用于净改变(net-change)计算
+
+    再次计算时比较各物料的输入摘要，只有输入变化的物料及其BOM下层物料需要重新净算，
+    其余物料直接复用快照中的计划订单和结果；BOM、日历或提前期等设置变化，
+    或物料字典变化导致物料ID不再对应时全部重算
+
+    属性:
+    - settings: 上次计算的设置，例如BOM指纹和日历键
+    - codes: 上次计算的物料字典，见MaterialMaster.codes
+    - digests: 上次计算的输入摘要 {物料编码: 摘要}
+    - planned_orders: 上次计算的计划订单 {物料ID: {需求时段: 计划订单量}}
+    - results: 上次计算的结果DataFrame
+    """
+
+    def __init__(self):
+        self.settings = None
+        self.codes = None
+        self.digests = {}
+        self.planned_orders = {}
+        self.results = None
+
+    def dirty_items(self, settings, digests, master):
+        """
+        比较输入摘要，找出需要重新净算的物料
+
+        参数:
+        - settings: 本次计算的设置
+        - digests: 本次计算的输入摘要，见input_digests
+        - master: 本次计算的物料主数据MaterialMaster
+
+        返回:
+        - dirty_items: 需要重新净算的物料ID集合，没有可用快照时返回None表示全部重算
+        """
+        if self.settings is None or self.settings != settings or not np.array_equal(self.codes, master.codes):
+            return None
+
+        changed = [item for item in set(digests) | set(self.digests) if digests.get(item) != self.digests.get(item)]
+        item_ids = master.encode(changed)
+        item_ids = item_ids[item_ids >= 0]
+        bom_ids = item_ids[item_ids < len(master.compiled_bom.codes)]
+        dirty_items = set(master.compiled_bom.descendants(bom_ids).tolist())
+        dirty_items.update(item_ids.tolist())
+        return dirty_items
+
+    def update(self, settings, digests, planned_orders, results, master, dirty_items=None):
+        """
+        保存本次计算的结果，净改变计算时只替换重新净算的物料
+
+        参数:
+        - settings: 本次计算的设置
+        - digests: 本次计算的输入摘要
+        - planned_orders: 重新净算物料的计划订单 {物料ID: {需求时段: 计划订单量}}
+        - results: 重新净算物料的结果DataFrame，包含物料编码列
+        - master: 本次计算的物料主数据MaterialMaster
+        - dirty_items: 重新净算的物料ID集合，None表示全部重算
+
+        返回:
+        - results: 合并后的完整结果DataFrame
+        """
+        if dirty_items is None:
+            self.planned_orders = dict(planned_orders)
+            self.results = results
+        else:
+            for item in dirty_items:
+                if item in planned_orders:
+                    self.planned_orders[item] = planned_orders[item]
+                else:
+                    self.planned_orders.pop(item, None)
+
+            # 未受影响物料的结果保留，重新净算物料的结果追加在后面
+            dirty_codes = master.codes[np.fromiter(dirty_items, dtype=np.int64, count=len(dirty_items))]
+            kept = self.results[~self.results['物料编码'].isin(dirty_codes)] if len(self.results.columns) else self.results
+            self.results = pd.concat([kept, results], ignore_index=True) if len(kept) else results
+
+        self.settings = settings
+        self.codes = master.codes
+        self.digests = digests
+        return self.results
@@ -2,15 +2,28 @@ import pandas as pd
 import numpy as np
 import os
 import sys
+import tempfile
 import time
+from unittest import mock
 
 # 添加当前目录到Python路径
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
 # 导入MRP计算函数
-from app import calculate_mrp
-from advanced_mrp import calculate_advanced_mrp
-from utils import validate_production_plan, validate_bom_data, validate_inventory_data, validate_purchase_orders
+from app import calculate_mrp, calculate_scenario_mrp
+import advanced_mrp
+from advanced_mrp import (calculate_advanced_mrp, choose_solver_backend, ModelCache, simulate_demand_uncertainty,
+                          simulate_projection)
+from mrp_engine import (CompiledBOM, BucketCalendar, NetChangeSnapshot, calculate_gross_requirements,
+                        get_explosion_cache, netting_kernel, lot_sizing_kernel, net_level, build_item_axis,
+                        input_digests, PeggingIndex, ResultBuffer, MaterialMaster)
+import utils
+from utils import (validate_production_plan, validate_bom_data, validate_inventory_data, validate_purchase_orders,
+                   load_csv_cached, read_typed_csv, validate_mrp_data, find_bom_cycles, check_bom_circular_reference,
+                   analyze_bom_structure)
+
+# 测试使用独立的临时缓存目录，不写入仓库中的.mrp_cache
+TEST_CACHE_DIR = tempfile.TemporaryDirectory(prefix='mrp_test_cache_')
 
 def load_test_data():
     """
@@ -19,10 +32,10 @@ def load_test_data():
     sample_data_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sample_data')
     
     # 加载基本测试数据
-    production_plan = pd.read_csv(os.path.join(sample_data_dir, 'production_plan.csv'))
-    bom_data = pd.read_csv(os.path.join(sample_data_dir, 'bom_data.csv'))
-    inventory_data = pd.read_csv(os.path.join(sample_data_dir, 'inventory_data.csv'))
-    purchase_orders = pd.read_csv(os.path.join(sample_data_dir, 'purchase_orders.csv'))
+    production_plan = load_csv_cached(os.path.join(sample_data_dir, 'production_plan.csv'), table='production_plan', cache_dir=TEST_CACHE_DIR.name)
+    bom_data = load_csv_cached(os.path.join(sample_data_dir, 'bom_data.csv'), table='bom', cache_dir=TEST_CACHE_DIR.name)
+    inventory_data = load_csv_cached(os.path.join(sample_data_dir, 'inventory_data.csv'), table='inventory', cache_dir=TEST_CACHE_DIR.name)
+    purchase_orders = load_csv_cached(os.path.join(sample_data_dir, 'purchase_orders.csv'), table='purchase_orders', cache_dir=TEST_CACHE_DIR.name)
     
     # 转换日期列
     production_plan['需求日期'] = pd.to_datetime(production_plan['需求日期'])
@@ -41,24 +54,16 @@ def test_basic_mrp():
     
     # 验证数据
     is_valid, message = validate_production_plan(production_plan)
-    if not is_valid:
-        print(f"生产计划数据验证失败: {message}")
-        return False
+    assert is_valid, f"生产计划数据验证失败: {message}"
     
     is_valid, message = validate_bom_data(bom_data)
-    if not is_valid:
-        print(f"BOM数据验证失败: {message}")
-        return False
+    assert is_valid, f"BOM数据验证失败: {message}"
     
     is_valid, message = validate_inventory_data(inventory_data)
-    if not is_valid:
-        print(f"库存数据验证失败: {message}")
-        return False
+    assert is_valid, f"库存数据验证失败: {message}"
     
     is_valid, message = validate_purchase_orders(purchase_orders)
-    if not is_valid:
-        print(f"采购订单数据验证失败: {message}")
-        return False
+    assert is_valid, f"采购订单数据验证失败: {message}"
     
     # 计时开始
     start_time = time.time()
@@ -85,11 +90,8 @@ def test_basic_mrp():
         # 输出部分结果示例
         print("\n结果示例:")
         print(mrp_results.head())
-        
-        return True
     except Exception as e:
-        print(f"MRP计算失败: {e}")
-        return False
+        raise AssertionError(f"MRP计算失败: {e}") from e
 
 def test_advanced_mrp():
     """
@@ -141,11 +143,978 @@ def test_advanced_mrp():
         # 输出部分结果示例
         print("\n结果示例:")
         print(mrp_results.head())
-        
-        return True
     except Exception as e:
-        print(f"高级MRP计算失败: {e}")
-        return False
+        raise AssertionError(f"高级MRP计算失败: {e}") from e
+
+def test_llc_netting():
+    """
+    测试按低层码逐层净算：共用组件只按父项的净计划订单展开
+    """
+    print("\n测试低层码逐层净算...")
+    
+    production_plan = pd.DataFrame({
+        '产品编码': ['A', 'B'],
+        '需求数量': [10, 5],
+        '需求日期': pd.to_datetime(['2023-06-10', '2023-06-10'])
+    })
+    bom_data = pd.DataFrame({
+        '父项编码': ['A', 'B', 'S'],
+        '子项编码': ['S', 'S', 'R'],
+        '用量': [2, 1, 3]
+    })
+    # A有4个库存，只需生产6个；S被A、B共用且位于第1层
+    inventory_data = pd.DataFrame({
+        '物料编码': ['A', 'B', 'S', 'R'],
+        '库存数量': [4, 0, 7, 0],
+        '安全库存': [0, 0, 0, 0]
+    })
+    
+    mrp_results = calculate_mrp(production_plan, bom_data, inventory_data)
+    net_map = mrp_results.groupby('物料编码')['净需求量'].sum()
+    
+    # S总需求 = 6*2 + 5*1 = 17，扣除库存7后净需求10；R只按S的净需求展开
+    expected = {'A': 6, 'B': 5, 'S': 10, 'R': 30}
+    for item, quantity in expected.items():
+        assert abs(net_map.get(item, 0) - quantity) <= 1e-6, f"物料 {item} 净需求错误: {net_map.get(item, 0)} != {quantity}"
+    
+    print("低层码逐层净算结果正确")
+
+def test_compiled_bom():
+    """
+    测试BOM邻接索引(CSR数组)的子项查询、出边位置和指纹
+    """
+    print("\n测试BOM邻接索引...")
+    
+    production_plan, bom_data, inventory_data, purchase_orders = load_test_data()
+    
+    compiled_bom = CompiledBOM(bom_data, production_plan['产品编码'].unique())
+    assert compiled_bom.edge_count == len(bom_data), f"BOM边数量错误: {compiled_bom.edge_count}"
+    
+    # 每个父项的子项和用量与BOM数据一致
+    for parent, group in bom_data.groupby('父项编码'):
+        child_ids, quantities = compiled_bom.children_of(compiled_bom.encode([parent])[0])
+        actual = dict(zip(compiled_bom.codes[child_ids], quantities))
+        assert actual == dict(zip(group['子项编码'], group['用量'].astype(float))), f"物料{parent}的子项错误: {actual}"
+    
+    # 一组物料的出边位置与逐个查询的结果一致
+    parent_ids = compiled_bom.encode(['P001', 'C001'])
+    positions, sources = compiled_bom.edge_positions(parent_ids)
+    expected = np.concatenate([compiled_bom.children_of(parent_id)[0] for parent_id in parent_ids])
+    assert np.array_equal(compiled_bom.children[positions], expected), "出边位置错误"
+    assert np.array_equal(sources, np.repeat([0, 1], [len(compiled_bom.children_of(parent_id)[0]) for parent_id in parent_ids])), \
+        "出边所属物料错误"
+    
+    # 下层物料包含物料本身和所有子项
+    descendants = set(compiled_bom.codes[compiled_bom.descendants(compiled_bom.encode(['C001']))])
+    assert descendants == {'C001', 'M001', 'M002'}, f"下层物料错误: {descendants}"
+    
+    # 相同BOM的指纹相同，用量变化后指纹不同
+    assert CompiledBOM(bom_data, production_plan['产品编码'].unique()).fingerprint() == compiled_bom.fingerprint(), \
+        "相同BOM的指纹不同"
+    changed_bom = bom_data.assign(用量=bom_data['用量'] + 1)
+    assert CompiledBOM(changed_bom).fingerprint() != compiled_bom.fingerprint(), "用量变化后指纹未变"
+    
+    print("BOM邻接索引结果正确")
+
+def test_netting_kernel():
+    """
+    测试闭式净算内核与逐期计算的结果一致
+    """
+    print("\n测试净算内核...")
+    
+    # 期初12，安全库存5，第2期到货15
+    planned, closing = netting_kernel([[10, 0, 20, 5]], [[0, 15, 0, 0]], [12], [5])
+    assert np.allclose(planned, [[3, 0, 5, 5]]), f"计划订单错误: {planned}"
+    assert np.allclose(closing, [[5, 20, 5, 5]]), f"期末库存错误: {closing}"
+    
+    # 不需要满足安全库存的时段不下达订单，缺口推迟到下一个需要满足的时段
+    planned, _ = netting_kernel([[10, 0, 20, 5]], [[0, 15, 0, 0]], [12], [5], active=[[False, True, True, True]])
+    assert np.allclose(planned, [[0, 0, 8, 5]]), f"跳过时段的计划订单错误: {planned}"
+    
+    # 随机数据与未配置批量规则的逐期内核一致
+    rng = np.random.default_rng(3)
+    gross = rng.integers(0, 50, size=(40, 25)).astype(float)
+    receipts = np.where(rng.random((40, 25)) < 0.1, rng.integers(0, 80, size=(40, 25)), 0).astype(float)
+    on_hand = rng.integers(0, 100, size=40)
+    safety_stock = rng.integers(0, 30, size=40)
+    active = rng.random((40, 25)) < 0.8
+    planned, closing = netting_kernel(gross, receipts, on_hand, safety_stock, active)
+    expected_planned, expected_closing = lot_sizing_kernel(gross, receipts, on_hand, safety_stock, active)
+    assert np.allclose(planned, expected_planned), "闭式解与逐期计算的计划订单不一致"
+    assert np.allclose(closing, expected_closing), "闭式解与逐期计算的期末库存不一致"
+    assert (planned >= 0).all(), "计划订单不应为负"
+    
+    print("净算内核结果正确")
+
+def test_explosion_cache():
+    """
+    测试展开向量缓存计算的总需求
+    """
+    print("\n测试展开向量缓存...")
+    
+    production_plan, bom_data, inventory_data, purchase_orders = load_test_data()
+    
+    compiled_bom = CompiledBOM(bom_data, production_plan['产品编码'].unique())
+    gross_requirements = calculate_gross_requirements(production_plan, compiled_bom, default_lead_time=7)
+    total_map = gross_requirements.groupby('物料编码')['需求数量'].sum()
+    
+    # C001由P001(用量2)和P002(用量1)共用
+    p001_total = production_plan.loc[production_plan['产品编码'] == 'P001', '需求数量'].sum()
+    p002_total = production_plan.loc[production_plan['产品编码'] == 'P002', '需求数量'].sum()
+    assert abs(total_map['C001'] - (p001_total * 2 + p002_total)) <= 1e-6, f"C001总需求错误: {total_map['C001']}"
+    
+    # 原材料M001在成品需求日期前两个提前期需要
+    earliest_demand = production_plan['需求日期'].min()
+    earliest_m001 = gross_requirements.loc[gross_requirements['物料编码'] == 'M001', '需求日期'].min()
+    assert earliest_m001 == earliest_demand - pd.Timedelta(days=14), f"M001需求日期错误: {earliest_m001}"
+    
+    # BOM和提前期不变时复用同一个缓存
+    rebuilt_bom = CompiledBOM(bom_data, production_plan['产品编码'].unique())
+    assert (get_explosion_cache(rebuilt_bom, default_lead_time=7) is
+            get_explosion_cache(compiled_bom, default_lead_time=7)), "相同BOM未复用展开向量缓存"
+    
+    # 累计提前期：P001经C001到M001为两层生产提前期加M001的采购提前期，P003不使用M001
+    cache = get_explosion_cache(compiled_bom, lead_times=np.full(compiled_bom.item_count, 7))
+    assert cache is get_explosion_cache(compiled_bom, default_lead_time=7), "相同提前期数组未复用展开向量缓存"
+    purchase_lead_times = np.full(compiled_bom.item_count, 2)
+    purchase_lead_times[compiled_bom.encode(['M001'])] = 10
+    cumulative = cache.cumulative_lead_times(compiled_bom.encode(['P001', 'P003', 'M001']), purchase_lead_times)
+    assert cumulative.tolist() == [24, 16, 10], f"累计提前期错误: {cumulative.tolist()}"
+    
+    print("展开向量缓存结果正确")
+
+def test_lot_sizing_kernel():
+    """
+    测试批量规则内核
+    """
+    print("\n测试批量规则内核...")
+    
+    gross = np.array([[10, 20, 30, 40], [10, 20, 30, 40], [10, 20, 30, 40]], dtype=float)
+    receipts = np.zeros_like(gross)
+    on_hand = [0, 0, 0]
+    safety_stock = [0, 0, 5]
+    
+    # 第1行周期订货(2期)，第2行固定批量25，第3行最小批量15且批量倍数4
+    planned, closing = lot_sizing_kernel(
+        gross, receipts, on_hand, safety_stock,
+        min_lot_size=[0, 0, 15], lot_multiple=[1, 1, 4],
+        fixed_lot_size=[0, 25, 0], order_periods=[2, 1, 1]
+    )
+    expected = np.array([[30, 0, 70, 0], [25, 25, 25, 25], [16, 20, 32, 40]], dtype=float)
+    assert np.allclose(planned, expected), f"批量规则计算错误:\n{planned}"
+    
+    # 多余数量计入投影库存且不低于安全库存
+    assert not (closing < np.array(safety_stock)[:, None]).any(), f"投影库存低于安全库存:\n{closing}"
+    
+    print("批量规则内核结果正确")
+
+def test_sparse_event_axis():
+    """
+    测试每个物料只在自身需求时段上净算，采购到货计入自身当天或之后的第一个需求时段
+    """
+    print("\n测试物料稀疏事件轴...")
+    
+    bom_data = pd.DataFrame({'父项编码': ['A', 'B'], '子项编码': ['X', 'Y'], '用量': [1, 1]})
+    inventory_data = pd.DataFrame({'物料编码': ['A', 'B', 'X', 'Y'], '库存数量': [0, 0, 0, 0], '安全库存': [0, 0, 0, 0]})
+    # A的第二张订单晚于最后一个需求时段，不影响计划
+    purchase_orders = pd.DataFrame({
+        '物料编码': ['A', 'A', 'B'],
+        '订单数量': [10, 7, 5],
+        '预计到货日期': pd.to_datetime(['2023-06-03', '2023-06-20', '2023-06-01'])
+    })
+    calendar = BucketCalendar('day')
+    master = MaterialMaster(CompiledBOM(bom_data), inventory_data, purchase_orders)
+    a, b = master.encode(['A', 'B'])
+    buckets = calendar.to_buckets(['2023-06-05', '2023-06-10', '2024-01-01'])
+    gross_requirements = {
+        int(a): {int(buckets[0]): 8.0, int(buckets[1]): 10.0},
+        int(b): {int(buckets[2]): 4.0}
+    }
+    
+    level = net_level([a, b], gross_requirements, master)
+    
+    # 事件轴不是两个物料需求时段的并集
+    assert level['offsets'].tolist() == [0, 2, 3], f"事件轴错误: {level['offsets']}"
+    assert level['buckets'].tolist() == buckets.tolist(), f"事件时段错误: {level['buckets']}"
+    assert level['receipts'].tolist() == [10, 0, 5], f"到货计入的事件错误: {level['receipts']}"
+    assert level['planned'].tolist() == [0, 8, 0], f"计划订单错误: {level['planned']}"
+    assert level['opening'].tolist() == [0, 2, 0], f"期初库存错误: {level['opening']}"
+    assert level['closing'].tolist() == [2, 0, 1], f"期末库存错误: {level['closing']}"
+    
+    # 整数规划使用的时间轴包含到货时段，同样忽略最后一个需求时段之后的到货
+    axis = build_item_axis(gross_requirements[int(a)], *master.receipts_of(a))
+    assert axis['buckets'].tolist() == sorted([int(buckets[0]), int(buckets[1]), int(calendar.to_buckets(['2023-06-03'])[0])]), \
+        f"整数规划时间轴错误: {axis['buckets']}"
+    assert axis['receipts'].sum() == 10, f"整数规划时间轴的到货错误: {axis['receipts']}"
+    
+    print("物料稀疏事件轴结果正确")
+
+def test_bucket_calendar():
+    """
+    测试计划时段日历和按周计算MRP
+    """
+    print("\n测试计划时段日历...")
+    
+    production_plan, bom_data, inventory_data, purchase_orders = load_test_data()
+    
+    # 2023-06-01为周四，所在ISO周从2023-05-29开始
+    calendar = BucketCalendar('week')
+    week_start = calendar.to_dates(calendar.to_buckets(['2023-06-01', '2023-06-04']))
+    assert (week_start == np.datetime64('2023-05-29')).all(), f"周时段起始日期错误: {week_start}"
+    
+    # 提前期从时段起始日期向前平移，跨周、跨月时落到前面的时段
+    shifted = calendar.to_dates(calendar.shift(calendar.to_buckets(['2023-06-01', '2023-06-01']), [3, 10]))
+    assert (shifted == np.array(['2023-05-22', '2023-05-15'], dtype='datetime64[D]')).all(), f"按周平移提前期错误: {shifted}"
+    month_calendar = BucketCalendar('month')
+    shifted = month_calendar.to_dates(month_calendar.shift(month_calendar.to_buckets(['2023-06-20']), 1))
+    assert (shifted == np.datetime64('2023-05-01')).all(), f"按月平移提前期错误: {shifted}"
+    
+    daily_results = calculate_mrp(production_plan, bom_data, inventory_data, purchase_orders)
+    weekly_results = calculate_mrp(production_plan, bom_data, inventory_data, purchase_orders, time_bucket='week')
+    
+    # 按周计算的需求周期都是周一
+    assert (weekly_results['需求周期'].dt.dayofweek == 0).all(), "按周计算的需求周期不是周一"
+    
+    # 按日计算的结果按周汇总后，产品的每周总需求和净需求与按周计算一致；下层物料同一周内晚到的采购订单
+    # 在按周计算时可以抵减周内较早的需求，净需求在周间移动，但各物料的合计不变
+    daily_results['需求周期'] -= pd.to_timedelta(daily_results['需求周期'].dt.dayofweek, unit='D')
+    daily_weekly = daily_results.groupby(['物料编码', '需求周期'])[['总需求量', '净需求量']].sum()
+    weekly = weekly_results.groupby(['物料编码', '需求周期'])[['总需求量', '净需求量']].sum()
+    products = production_plan['产品编码'].unique()
+    pd.testing.assert_frame_equal(weekly.loc[products], daily_weekly.loc[products])
+    pd.testing.assert_frame_equal(weekly.groupby(level=0).sum(), daily_weekly.groupby(level=0).sum())
+    
+    print("计划时段日历结果正确")
+
+def test_parallel_milp():
+    """
+    测试同层整数规划模型分发到进程池求解，结果与串行求解一致
+    """
+    print("\n测试进程池并行求解...")
+    
+    production_plan, bom_data, inventory_data, purchase_orders = load_test_data()
+    lot_sizes = pd.DataFrame({'物料编码': inventory_data['物料编码'], '最小批量': 20, '批量倍数': 5})
+    # 每个物料使用单独的产线，同层每个物料各自建立一个模型
+    item_codes = inventory_data['物料编码'].astype(str)
+    resource_requirements = pd.DataFrame({
+        '物料编码': item_codes,
+        '资源编码': 'L_' + item_codes,
+        '单位用量': 1
+    })
+    capacity_constraints = pd.DataFrame({
+        '资源编码': resource_requirements['资源编码'],
+        '日期': '2023-06-10',
+        '可用产能': 500
+    })
+    
+    def run(max_workers):
+        return calculate_advanced_mrp(production_plan, bom_data, inventory_data, purchase_orders, lot_sizes=lot_sizes,
+                                      capacity_constraints=capacity_constraints,
+                                      resource_requirements=resource_requirements, max_workers=max_workers)
+    
+    serial = run(None)
+    parallel = run(2)
+    columns = ['物料编码', '需求周期', '净需求量', '求解状态']
+    assert not serial.empty, "整数规划没有计划订单"
+    assert serial[columns].equals(parallel[columns]), "进程池求解结果与串行不一致"
+    model_counts = [{backend: stats['模型数'] for backend, stats in results.attrs['求解统计'].items()}
+                    for results in (serial, parallel)]
+    assert model_counts[0] == model_counts[1], f"进程池的模型数统计与串行不一致: {model_counts}"
+    
+    print(f"进程池并行求解结果正确，模型数: {sum(model_counts[0].values())}")
+
+def test_shared_capacity():
+    """
+    测试共用资源的物料在联合模型中合计占用产能
+    """
+    print("\n测试共用资源产能约束...")
+    
+    production_plan = pd.DataFrame({
+        '产品编码': ['A', 'A', 'B'],
+        '需求数量': [4, 6, 3],
+        '需求日期': pd.to_datetime(['2023-06-05', '2023-06-10', '2023-06-10'])
+    })
+    bom_data = pd.DataFrame({
+        '父项编码': ['A', 'B'],
+        '子项编码': ['R', 'R'],
+        '用量': [1, 1]
+    })
+    inventory_data = pd.DataFrame({
+        '物料编码': ['A', 'B', 'R'],
+        '库存数量': [0, 0, 0],
+        '安全库存': [0, 0, 0]
+    })
+    # A和B共用产线L1，B每单位占用2单位产能；单独建模时6 + 2*3 = 12会超出产能10
+    capacity_constraints = pd.DataFrame({
+        '资源编码': ['L1'],
+        '日期': ['2023-06-10'],
+        '可用产能': [10]
+    })
+    resource_requirements = pd.DataFrame({
+        '物料编码': ['A', 'B'],
+        '资源编码': ['L1', 'L1'],
+        '单位用量': [1, 2]
+    })
+    
+    mrp_results = calculate_advanced_mrp(
+        production_plan, bom_data, inventory_data,
+        capacity_constraints=capacity_constraints,
+        resource_requirements=resource_requirements
+    )
+    
+    usage_map = {'A': 1, 'B': 2}
+    on_date = mrp_results[mrp_results['需求周期'] == pd.Timestamp('2023-06-10')]
+    usage = sum(usage_map.get(item, 0) * quantity for item, quantity in zip(on_date['物料编码'], on_date['净需求量']))
+    assert usage <= 10 + 1e-6, f"L1产能占用超出: {usage}"
+    
+    # 需求总量仍然全部满足，A提前在2023-06-05多生产
+    net_map = mrp_results.groupby('物料编码')['净需求量'].sum()
+    expected = {'A': 10, 'B': 3, 'R': 13}
+    for item, quantity in expected.items():
+        assert abs(net_map.get(item, 0) - quantity) <= 1e-6, f"物料 {item} 净需求错误: {net_map.get(item, 0)} != {quantity}"
+    
+    # 尽量晚生产：2023-06-10剩余的4单位产能留给A，只有放不下的2个提前到2023-06-05
+    a_orders = mrp_results[mrp_results['物料编码'] == 'A'].set_index('需求周期')['净需求量']
+    assert np.isclose(a_orders.get(pd.Timestamp('2023-06-10'), 0), 4), f"A没有在最晚的可行时段生产:\n{a_orders}"
+    assert np.isclose(a_orders.get(pd.Timestamp('2023-06-05'), 0), 6), f"A提前生产的数量错误:\n{a_orders}"
+    
+    print("共用资源产能约束结果正确")
+
+def test_solver_backend_routing():
+    """
+    测试求解器后端按模型类型选择，并支持手动指定
+    """
+    print("\n测试求解器后端选择...")
+    
+    def item_model(min_lot_size, lot_multiple):
+        return {'is_demand': np.array([True, False, True]), 'min_lot_size': min_lot_size, 'lot_multiple': lot_multiple}
+    
+    # 连续模型不论规模都用GLOP，纯整数小模型用CP-SAT，连续和整数混合用SCIP
+    large_model = {'is_demand': np.ones(60000, dtype=bool), 'min_lot_size': 0, 'lot_multiple': 1}
+    cases = [
+        ([item_model(0, 1)], 'GLOP'),
+        ([large_model], 'GLOP'),
+        ([item_model(20, 5), item_model(0, 10)], 'CP-SAT'),
+        ([item_model(0, 1), item_model(20, 1)], 'SCIP')
+    ]
+    for item_models, expected in cases:
+        backend = choose_solver_backend(item_models)
+        assert backend == expected, f"求解器选择错误: {backend} != {expected}"
+    
+    production_plan, bom_data, inventory_data, purchase_orders = load_test_data()
+    capacity_constraints = pd.DataFrame({
+        '资源编码': ['R1'],
+        '日期': ['2023-06-01'],
+        '可用产能': [100000]
+    })
+    automatic = calculate_advanced_mrp(production_plan, bom_data, inventory_data, purchase_orders,
+                                       capacity_constraints=capacity_constraints)
+    forced = calculate_advanced_mrp(production_plan, bom_data, inventory_data, purchase_orders,
+                                    capacity_constraints=capacity_constraints, solver_backend='SCIP')
+    
+    # 求解统计记录在结果的attrs中
+    assert set(automatic.attrs['求解统计']) == {'GLOP'}, f"自动选择的求解统计错误: {automatic.attrs['求解统计']}"
+    assert set(forced.attrs['求解统计']) == {'SCIP'}, f"指定后端的求解统计错误: {forced.attrs['求解统计']}"
+    
+    assert abs(automatic['净需求量'].sum() - forced['净需求量'].sum()) <= 1e-6, "不同求解器的总净需求量不一致"
+    
+    # 线性规划的相对间隙由对偶解计算；手动指定PDLP时近似解经过修复，不低于安全库存
+    pdlp = calculate_advanced_mrp(production_plan, bom_data, inventory_data, purchase_orders,
+                                  capacity_constraints=capacity_constraints, solver_backend='PDLP')
+    assert (automatic['相对间隙'] <= 1e-9).all(), f"GLOP的相对间隙错误: {automatic['相对间隙'].max()}"
+    assert (pdlp['相对间隙'] <= 1e-6).all(), f"PDLP的相对间隙错误: {pdlp['相对间隙'].max()}"
+    assert pdlp.attrs['求解统计']['PDLP']['原始残差'] <= 1e-9, f"PDLP的解违反约束: {pdlp.attrs['求解统计']}"
+    assert (pdlp['期末库存'] >= pdlp['安全库存'] - 1e-9).all(), "PDLP的解低于安全库存"
+    assert abs(pdlp['净需求量'].sum() - automatic['净需求量'].sum()) <= 1e-3, "PDLP的总净需求量与GLOP不一致"
+    
+    print("求解器后端选择结果正确")
+
+def test_solver_limits():
+    """
+    测试求解时间上限、相对间隙目标和无可行解时的状态标记
+    """
+    print("\n测试求解时间上限和间隙目标...")
+    
+    production_plan, bom_data, inventory_data, purchase_orders = load_test_data()
+    capacity_constraints = pd.DataFrame({
+        '资源编码': ['R1'],
+        '日期': ['2023-06-01'],
+        '可用产能': [100000]
+    })
+    lot_sizes = pd.DataFrame({
+        '物料编码': inventory_data['物料编码'],
+        '最小批量': 20,
+        '批量倍数': 5
+    })
+    
+    mrp_results = calculate_advanced_mrp(
+        production_plan, bom_data, inventory_data, purchase_orders,
+        lot_sizes=lot_sizes, capacity_constraints=capacity_constraints,
+        time_limit=5, mip_gap=0.05, run_time_limit=30
+    )
+    assert mrp_results['求解状态'].isin(['最优', '可行']).all(), f"求解状态错误: {mrp_results['求解状态'].unique()}"
+    assert not (mrp_results['相对间隙'] > 0.05 + 1e-9).any(), f"相对间隙超出目标: {mrp_results['相对间隙'].max()}"
+    
+    # 产能不足时不再中断计算，而是标记为不可行
+    capacity_constraints['可用产能'] = 1
+    infeasible_results = calculate_advanced_mrp(
+        production_plan, bom_data, inventory_data, purchase_orders,
+        capacity_constraints=capacity_constraints
+    )
+    assert (infeasible_results['求解状态'] == '不可行').any(), "产能不足时未标记不可行"
+    
+    print("求解时间上限和间隙目标结果正确")
+
+def test_net_change():
+    """
+    测试净改变计算只重算输入变化的物料，结果与全部重算一致
+    """
+    print("\n测试净改变计算...")
+    
+    production_plan, bom_data, inventory_data, purchase_orders = load_test_data()
+    
+    def sorted_results(results):
+        return results.sort_values(['物料编码', '需求周期']).reset_index(drop=True)
+    
+    compiled_bom = CompiledBOM(bom_data, production_plan['产品编码'].unique())
+    snapshot = NetChangeSnapshot()
+    calculate_mrp(production_plan.copy(), bom_data, inventory_data.copy(), purchase_orders.copy(),
+                  compiled_bom=compiled_bom, snapshot=snapshot)
+    
+    # 只修改M004的库存，只有M004需要重算
+    changed_inventory = inventory_data.copy()
+    changed_inventory.loc[changed_inventory['物料编码'] == 'M004', '库存数量'] += 100
+    master = MaterialMaster(compiled_bom, changed_inventory, purchase_orders,
+                            items=production_plan['产品编码'].unique())
+    digests = input_digests(production_plan, changed_inventory, purchase_orders)
+    dirty_items = set(master.codes[list(snapshot.dirty_items(snapshot.settings, digests, master))])
+    assert dirty_items == {'M004'}, f"库存变化的受影响物料错误: {dirty_items}"
+    
+    # 修改P001的一行生产计划，P001及其下层物料需要重算
+    changed_plan = production_plan.copy()
+    changed_plan.loc[changed_plan['产品编码'] == 'P001', '需求数量'] += 30
+    digests = input_digests(changed_plan, changed_inventory, purchase_orders)
+    dirty_items = set(master.codes[list(snapshot.dirty_items(snapshot.settings, digests, master))])
+    expected = {'P001', 'C001', 'C002', 'M001', 'M002', 'M003', 'M004', 'M005'}
+    assert dirty_items == expected, f"生产计划变化的受影响物料错误: {dirty_items}"
+    
+    net_change_results = calculate_mrp(changed_plan.copy(), bom_data, changed_inventory.copy(),
+                                       purchase_orders.copy(), compiled_bom=compiled_bom, snapshot=snapshot)
+    full_results = calculate_mrp(changed_plan.copy(), bom_data, changed_inventory.copy(), purchase_orders.copy())
+    assert sorted_results(net_change_results).equals(sorted_results(full_results)), "净改变计算结果与全部重算不一致"
+
+    # 依次修改采购订单数量、新增采购订单和修改安全库存，每次只重算受影响的物料，结果与全部重算一致
+    changed_orders = purchase_orders.copy()
+    changed_orders.loc[changed_orders['物料编码'] == 'M005', '订单数量'] += 300
+    added_orders = pd.concat([changed_orders, pd.DataFrame({
+        '订单编号': ['PO011'], '物料编码': ['C002'], '订单数量': [40.0], '预计到货日期': pd.to_datetime(['2023-06-12'])
+    })], ignore_index=True)
+    safety_inventory = changed_inventory.copy()
+    safety_inventory.loc[safety_inventory['物料编码'].isin(['C001', 'M005']), '安全库存'] += 25
+    edits = [
+        ('采购订单数量', changed_inventory, changed_orders, {'M005'}),
+        ('新增采购订单', changed_inventory, added_orders, {'C002', 'M002', 'M003'}),
+        ('安全库存', safety_inventory, added_orders, {'C001', 'M001', 'M002', 'M005'})
+    ]
+    for name, edited_inventory, edited_orders, expected in edits:
+        master = MaterialMaster(compiled_bom, edited_inventory, edited_orders, items=production_plan['产品编码'].unique())
+        digests = input_digests(changed_plan, edited_inventory, edited_orders)
+        dirty_items = set(master.codes[list(snapshot.dirty_items(snapshot.settings, digests, master))])
+        assert dirty_items == expected, f"{name}变化的受影响物料错误: {dirty_items}"
+
+        net_change_results = calculate_mrp(changed_plan.copy(), bom_data, edited_inventory.copy(), edited_orders.copy(),
+                                           compiled_bom=compiled_bom, snapshot=snapshot)
+        full_results = calculate_mrp(changed_plan.copy(), bom_data, edited_inventory.copy(), edited_orders.copy())
+        assert sorted_results(net_change_results).equals(sorted_results(full_results)), \
+            f"{name}变化后净改变计算结果与全部重算不一致"
+
+    print("净改变计算结果正确")
+
+def test_model_cache():
+    """
+    测试跨多次计算复用求解模型，输入变化后热启动求解的结果与重新建模一致
+    """
+    print("\n测试求解模型复用...")
+    
+    production_plan, bom_data, inventory_data, purchase_orders = load_test_data()
+    capacity_constraints = pd.DataFrame({
+        '资源编码': ['R1'],
+        '日期': ['2023-06-01'],
+        '可用产能': [100000]
+    })
+    lot_sizes = pd.DataFrame({
+        '物料编码': inventory_data['物料编码'],
+        '最小批量': 20,
+        '批量倍数': 5
+    })
+    
+    model_cache = ModelCache()
+    calculate_advanced_mrp(production_plan, bom_data, inventory_data, purchase_orders, lot_sizes=lot_sizes,
+                           capacity_constraints=capacity_constraints, model_cache=model_cache)
+    models = dict(model_cache.models)
+    
+    # 只修改库存，模型结构不变
+    changed_inventory = inventory_data.copy()
+    changed_inventory.loc[changed_inventory['物料编码'] == 'M003', '库存数量'] += 500
+    cached_results = calculate_advanced_mrp(production_plan, bom_data, changed_inventory, purchase_orders,
+                                            lot_sizes=lot_sizes, capacity_constraints=capacity_constraints,
+                                            model_cache=model_cache)
+    assert all(model_cache.models[items] is model for items, model in models.items()), "模型结构不变时未复用模型"
+    
+    cold_results = calculate_advanced_mrp(production_plan, bom_data, changed_inventory, purchase_orders,
+                                          lot_sizes=lot_sizes, capacity_constraints=capacity_constraints)
+    columns = ['物料编码', '需求周期', '净需求量']
+    assert cached_results[columns].equals(cold_results[columns]), "复用模型的结果与重新建模不一致"
+    
+    print("求解模型复用结果正确")
+
+def test_pegging_index():
+    """
+    测试需求追溯索引按净算后的计划订单追溯，正向和反向查询与总需求一致
+    """
+    print("\n测试需求追溯索引...")
+    
+    production_plan, bom_data, inventory_data, purchase_orders = load_test_data()
+    
+    # 结果中每条记录的总需求量都能追溯到生产计划行，数量合计一致且占比合计为1
+    pegging = PeggingIndex()
+    mrp_results = calculate_mrp(production_plan.copy(), bom_data, inventory_data.copy(), purchase_orders.copy(),
+                                pegging=pegging)
+    for item, date, quantity in zip(mrp_results['物料编码'], mrp_results['需求周期'], mrp_results['总需求量']):
+        rows = pegging.demand_rows(item, date)
+        assert abs(rows['需求数量'].sum() - quantity) <= 1e-6, f"物料 {item} 在 {date} 的追溯数量错误"
+        assert abs(rows['占比'].sum() - 1) <= 1e-9, f"物料 {item} 在 {date} 的追溯占比错误"
+        assert rows['生产计划行'].between(0, len(production_plan) - 1).all(), f"物料 {item} 追溯到的生产计划行错误"
+    
+    # 反向查询的合计与全部追溯记录一致
+    total = sum(pegging.requirements_of(row)['需求数量'].sum() for row in range(len(production_plan)))
+    assert abs(total - pegging.quantities.sum()) <= 1e-6, "反向查询的需求合计与追溯记录不一致"
+    
+    # 共用组件S只按A、B的净计划订单追溯：S总需求 = 6*2 + 5*1 = 17，R只按S的净需求10展开
+    shared_plan = pd.DataFrame({'产品编码': ['A', 'B'], '需求数量': [10, 5], '需求日期': pd.to_datetime(['2023-06-10'] * 2)})
+    shared_bom = pd.DataFrame({'父项编码': ['A', 'B', 'S'], '子项编码': ['S', 'S', 'R'], '用量': [2, 1, 3]})
+    shared_inventory = pd.DataFrame({'物料编码': ['A', 'B', 'S', 'R'], '库存数量': [4, 0, 7, 0], '安全库存': [0, 0, 0, 0]})
+    pegging = PeggingIndex()
+    shared_results = calculate_mrp(shared_plan, shared_bom, shared_inventory, pegging=pegging)
+    gross = shared_results.groupby(['物料编码', '需求周期'])['总需求量'].sum()
+    pegged = pd.DataFrame({'物料编码': pegging.codes[pegging.item_ids],
+                           '需求周期': pegging.calendar.to_dates(pegging.buckets),
+                           '需求数量': pegging.quantities}).groupby(['物料编码', '需求周期'])['需求数量'].sum()
+    assert np.allclose(pegged.reindex(gross.index), gross) and len(pegged) == len(gross), \
+        f"追溯数量与总需求量不一致:\n{pegged}\n{gross}"
+    assert np.isclose(gross['S'].sum(), 17) and np.isclose(gross['R'].sum(), 30), f"总需求量错误:\n{gross}"
+    
+    # R的需求按S的总需求中A、B的占比分摊：A占12/17，B占5/17
+    r_rows = pegging.demand_rows('R', pd.Timestamp('2023-05-27'))
+    assert np.allclose(r_rows['需求数量'], [30 * 12 / 17, 30 * 5 / 17]), f"R的追溯分摊错误:\n{r_rows}"
+    
+    print("需求追溯索引结果正确")
+
+def test_result_buffer():
+    """
+    测试按列存储的结果缓冲区
+    """
+    print("\n测试结果缓冲区...")
+    
+    buffer = ResultBuffer({'物料编码': object, '需求周期': 'datetime64[ns]', '净需求量': np.float64}, capacity=2)
+    buffer.extend({
+        '物料编码': np.array(['A', 'B', 'C'], dtype=object),
+        '需求周期': pd.to_datetime(['2023-06-01', '2023-06-02', '2023-06-03']).to_numpy(),
+        '净需求量': np.array([1.0, 2.0, 3.0])
+    })
+    # 标量广播到整批
+    buffer.extend({'物料编码': 'D', '需求周期': np.datetime64('2023-06-04'), '净需求量': 4.0})
+    
+    results = buffer.to_frame()
+    assert results['物料编码'].tolist() == ['A', 'B', 'C', 'D'] and results['净需求量'].sum() == 10, f"结果缓冲区内容错误:\n{results}"
+    assert results['需求周期'].dtype == 'datetime64[ns]', f"结果缓冲区列类型错误: {results['需求周期'].dtype}"
+    
+    print("结果缓冲区结果正确")
+
+def test_material_master():
+    """
+    测试物料主数据按物料ID存储的数组与原始数据一致
+    """
+    print("\n测试物料主数据编码...")
+    
+    production_plan, bom_data, inventory_data, purchase_orders = load_test_data()
+    
+    compiled_bom = CompiledBOM(bom_data, production_plan['产品编码'].unique())
+    master = MaterialMaster(compiled_bom, inventory_data, purchase_orders,
+                            items=production_plan['产品编码'].unique())
+    
+    # BOM中的物料沿用CompiledBOM的物料ID
+    assert np.array_equal(master.codes[:compiled_bom.item_count], compiled_bom.codes), "物料ID与BOM索引不一致"
+    
+    # 库存和安全库存按物料ID对齐
+    item_ids = master.encode(inventory_data['物料编码'])
+    assert (np.array_equal(master.on_hand[item_ids], inventory_data['库存数量'].to_numpy(dtype=np.float64)) and
+            np.array_equal(master.safety_stock[item_ids], inventory_data['安全库存'].to_numpy(dtype=np.float64))), \
+        "库存数组与库存数据不一致"
+    
+    # 采购到货按物料汇总后与采购订单总量一致
+    for item, quantity in purchase_orders.groupby('物料编码')['订单数量'].sum().items():
+        _, receipt_quantities = master.receipts_of(master.encode([item])[0])
+        assert np.isclose(receipt_quantities.sum(), quantity), f"物料{item}的采购到货与采购订单不一致"
+    
+    assert master.encode(['不存在的物料'])[0] == -1, "未知物料编码应返回-1"
+    
+    print("物料主数据编码正确")
+
+def test_streaming_plan():
+    """
+    测试按块流式读取生产计划与一次载入的计算结果一致
+    """
+    print("\n测试流式读取生产计划...")
+    
+    production_plan, bom_data, inventory_data, purchase_orders = load_test_data()
+    plan_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sample_data', 'production_plan.csv')
+    
+    def sorted_results(results):
+        return results.sort_values(['物料编码', '需求周期']).reset_index(drop=True)
+    
+    full_results = calculate_mrp(production_plan.copy(), bom_data, inventory_data.copy(), purchase_orders.copy())
+    
+    # 从CSV文件按每块3行读取，以及直接传入DataFrame块的迭代器
+    file_results = calculate_mrp(plan_file, bom_data, inventory_data.copy(), purchase_orders.copy(), chunksize=3)
+    chunk_results = calculate_mrp((production_plan.iloc[start:start + 2] for start in range(0, len(production_plan), 2)),
+                                  bom_data, inventory_data.copy(), purchase_orders.copy())
+    for results in (file_results, chunk_results):
+        assert sorted_results(results).equals(sorted_results(full_results)), "流式计算结果与一次载入不一致"
+    
+    # 总需求逐块展开累加后与整体展开一致
+    compiled_bom = CompiledBOM(bom_data, production_plan['产品编码'].unique())
+    gross = calculate_gross_requirements(production_plan, compiled_bom, default_lead_time=3)
+    chunked_gross = calculate_gross_requirements(plan_file, compiled_bom, default_lead_time=3, chunksize=2)
+    assert gross.equals(chunked_gross), "逐块展开的总需求与整体展开不一致"
+    
+    print("流式读取生产计划结果正确")
+
+def test_scenarios():
+    """
+    测试多场景一次计算与逐个场景计算的结果一致
+    """
+    print("\n测试多场景计算...")
+    
+    production_plan, bom_data, inventory_data, purchase_orders = load_test_data()
+    
+    def sorted_results(results):
+        return results.sort_values(['物料编码', '需求周期']).reset_index(drop=True)
+    
+    # 基准、需求上浮20%、P001提前一周上市
+    increased_plan = production_plan.assign(需求数量=production_plan['需求数量'] * 1.2)
+    pulled_plan = production_plan.copy()
+    pulled_plan.loc[pulled_plan['产品编码'] == 'P001', '需求日期'] -= pd.Timedelta(days=7)
+    scenarios = {'基准': production_plan, '上浮20%': increased_plan, '提前上市': pulled_plan}
+    
+    scenario_results, comparison = calculate_scenario_mrp(scenarios, bom_data, inventory_data, purchase_orders)
+    for name, plan in scenarios.items():
+        expected = calculate_mrp(plan.copy(), bom_data, inventory_data.copy(), purchase_orders.copy())
+        actual = scenario_results[scenario_results['场景'] == name].drop(columns='场景')
+        assert np.allclose(sorted_results(actual).select_dtypes('number'),
+                           sorted_results(expected).select_dtypes('number')), f"场景{name}的结果与单独计算不一致"
+    
+    # 对比表每个场景一列，上浮场景产品的总需求量为基准的1.2倍
+    assert list(comparison.columns.get_level_values('场景').unique()) == list(scenarios), f"对比表的场景列错误: {list(comparison.columns)}"
+    gross = comparison['总需求量'].loc[list(production_plan['产品编码'].unique())]
+    assert np.allclose(gross['上浮20%'], gross['基准'] * 1.2), "上浮场景的总需求量错误"
+    
+    print("多场景计算结果正确")
+
+def test_demand_simulation():
+    """
+    测试需求和提前期不确定性的蒙特卡洛模拟
+    """
+    print("\n测试蒙特卡洛模拟...")
+    
+    production_plan, bom_data, inventory_data, purchase_orders = load_test_data()
+    lead_times = pd.DataFrame({'物料编码': inventory_data['物料编码'], '生产提前期': 3, '采购提前期': 5})
+    
+    # 没有不确定性时每个样本都与基准计划相同，不会缺货
+    nominal = simulate_demand_uncertainty(production_plan, bom_data, inventory_data, purchase_orders, lead_times,
+                                          samples=20, demand_cv=0, lead_time_cv=0, seed=1)
+    assert nominal['缺货概率'].max() == 0 and np.allclose(nominal['投影库存P50'], nominal['期末库存']), "无不确定性时的模拟结果应与基准计划一致"
+    
+    # 相同随机种子时串行和进程池的结果一致
+    serial = simulate_demand_uncertainty(production_plan, bom_data, inventory_data, purchase_orders, lead_times,
+                                         samples=500, batch_size=100, seed=7)
+    parallel = simulate_demand_uncertainty(production_plan, bom_data, inventory_data, purchase_orders, lead_times,
+                                           samples=500, batch_size=100, seed=7, max_workers=2)
+    assert serial.equals(parallel), "进程池模拟结果与串行不一致"
+    
+    probabilities = serial['缺货概率']
+    assert ((probabilities >= 0) & (probabilities <= 1)).all() and probabilities.max() != 0, f"缺货概率异常: {probabilities.describe()}"
+    assert (serial['投影库存P5'] <= serial['投影库存P95']).all(), "投影库存百分位数顺序错误"
+    
+    # 各批只保留直方图，百分位数与全部样本的精确百分位数相差不超过一个分箱的宽度
+    projections = []
+    def record_projection(*args):
+        projected = simulate_projection(*args)
+        projections.append(projected)
+        return projected
+    with mock.patch.object(advanced_mrp, 'simulate_projection', side_effect=record_projection):
+        recorded = simulate_demand_uncertainty(production_plan, bom_data, inventory_data, purchase_orders, lead_times,
+                                               samples=500, batch_size=100, seed=7)
+    projected = np.concatenate(projections)
+    pilot = projections[0]
+    bin_width = 2 * (pilot.max(axis=0) - pilot.min(axis=0)) / advanced_mrp.SIMULATION_HISTOGRAM_BINS
+    assert recorded.equals(serial) and len(projected) == 500, "记录投影库存时的模拟结果不一致"
+    assert np.array_equal(serial['缺货概率'], (projected < 0).mean(axis=0)), "缺货概率与样本不一致"
+    for percentile in (5, 50, 95):
+        error = np.abs(serial[f'投影库存P{percentile}'] - np.percentile(projected, percentile, axis=0))
+        assert (error <= bin_width + 1e-9).all(), f"P{percentile}的误差超过分箱宽度: {(error - bin_width).max()}"
+    
+    # 未指定每批样本数时按每个样本的事件数和输出单元数分批
+    projections.clear()
+    with mock.patch.object(advanced_mrp, 'SIMULATION_BATCH_VALUES', 1000), \
+            mock.patch.object(advanced_mrp, 'simulate_projection', side_effect=record_projection):
+        simulate_demand_uncertainty(production_plan, bom_data, inventory_data, purchase_orders, lead_times,
+                                    samples=50, seed=7)
+    assert len(projections) > 1 and sum(map(len, projections)) == 50, f"分批错误: {[len(p) for p in projections]}"
+    
+    print(f"模拟{serial.attrs['模拟次数']}个样本，最大缺货概率: {probabilities.max():.2%}")
+
+def test_rolling_horizon():
+    """
+    测试滚动计划的冻结期、半冻结期和尾段
+    """
+    print("\n测试滚动计划时间栏...")
+    
+    production_plan, bom_data, inventory_data, purchase_orders = load_test_data()
+    lot_sizes = pd.DataFrame({'物料编码': inventory_data['物料编码'], '最小批量': 20, '批量倍数': 5})
+    lead_times = pd.DataFrame({'物料编码': inventory_data['物料编码'], '生产提前期': 2, '采购提前期': 5})
+    
+    planning_date = pd.Timestamp('2023-06-01')
+    results = calculate_advanced_mrp(production_plan, bom_data, inventory_data, purchase_orders, lead_times,
+                                     lot_sizes, frozen_days=5, slushy_days=20, tail_bucket='week',
+                                     planning_date=planning_date)
+    frozen_end = planning_date + pd.Timedelta(days=5)
+    slushy_end = planning_date + pd.Timedelta(days=20)
+    
+    # 冻结期内不下达新订单
+    assert not (results['需求周期'] < frozen_end).any(), "冻结期内不应有新的计划订单"
+    
+    # 半冻结期使用整数批量模型，订单满足最小批量和批量倍数
+    slushy = results[results['需求周期'] < slushy_end]
+    assert ((slushy['净需求量'] >= 20) & (np.isclose(slushy['净需求量'] % 5, 0))).all(), "半冻结期的计划订单不满足批量约束"
+    
+    # 尾段合并为周时段，订单在周一或半冻结期结束日
+    tail = results[results['需求周期'] >= slushy_end]
+    assert not tail.empty and ((tail['需求周期'].dt.dayofweek == 0) | (tail['需求周期'] == slushy_end)).all(), "尾段的计划订单应合并到周时段"
+
+    # 尾段按月合并时，月中到货同样抵减同月晚些时候的需求，与不滚动计划的结果一致
+    month_plan = pd.DataFrame({'产品编码': ['A'], '需求数量': [100], '需求日期': pd.to_datetime(['2024-03-20'])})
+    month_bom = pd.DataFrame({'父项编码': ['A'], '子项编码': ['R'], '用量': [1]})
+    month_inventory = pd.DataFrame({'物料编码': ['A', 'R'], '库存数量': [0, 0], '安全库存': [0, 0]})
+    month_orders = pd.DataFrame({'物料编码': ['A'], '订单数量': [100], '预计到货日期': pd.to_datetime(['2024-03-10'])})
+    month_results = calculate_advanced_mrp(month_plan, month_bom, month_inventory, month_orders, frozen_days=0,
+                                           slushy_days=5, planning_date='2024-01-01', tail_bucket='month')
+    assert month_results.empty, f"尾段的月中到货没有抵减需求:\n{month_results}"
+    
+    # 未指定半冻结期时默认延伸一个累计提前期，整数批量模型的变量数不随计划总长度增长
+    def milp_variables(days):
+        dates = planning_date + pd.to_timedelta(np.arange(0, days, 3), unit='D')
+        plan = pd.DataFrame({'产品编码': 'P001', '需求数量': 10, '需求日期': dates})
+        model_cache = ModelCache()
+        calculate_advanced_mrp(plan, bom_data, inventory_data, purchase_orders, lead_times, lot_sizes,
+                               frozen_days=0, planning_date=planning_date, model_cache=model_cache)
+        return sum(model.solver.NumVariables() for model in model_cache.models.values())
+    
+    short_variables = milp_variables(60)
+    assert short_variables > 0, "半冻结期内有批量规则的物料应使用整数批量模型"
+    assert milp_variables(720) == short_variables, "整数批量模型的变量数随计划总长度增长"
+
+    print(f"半冻结期订单: {len(slushy)}条，尾段订单: {len(tail)}条")
+
+def test_csv_cache():
+    """
+    测试CSV列式缓存按内容哈希复用Parquet文件
+    """
+    print("\n测试CSV列式缓存...")
+    
+    sample_data_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sample_data')
+    bom_file = os.path.join(sample_data_dir, 'bom_data.csv')
+    
+    with tempfile.TemporaryDirectory() as cache_dir:
+        # 第一次加载解析CSV并写入缓存，之后从缓存读取，结果与直接解析一致
+        first = load_csv_cached(bom_file, cache_dir=cache_dir)
+        cached_files = os.listdir(cache_dir)
+        second = load_csv_cached(bom_file, cache_dir=cache_dir)
+        assert len(cached_files) == 1 and cached_files[0].endswith('.parquet'), f"缓存文件错误: {cached_files}"
+        assert first.equals(pd.read_csv(bom_file)) and second.equals(first), "缓存读取的数据与CSV不一致"
+        
+        # 内容相同的上传内容命中同一缓存，内容变化时生成新的缓存文件
+        with open(bom_file, 'rb') as f:
+            content = f.read()
+        load_csv_cached(content, cache_dir=cache_dir)
+        load_csv_cached(content + '\nP009,产品9,C009,组件9,1,个\n'.encode('utf-8'), cache_dir=cache_dir)
+        assert len(os.listdir(cache_dir)) == 2, f"缓存文件数量错误: {os.listdir(cache_dir)}"
+    
+    with tempfile.TemporaryDirectory() as cache_dir:
+        # 表结构或缓存版本改变后不命中旧的缓存
+        load_csv_cached(bom_file, cache_dir=cache_dir, table='bom')
+        with mock.patch.dict(utils.TABLE_SCHEMAS['bom'], {'备注': 'string'}):
+            load_csv_cached(bom_file, cache_dir=cache_dir, table='bom')
+        with mock.patch.object(utils, 'CSV_CACHE_VERSION', utils.CSV_CACHE_VERSION + 1):
+            load_csv_cached(bom_file, cache_dir=cache_dir, table='bom')
+        assert len(os.listdir(cache_dir)) == 3, f"表结构变化后缓存文件数量错误: {os.listdir(cache_dir)}"
+    
+    with tempfile.TemporaryDirectory() as cache_dir:
+        # 超过容量上限时淘汰最久未使用的缓存，保留刚写入的文件
+        load_csv_cached(content, cache_dir=cache_dir)
+        latest = load_csv_cached(content + '\nP009,产品9,C009,组件9,1,个\n'.encode('utf-8'), cache_dir=cache_dir, max_bytes=1)
+        cached_files = os.listdir(cache_dir)
+        assert len(cached_files) == 1, f"缓存淘汰错误: {cached_files}"
+        again = load_csv_cached(content + '\nP009,产品9,C009,组件9,1,个\n'.encode('utf-8'), cache_dir=cache_dir, max_bytes=1)
+        assert os.listdir(cache_dir) == cached_files and again.equals(latest), "淘汰后保留的缓存不正确"
+    
+    print("CSV列式缓存正确")
+
+def test_typed_csv():
+    """
+    测试按表结构读取CSV数据
+    """
+    print("\n测试按表结构读取CSV...")
+    
+    import io
+    sample_data_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sample_data')
+    
+    # 编码列为分类类型，日期列在读取时解析，数量列为浮点数
+    purchase_orders = read_typed_csv(os.path.join(sample_data_dir, 'purchase_orders.csv'), 'purchase_orders')
+    assert (isinstance(purchase_orders['物料编码'].dtype, pd.CategoricalDtype)
+            and pd.api.types.is_datetime64_any_dtype(purchase_orders['预计到货日期'])
+            and purchase_orders['订单数量'].dtype == np.float64), f"列类型错误: {purchase_orders.dtypes.to_dict()}"
+    
+    # 可选列缺失时只读取存在的列
+    lot_sizes = read_typed_csv(io.BytesIO('物料编码,最小批量,批量倍数\nC001,10,5\n'.encode('utf-8')), 'lot_sizes')
+    assert (list(lot_sizes.columns) == ['物料编码', '最小批量', '批量倍数']
+            and lot_sizes['最小批量'].dtype == np.float64), f"可选列处理错误: {lot_sizes.dtypes.to_dict()}"
+    
+    # 未定义的表结构应报错
+    try:
+        read_typed_csv(os.path.join(sample_data_dir, 'bom_data.csv'), 'unknown')
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("未定义的表结构没有报错")
+    
+    print("按表结构读取CSV正确")
+
+def test_validation_report():
+    """
+    测试一次验证所有数据并报告全部问题
+    """
+    print("\n测试数据验证报告...")
+    
+    production_plan, bom_data, inventory_data, purchase_orders = load_test_data()
+    
+    is_valid, report = validate_mrp_data(production_plan, bom_data, inventory_data, purchase_orders)
+    assert is_valid and report.empty, f"示例数据验证失败:\n{report}"
+    
+    # 构造多个错误：非数值、非正数、无效日期、未定义物料、重复BOM行和循环引用
+    bad_plan = production_plan.astype({'需求数量': object, '需求日期': object, '产品编码': object})
+    bad_plan.loc[0, '需求数量'] = 'abc'
+    bad_plan.loc[1, '需求数量'] = -5
+    bad_plan.loc[2, '需求日期'] = '无效日期'
+    bad_plan.loc[3, '产品编码'] = 'X999'
+    bad_bom = pd.concat([bom_data, bom_data.iloc[[0]],
+                         pd.DataFrame({'父项编码': ['C001'], '子项编码': ['P001'], '用量': [1]})], ignore_index=True)
+    plan_before = bad_plan.copy()
+    
+    is_valid, report = validate_mrp_data(bad_plan, bad_bom, inventory_data, purchase_orders)
+    assert not is_valid, "错误数据没有被发现"
+    
+    # 每个问题都应报告到对应的行，且传入的数据不被修改
+    found = set(zip(report['数据表'], report['行号'], report['错误信息']))
+    expected = {
+        ('生产计划', 0, '需求数量不是有效的数值'),
+        ('生产计划', 1, '需求数量必须大于0'),
+        ('生产计划', 2, '需求日期不是有效的日期'),
+        ('生产计划', 3, '产品编码未在BOM或库存数据中定义'),
+        ('BOM数据', len(bom_data), '父项编码和子项编码重复')
+    }
+    assert expected <= found, f"缺少的问题: {expected - found}"
+    assert report['错误信息'].str.contains('循环引用').any(), "没有报告BOM循环引用"
+    assert bad_plan.equals(plan_before), "验证修改了传入的数据"
+    
+    # 用量不是数值或父项编码为空的BOM行只报告错误，不影响循环引用检查
+    for col, value, message in [('用量', 'abc', '用量不是有效的数值'), ('父项编码', None, '父项编码不能为空')]:
+        invalid_bom = bad_bom.astype({col: object})
+        invalid_bom.loc[0, col] = value
+        is_valid, report = validate_mrp_data(production_plan, invalid_bom, inventory_data, purchase_orders)
+        found = set(zip(report['数据表'], report['行号'], report['错误信息']))
+        assert not is_valid and ('BOM数据', 0, message) in found, f"缺少的问题: {message}"
+        assert report['错误信息'].str.contains('循环引用').any(), "没有报告BOM循环引用"
+        assert validate_bom_data(invalid_bom) == (False, message), f"BOM验证结果错误: {message}"
+    
+    print(f"数据验证报告正确，共{len(report)}个问题")
+
+def test_bom_cycle_detection():
+    """
+    测试BOM循环引用检测报告所有环路并支持很深的BOM
+    """
+    print("\n测试BOM循环引用检测...")
+    
+    def make_bom(edges):
+        return pd.DataFrame(edges, columns=['父项编码', '子项编码']).assign(用量=1.0)
+    
+    # 菱形结构不是循环引用
+    diamond = make_bom([('A', 'B'), ('A', 'C'), ('B', 'D'), ('C', 'D')])
+    assert not find_bom_cycles(diamond), "菱形结构被误判为循环引用"
+    
+    # 多个独立的环路和自引用都应报告
+    cycles = find_bom_cycles(make_bom([('A', 'B'), ('B', 'C'), ('C', 'A'), ('C', 'D'), ('D', 'D'),
+                                       ('E', 'F'), ('F', 'E'), ('G', 'E')]))
+    assert cycles == [['A', 'B', 'C', 'A'], ['D', 'D'], ['E', 'F', 'E']], f"环路错误: {cycles}"
+    try:
+        check_bom_circular_reference(make_bom([('A', 'B'), ('B', 'A'), ('C', 'C')]))
+    except ValueError as e:
+        assert 'A -> B -> A' in str(e) and 'C -> C' in str(e), f"错误信息没有列出所有环路: {e}"
+    else:
+        raise AssertionError("循环引用没有报错")
+    
+    # 层级超过递归深度限制的BOM
+    depth = sys.getrecursionlimit() * 5
+    chain = [(f"M{i}", f"M{i + 1}") for i in range(depth)]
+    assert not find_bom_cycles(make_bom(chain)), "深层BOM被误判为循环引用"
+    cycles = find_bom_cycles(make_bom(chain + [(f"M{depth}", 'M0')]))
+    assert len(cycles) == 1 and len(cycles[0]) == depth + 2, "深层BOM的环路检测错误"
+    
+    print("BOM循环引用检测正确")
+
+def test_bom_structure_analysis():
+    """
+    测试BOM结构分析使用低层码计算层级
+    """
+    print("\n测试BOM结构分析...")
+    
+    _, bom_data, _, _ = load_test_data()
+    
+    compiled_bom = CompiledBOM(bom_data)
+    analysis = analyze_bom_structure(bom_data, compiled_bom)
+    
+    # 最大层级应与层级分布和低层码一致
+    llc = analysis['low_level_codes']
+    assert analysis['max_bom_level'] == max(analysis['level_distribution']) == llc.max(), \
+        f"最大层级错误: {analysis['max_bom_level']}, 层级分布: {analysis['level_distribution']}"
+    assert sum(analysis['level_distribution'].values()) == len(llc) == analysis['total_items_count'], "层级分布的物料数量错误"
+    
+    # 低层码在编译后的BOM上缓存，MRP引擎复用同一份结果
+    assert compiled_bom.low_level_codes() is compiled_bom.low_level_codes(), "低层码没有缓存"
+    
+    # 稠密的多层BOM：每层每个物料都用到下一层所有物料，路径数随层数指数增长
+    layers, width = 30, 20
+    dense_bom = pd.DataFrame([(f"L{layer}_{i}", f"L{layer + 1}_{j}", 1)
+                              for layer in range(layers) for i in range(width) for j in range(width)],
+                             columns=['父项编码', '子项编码', '用量'])
+    start_time = time.time()
+    analysis = analyze_bom_structure(dense_bom)
+    elapsed = time.time() - start_time
+    assert analysis['max_bom_level'] == layers, f"稠密BOM最大层级错误: {analysis['max_bom_level']}"
+    assert analysis['level_distribution'] == {level: width for level in range(layers + 1)}, \
+        f"稠密BOM层级错误: {analysis['level_distribution']}"
+    
+    print(f"BOM结构分析正确，稠密BOM分析耗时: {elapsed:.4f}秒")
 
 def test_performance_with_large_data():
     """
@@ -163,14 +1132,14 @@ def test_performance_with_large_data():
     
     # 检查大规模数据文件是否存在
     if not all(os.path.exists(file) for file in large_data_files):
-        print("大规模测试数据文件不存在，请先运行 generate_sample_data.py 生成测试数据")
-        return False
+        import pytest
+        pytest.skip("大规模测试数据文件不存在，请先运行 generate_sample_data.py 生成测试数据")
     
     # 加载大规模测试数据
-    production_plan = pd.read_csv(large_data_files[0])
-    bom_data = pd.read_csv(large_data_files[1])
-    inventory_data = pd.read_csv(large_data_files[2])
-    purchase_orders = pd.read_csv(large_data_files[3])
+    production_plan = load_csv_cached(large_data_files[0], table='production_plan', cache_dir=TEST_CACHE_DIR.name)
+    bom_data = load_csv_cached(large_data_files[1], table='bom', cache_dir=TEST_CACHE_DIR.name)
+    inventory_data = load_csv_cached(large_data_files[2], table='inventory', cache_dir=TEST_CACHE_DIR.name)
+    purchase_orders = load_csv_cached(large_data_files[3], table='purchase_orders', cache_dir=TEST_CACHE_DIR.name)
     
     # 转换日期列
     production_plan['需求日期'] = pd.to_datetime(production_plan['需求日期'])
@@ -203,20 +1172,103 @@ def test_performance_with_large_data():
         print(f"结果包含 {len(mrp_results)} 行数据")
         print(f"涉及 {mrp_results['物料编码'].nunique()} 个物料")
         print(f"涉及 {mrp_results['需求周期'].nunique()} 个时间周期")
-        
+    except Exception as e:
+        raise AssertionError(f"大规模MRP计算失败: {e}") from e
+
+def run_test(test_function):
+    """
+    运行单个测试函数，断言失败或出现异常时返回False
+    """
+    try:
+        test_function()
         return True
     except Exception as e:
-        print(f"大规模MRP计算失败: {e}")
+        print(f"{test_function.__name__} 失败: {e}")
         return False
 
 if __name__ == "__main__":
     print("开始MRP系统测试...\n")
     
     # 测试基本MRP计算
-    basic_test_result = test_basic_mrp()
+    basic_test_result = run_test(test_basic_mrp)
     
     # 测试高级MRP计算
-    advanced_test_result = test_advanced_mrp()
+    advanced_test_result = run_test(test_advanced_mrp)
+    
+    # 测试低层码逐层净算
+    llc_test_result = run_test(test_llc_netting)
+    
+    # 测试BOM邻接索引
+    compiled_bom_result = run_test(test_compiled_bom)
+    
+    # 测试展开向量缓存
+    explosion_test_result = run_test(test_explosion_cache)
+    
+    # 测试净算内核
+    netting_kernel_result = run_test(test_netting_kernel)
+    
+    # 测试批量规则内核
+    lot_sizing_test_result = run_test(test_lot_sizing_kernel)
+    
+    # 测试物料稀疏事件轴
+    event_axis_result = run_test(test_sparse_event_axis)
+    
+    # 测试计划时段日历
+    calendar_test_result = run_test(test_bucket_calendar)
+    
+    # 测试进程池并行求解
+    parallel_milp_result = run_test(test_parallel_milp)
+    
+    # 测试共用资源产能约束
+    shared_capacity_test_result = run_test(test_shared_capacity)
+    
+    # 测试求解器后端选择
+    solver_backend_test_result = run_test(test_solver_backend_routing)
+    
+    # 测试求解时间上限和间隙目标
+    solver_limits_test_result = run_test(test_solver_limits)
+    
+    # 测试净改变计算
+    net_change_test_result = run_test(test_net_change)
+    
+    # 测试求解模型复用
+    model_cache_test_result = run_test(test_model_cache)
+    
+    # 测试需求追溯索引
+    pegging_test_result = run_test(test_pegging_index)
+    
+    # 测试结果缓冲区
+    result_buffer_test_result = run_test(test_result_buffer)
+    
+    # 测试物料主数据编码
+    material_master_result = run_test(test_material_master)
+    
+    # 测试流式读取生产计划
+    streaming_result = run_test(test_streaming_plan)
+    
+    # 测试多场景计算
+    scenarios_result = run_test(test_scenarios)
+    
+    # 测试蒙特卡洛模拟
+    simulation_result = run_test(test_demand_simulation)
+    
+    # 测试滚动计划时间栏
+    rolling_result = run_test(test_rolling_horizon)
+    
+    # 测试CSV列式缓存
+    csv_cache_result = run_test(test_csv_cache)
+    
+    # 测试按表结构读取CSV
+    typed_csv_result = run_test(test_typed_csv)
+    
+    # 测试数据验证报告
+    validation_report_result = run_test(test_validation_report)
+    
+    # 测试BOM循环引用检测
+    bom_cycle_result = run_test(test_bom_cycle_detection)
+    
+    # 测试BOM结构分析
+    bom_structure_result = run_test(test_bom_structure_analysis)
     
     # 检查大规模数据文件是否存在
     sample_data_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sample_data')
@@ -225,7 +1277,7 @@ if __name__ == "__main__":
     # 如果大规模数据存在，测试性能
     performance_test_result = False
     if large_data_exists:
-        performance_test_result = test_performance_with_large_data()
+        performance_test_result = run_test(test_performance_with_large_data)
     else:
         print("\n跳过大规模数据性能测试，因为大规模测试数据文件不存在")
         print("运行 generate_sample_data.py 可以生成大规模测试数据")
@@ -234,10 +1286,65 @@ if __name__ == "__main__":
     print("\n测试结果总结:")
     print(f"基本MRP计算测试: {'通过' if basic_test_result else '失败'}")
     print(f"高级MRP计算测试: {'通过' if advanced_test_result else '失败'}")
+    print(f"低层码逐层净算测试: {'通过' if llc_test_result else '失败'}")
+    print(f"BOM邻接索引测试: {'通过' if compiled_bom_result else '失败'}")
+    print(f"展开向量缓存测试: {'通过' if explosion_test_result else '失败'}")
+    print(f"净算内核测试: {'通过' if netting_kernel_result else '失败'}")
+    print(f"批量规则内核测试: {'通过' if lot_sizing_test_result else '失败'}")
+    print(f"物料稀疏事件轴测试: {'通过' if event_axis_result else '失败'}")
+    print(f"计划时段日历测试: {'通过' if calendar_test_result else '失败'}")
+    print(f"进程池并行求解测试: {'通过' if parallel_milp_result else '失败'}")
+    print(f"共用资源产能约束测试: {'通过' if shared_capacity_test_result else '失败'}")
+    print(f"求解器后端选择测试: {'通过' if solver_backend_test_result else '失败'}")
+    print(f"求解时间上限和间隙目标测试: {'通过' if solver_limits_test_result else '失败'}")
+    print(f"净改变计算测试: {'通过' if net_change_test_result else '失败'}")
+    print(f"求解模型复用测试: {'通过' if model_cache_test_result else '失败'}")
+    print(f"需求追溯索引测试: {'通过' if pegging_test_result else '失败'}")
+    print(f"结果缓冲区测试: {'通过' if result_buffer_test_result else '失败'}")
+    print(f"物料主数据编码测试: {'通过' if material_master_result else '失败'}")
+    print(f"流式读取生产计划测试: {'通过' if streaming_result else '失败'}")
+    print(f"多场景计算测试: {'通过' if scenarios_result else '失败'}")
+    print(f"蒙特卡洛模拟测试: {'通过' if simulation_result else '失败'}")
+    print(f"滚动计划时间栏测试: {'通过' if rolling_result else '失败'}")
+    print(f"CSV列式缓存测试: {'通过' if csv_cache_result else '失败'}")
+    print(f"按表结构读取CSV测试: {'通过' if typed_csv_result else '失败'}")
+    print(f"数据验证报告测试: {'通过' if validation_report_result else '失败'}")
+    print(f"BOM循环引用检测测试: {'通过' if bom_cycle_result else '失败'}")
+    print(f"BOM结构分析测试: {'通过' if bom_structure_result else '失败'}")
     if large_data_exists:
         print(f"大规模数据性能测试: {'通过' if performance_test_result else '失败'}")
     
-    if basic_test_result and advanced_test_result and (not large_data_exists or performance_test_result):
+    all_test_results = [
+        basic_test_result,
+        advanced_test_result,
+        llc_test_result,
+        compiled_bom_result,
+        explosion_test_result,
+        netting_kernel_result,
+        lot_sizing_test_result,
+        event_axis_result,
+        calendar_test_result,
+        parallel_milp_result,
+        shared_capacity_test_result,
+        solver_backend_test_result,
+        solver_limits_test_result,
+        net_change_test_result,
+        model_cache_test_result,
+        pegging_test_result,
+        result_buffer_test_result,
+        material_master_result,
+        streaming_result,
+        scenarios_result,
+        simulation_result,
+        rolling_result,
+        csv_cache_result,
+        typed_csv_result,
+        validation_report_result,
+        bom_cycle_result,
+        bom_structure_result
+    ]
+    
+    if all(all_test_results) and (not large_data_exists or performance_test_result):
         print("\n所有测试通过!")
         sys.exit(0)
     else:
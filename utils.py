@@ -3,118 +3,203 @@ import numpy as np
 import io
 import base64
 import os
-import datetime
+import hashlib
 import streamlit as st
+from mrp_engine import CompiledBOM
 
-def validate_production_plan(df):
+# 各数据表的验证规则：必要列、数值列的下限 ('positive'大于0，'non_negative'不小于0)、日期列和唯一键
+VALIDATION_RULES = {
+    'production_plan': {
+        'name': '生产计划',
+        'required': ['产品编码', '需求数量', '需求日期'],
+        'numeric': {'需求数量': 'positive'},
+        'dates': ['需求日期'],
+        'unique': None
+    },
+    'bom': {
+        'name': 'BOM数据',
+        'required': ['父项编码', '子项编码', '用量'],
+        'numeric': {'用量': 'positive'},
+        'dates': [],
+        'unique': ['父项编码', '子项编码']
+    },
+    'inventory': {
+        'name': '库存数据',
+        'required': ['物料编码', '库存数量', '安全库存'],
+        'numeric': {'库存数量': 'non_negative', '安全库存': 'non_negative'},
+        'dates': [],
+        'unique': ['物料编码']
+    },
+    'purchase_orders': {
+        'name': '采购订单',
+        'required': ['物料编码', '订单数量', '预计到货日期'],
+        'numeric': {'订单数量': 'positive'},
+        'dates': ['预计到货日期'],
+        'unique': None
+    }
+}
+
+# 验证报告的列
+VALIDATION_REPORT_COLUMNS = ['数据表', '行号', '列名', '错误信息']
+
+def _error_rows(table, index, column, message):
     """
-    验证生产计划数据格式
+    为一组出错的行生成验证报告记录
     
     参数:
-    - df: 生产计划DataFrame
+    - table: 表名，VALIDATION_RULES中的键
+    - index: 出错行的索引标签，整表问题时为None
+    - column: 出错的列名
+    - message: 错误信息
     
     返回:
-    - is_valid: 是否有效
-    - message: 错误信息（如果有）
+    - errors: 验证报告DataFrame
     """
-    required_columns = ['产品编码', '需求数量', '需求日期']
-    
-    # 检查必要的列
-    missing_columns = [col for col in required_columns if col not in df.columns]
-    if missing_columns:
-        return False, f"缺少必要的列: {', '.join(missing_columns)}"
-    
-    # 检查数据类型
-    try:
-        # 确保需求数量是数值型
-        df['需求数量'] = pd.to_numeric(df['需求数量'])
-        
-        # 确保需求日期是日期型
-        df['需求日期'] = pd.to_datetime(df['需求日期'])
-    except Exception as e:
-        return False, f"数据类型转换错误: {str(e)}"
+    if index is None:
+        index = [None]
+    return pd.DataFrame({
+        '数据表': VALIDATION_RULES[table]['name'],
+        '行号': pd.Series(list(index), dtype=object),
+        '列名': column,
+        '错误信息': message
+    }, columns=VALIDATION_REPORT_COLUMNS)
+
+def _has_required_columns(table, df):
+    """
+    检查数据表是否包含所有必要的列
     
-    # 检查数据有效性
-    if df['需求数量'].min() <= 0:
-        return False, "需求数量必须大于0"
+    参数:
+    - table: 表名，VALIDATION_RULES中的键
+    - df: 待验证的DataFrame
     
-    return True, ""
+    返回:
+    - 是否包含所有必要的列
+    """
+    return all(col in df.columns for col in VALIDATION_RULES[table]['required'])
 
-def validate_bom_data(df):
+def _validate_table(table, df):
     """
-    验证BOM数据格式
+    按VALIDATION_RULES检查一张数据表的所有规则，不修改df
     
     参数:
-    - df: BOM数据DataFrame
+    - table: 表名，VALIDATION_RULES中的键
+    - df: 待验证的DataFrame
     
     返回:
-    - is_valid: 是否有效
-    - message: 错误信息（如果有）
+    - errors: 验证报告DataFrame的列表；缺少必要的列时只报告缺少的列
     """
-    required_columns = ['父项编码', '子项编码', '用量']
+    rules = VALIDATION_RULES[table]
     
     # 检查必要的列
-    missing_columns = [col for col in required_columns if col not in df.columns]
+    missing_columns = [col for col in rules['required'] if col not in df.columns]
     if missing_columns:
-        return False, f"缺少必要的列: {', '.join(missing_columns)}"
+        return [_error_rows(table, None, ', '.join(missing_columns), f"缺少必要的列: {', '.join(missing_columns)}")]
+    
+    errors = []
+    for col in rules['required']:
+        if col in rules['numeric']:
+            # 数值列：无法转换的值和超出下限的值分别报告
+            values = pd.to_numeric(df[col], errors='coerce')
+            errors.append(_error_rows(table, df.index[values.isna().to_numpy()], col, f"{col}不是有效的数值"))
+            if rules['numeric'][col] == 'positive':
+                errors.append(_error_rows(table, df.index[(values <= 0).to_numpy()], col, f"{col}必须大于0"))
+            else:
+                errors.append(_error_rows(table, df.index[(values < 0).to_numpy()], col, f"{col}不能为负数"))
+        elif col in rules['dates']:
+            invalid = pd.to_datetime(df[col], errors='coerce').isna().to_numpy()
+            errors.append(_error_rows(table, df.index[invalid], col, f"{col}不是有效的日期"))
+        else:
+            errors.append(_error_rows(table, df.index[df[col].isna().to_numpy()], col, f"{col}不能为空"))
+    
+    # 检查唯一键重复的行，第一次出现的行不报告
+    if rules['unique'] is not None:
+        duplicated = df.duplicated(subset=rules['unique']).to_numpy()
+        errors.append(_error_rows(table, df.index[duplicated], ', '.join(rules['unique']),
+                                  f"{'和'.join(rules['unique'])}重复"))
+    return errors
+
+def _circular_reference_errors(bom_data, compiled_bom=None):
+    """
+    检查BOM循环引用并转换为验证报告记录，每条环路一条记录
     
-    # 检查数据类型
-    try:
-        # 确保用量是数值型
-        df['用量'] = pd.to_numeric(df['用量'])
-    except Exception as e:
-        return False, f"数据类型转换错误: {str(e)}"
+    参数:
+    - bom_data: BOM数据DataFrame
+    - compiled_bom: 预先编译的BOM索引CompiledBOM (可选)
     
-    # 检查数据有效性
-    if df['用量'].min() <= 0:
-        return False, "用量必须大于0"
+    返回:
+    - errors: 验证报告DataFrame的列表
+    """
+    # 只用编码非空且用量为有效数值的行构建物料依赖图，其余行已由逐表检查报告
+    if compiled_bom is None:
+        valid = (bom_data['父项编码'].notna() & bom_data['子项编码'].notna()
+                 & pd.to_numeric(bom_data['用量'], errors='coerce').notna())
+        compiled_bom = CompiledBOM(bom_data[valid])
+    return [_error_rows('bom', None, '父项编码, 子项编码', f"检测到BOM循环引用: {' -> '.join(cycle)}")
+            for cycle in find_bom_cycles(bom_data, compiled_bom)]
+
+def _first_error(errors):
+    """
+    将验证报告转换为 (是否有效, 第一条错误信息)
     
-    # 检查BOM循环引用
-    try:
-        check_bom_circular_reference(df)
-    except ValueError as e:
-        return False, str(e)
+    参数:
+    - errors: 验证报告DataFrame的列表
     
+    返回:
+    - is_valid: 是否有效
+    - message: 错误信息（如果有）
+    """
+    for table_errors in errors:
+        if not table_errors.empty:
+            return False, table_errors['错误信息'].iloc[0]
     return True, ""
 
-def validate_inventory_data(df):
+def validate_production_plan(df):
     """
-    验证库存数据格式
+    验证生产计划数据格式，不修改df
     
     参数:
-    - df: 库存数据DataFrame
+    - df: 生产计划DataFrame
     
     返回:
     - is_valid: 是否有效
     - message: 错误信息（如果有）
     """
-    required_columns = ['物料编码', '库存数量', '安全库存']
+    return _first_error(_validate_table('production_plan', df))
+
+def validate_bom_data(df):
+    """
+    验证BOM数据格式，不修改df
     
-    # 检查必要的列
-    missing_columns = [col for col in required_columns if col not in df.columns]
-    if missing_columns:
-        return False, f"缺少必要的列: {', '.join(missing_columns)}"
+    参数:
+    - df: BOM数据DataFrame
     
-    # 检查数据类型
-    try:
-        # 确保库存数量和安全库存是数值型
-        df['库存数量'] = pd.to_numeric(df['库存数量'])
-        df['安全库存'] = pd.to_numeric(df['安全库存'])
-    except Exception as e:
-        return False, f"数据类型转换错误: {str(e)}"
+    返回:
+    - is_valid: 是否有效
+    - message: 错误信息（如果有）
+    """
+    errors = _validate_table('bom', df)
     
-    # 检查数据有效性
-    if df['库存数量'].min() < 0:
-        return False, "库存数量不能为负数"
+    # 检查BOM循环引用
+    if _has_required_columns('bom', df):
+        errors.extend(_circular_reference_errors(df))
+    return _first_error(errors)
+
+def validate_inventory_data(df):
+    """
+    验证库存数据格式，不修改df
     
-    if df['安全库存'].min() < 0:
-        return False, "安全库存不能为负数"
+    参数:
+    - df: 库存数据DataFrame
     
-    return True, ""
+    返回:
+    - is_valid: 是否有效
+    - message: 错误信息（如果有）
+    """
+    return _first_error(_validate_table('inventory', df))
 
 def validate_purchase_orders(df):
     """
-    验证采购订单数据格式
+    验证采购订单数据格式，不修改df
     
     参数:
     - df: 采购订单DataFrame
@@ -123,68 +208,175 @@ def validate_purchase_orders(df):
     - is_valid: 是否有效
     - message: 错误信息（如果有）
     """
-    required_columns = ['物料编码', '订单数量', '预计到货日期']
+    return _first_error(_validate_table('purchase_orders', df))
+
+def validate_mrp_data(production_plan, bom_data, inventory_data, purchase_orders=None, compiled_bom=None):
+    """
+    一次验证所有输入数据并报告全部问题
     
-    # 检查必要的列
-    missing_columns = [col for col in required_columns if col not in df.columns]
-    if missing_columns:
-        return False, f"缺少必要的列: {', '.join(missing_columns)}"
+    每张表的所有规则 (必要的列、数值转换、取值范围、日期、空值、重复) 以向量化掩码检查，
+    再检查跨表的物料引用和BOM循环引用。不修改传入的DataFrame，也不在第一个错误处停止
     
-    # 检查数据类型
-    try:
-        # 确保订单数量是数值型
-        df['订单数量'] = pd.to_numeric(df['订单数量'])
-        
-        # 确保预计到货日期是日期型
-        df['预计到货日期'] = pd.to_datetime(df['预计到货日期'])
-    except Exception as e:
-        return False, f"数据类型转换错误: {str(e)}"
+    参数:
+    - production_plan: 生产计划DataFrame
+    - bom_data: BOM数据DataFrame
+    - inventory_data: 库存数据DataFrame
+    - purchase_orders: 采购订单DataFrame (可选)
+    - compiled_bom: 预先编译的BOM索引CompiledBOM (可选)，未提供时从bom_data构建
+    
+    返回:
+    - is_valid: 是否有效
+    - report: 验证报告DataFrame，每个问题一行，包含数据表、行号 (DataFrame的索引标签，
+      整表问题为None)、列名和错误信息
+    """
+    tables = {'production_plan': production_plan, 'bom': bom_data, 'inventory': inventory_data}
+    if purchase_orders is not None:
+        tables['purchase_orders'] = purchase_orders
+    
+    # 1. 逐表检查，跨表规则只检查必要的列齐全的表
+    errors = []
+    for table, df in tables.items():
+        errors.extend(_validate_table(table, df))
+    complete = {table for table, df in tables.items() if _has_required_columns(table, df)}
+    
+    # 2. 检查生产计划和采购订单中的物料是否在BOM或库存数据中定义
+    if 'bom' in complete and '物料编码' in inventory_data.columns:
+        known_codes = pd.concat([bom_data['父项编码'].astype(object), bom_data['子项编码'].astype(object),
+                                 inventory_data['物料编码'].astype(object)]).unique()
+        for table, col in [('production_plan', '产品编码'), ('purchase_orders', '物料编码')]:
+            if table in complete:
+                codes = tables[table][col]
+                dangling = (codes.notna() & ~codes.isin(known_codes)).to_numpy()
+                errors.append(_error_rows(table, tables[table].index[dangling], col, f"{col}未在BOM或库存数据中定义"))
+    
+    # 3. 检查BOM循环引用
+    if 'bom' in complete:
+        errors.extend(_circular_reference_errors(bom_data, compiled_bom))
+    
+    report = pd.concat(errors, ignore_index=True)
+    return report.empty, report
+
+def find_bom_cycles(bom_data, compiled_bom=None):
+    """
+    查找BOM数据中的所有循环引用
     
-    # 检查数据有效性
-    if df['订单数量'].min() <= 0:
-        return False, "订单数量必须大于0"
+    先按拓扑顺序逐层剥离入度为0的物料 (向量化)，无环的BOM在这一步即检查完毕；
+    剩余物料上用迭代的Tarjan算法求强连通分量，每个含环的分量报告一条环路。
+    总复杂度为O(V+E)，不使用递归，BOM层级很深时也不会超出递归深度
     
-    return True, ""
+    参数:
+    - bom_data: BOM数据DataFrame
+    - compiled_bom: 预先编译的BOM索引CompiledBOM (可选)，未提供时从bom_data构建
+    
+    返回:
+    - cycles: 环路列表，每条环路为首尾相同的物料编码列表，按起点编码排序
+    """
+    # 使用编译后的邻接索引作为物料依赖图
+    if compiled_bom is None:
+        compiled_bom = CompiledBOM(bom_data)
+    codes = compiled_bom.codes
+    
+    # 1. 逐层剥离入度为0的物料，剩余物料位于环上或环的下游
+    in_degree = np.bincount(compiled_bom.children, minlength=compiled_bom.item_count)
+    remaining = np.ones(compiled_bom.item_count, dtype=bool)
+    frontier = np.flatnonzero(in_degree == 0)
+    while len(frontier):
+        remaining[frontier] = False
+        positions, _ = compiled_bom.edge_positions(frontier)
+        reached = compiled_bom.children[positions]
+        np.subtract.at(in_degree, reached, 1)
+        reached = np.unique(reached)
+        frontier = reached[in_degree[reached] == 0]
+    if not remaining.any():
+        return []
+    
+    # 2. 只保留剩余物料之间的边，构建子图的邻接表
+    item_ids = np.flatnonzero(remaining)
+    positions, sources = compiled_bom.edge_positions(item_ids)
+    children = compiled_bom.children[positions]
+    kept = remaining[children]
+    adjacency = {item_id: [] for item_id in item_ids.tolist()}
+    for source, child in zip(item_ids[sources[kept]].tolist(), children[kept].tolist()):
+        adjacency[source].append(child)
+    
+    # 3. 迭代Tarjan算法求强连通分量
+    index = {}
+    low_link = {}
+    on_stack = set()
+    stack = []
+    components = []
+    for root in adjacency:
+        if root in index:
+            continue
+        index[root] = low_link[root] = len(index)
+        stack.append(root)
+        on_stack.add(root)
+        work = [(root, iter(adjacency[root]))]
+        while work:
+            node, child_iter = work[-1]
+            for child in child_iter:
+                if child not in index:
+                    index[child] = low_link[child] = len(index)
+                    stack.append(child)
+                    on_stack.add(child)
+                    work.append((child, iter(adjacency[child])))
+                    break
+                if child in on_stack:
+                    low_link[node] = min(low_link[node], index[child])
+            else:
+                # 子项都已访问，回溯到父项
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    low_link[parent] = min(low_link[parent], low_link[node])
+                if low_link[node] == index[node]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        component.append(member)
+                        if member == node:
+                            break
+                    if len(component) > 1 or node in adjacency[node]:
+                        components.append(component)
+    
+    # 4. 每个强连通分量从编码最小的物料出发，广度优先找一条回到起点的环路
+    cycles = []
+    for component in components:
+        members = set(component)
+        start = min(component, key=lambda item_id: str(codes[item_id]))
+        previous = {start: None}
+        queue = [start]
+        end = None
+        for node in queue:
+            if start in adjacency[node]:
+                end = node
+                break
+            for child in adjacency[node]:
+                if child in members and child not in previous:
+                    previous[child] = node
+                    queue.append(child)
+        path = [start]
+        while end is not None:
+            path.append(end)
+            end = previous[end]
+        cycles.append([str(codes[item_id]) for item_id in reversed(path)])
+    return sorted(cycles)
 
-def check_bom_circular_reference(bom_data):
+def check_bom_circular_reference(bom_data, compiled_bom=None):
     """
     检查BOM数据中是否存在循环引用
     
     参数:
     - bom_data: BOM数据DataFrame
+    - compiled_bom: 预先编译的BOM索引CompiledBOM (可选)，未提供时从bom_data构建
     
     抛出:
-    - ValueError: 如果检测到循环引用
+    - ValueError: 如果检测到循环引用，错误信息列出所有环路
     """
-    # 创建物料依赖图
-    dependency_graph = {}
-    for _, row in bom_data.iterrows():
-        parent = row['父项编码']
-        child = row['子项编码']
-        
-        if parent not in dependency_graph:
-            dependency_graph[parent] = []
-        
-        dependency_graph[parent].append(child)
-    
-    # 检查循环引用的辅助函数
-    def check_cycle(item, path=None):
-        if path is None:
-            path = []
-        
-        # 检查是否已经在路径中
-        if item in path:
-            cycle_path = path[path.index(item):] + [item]
-            raise ValueError(f"检测到BOM循环引用: {' -> '.join(cycle_path)}")
-        
-        # 如果物料有子项，递归检查
-        if item in dependency_graph:
-            for child in dependency_graph[item]:
-                check_cycle(child, path + [item])
-    
-    # 检查每个物料
-    for item in dependency_graph:
-        check_cycle(item)
+    cycles = find_bom_cycles(bom_data, compiled_bom)
+    if cycles:
+        raise ValueError(f"检测到BOM循环引用: {'; '.join(' -> '.join(cycle) for cycle in cycles)}")
 
 def get_download_link(df, filename, text):
     """
@@ -203,18 +395,186 @@ def get_download_link(df, filename, text):
     href = f'<a href="data:file/csv;base64,{b64}" download="{filename}">{text}</a>'
     return href
 
-def load_sample_data(file_path):
+# 输入表结构：列名 -> 类型，'date'表示读取时解析为日期
+TABLE_SCHEMAS = {
+    'production_plan': {'产品编码': 'category', '产品名称': 'category', '需求数量': 'float64', '需求日期': 'date'},
+    'bom': {'父项编码': 'category', '父项名称': 'category', '子项编码': 'category', '子项名称': 'category',
+            '用量': 'float64', '单位': 'category'},
+    'inventory': {'物料编码': 'category', '物料名称': 'category', '库存数量': 'float64', '安全库存': 'float64',
+                  '单位': 'category'},
+    'purchase_orders': {'订单编号': 'str', '物料编码': 'category', '物料名称': 'category', '订单数量': 'float64',
+                        '单位': 'category', '订单日期': 'date', '预计到货日期': 'date', '供应商': 'category'},
+    'lead_times': {'物料编码': 'category', '生产提前期': 'int64', '采购提前期': 'int64'},
+    'lot_sizes': {'物料编码': 'category', '最小批量': 'float64', '批量倍数': 'float64', '固定批量': 'float64',
+                  '订货周期数': 'float64'},
+    'capacity_constraints': {'资源编码': 'category', '日期': 'date', '可用产能': 'float64'},
+    'resource_requirements': {'物料编码': 'category', '资源编码': 'category', '单位用量': 'float64'}
+}
+
+def read_typed_csv(source, table):
+    """
+    按表结构读取CSV数据
+    
+    使用pyarrow引擎多线程解析，编码和名称列读为分类类型，日期列在读取时解析，
+    其余列使用显式类型，不再逐列推断。表结构中没有的列按默认方式推断
+    
+    参数:
+    - source: CSV文件路径或文件对象
+    - table: 表名，TABLE_SCHEMAS中的键
+    
+    返回:
+    - df: 加载的DataFrame
+    
+    抛出:
+    - ValueError: 表名未定义时
+    """
+    if table not in TABLE_SCHEMAS:
+        raise ValueError(f"未定义的表结构: {table}")
+    schema = TABLE_SCHEMAS[table]
+    
+    # 只对文件中存在的列指定类型，可选列缺失时不报错
+    columns = pd.read_csv(source, nrows=0).columns
+    if hasattr(source, 'seek'):
+        source.seek(0)
+    dtype = {col: kind for col, kind in schema.items() if col in columns and kind != 'date'}
+    date_columns = [col for col, kind in schema.items() if col in columns and kind == 'date']
+    
+    return pd.read_csv(source, engine='pyarrow', dtype=dtype, parse_dates=date_columns)
+
+# 列式缓存目录，CSV按内容哈希转换为Parquet文件
+CSV_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.mrp_cache')
+# 缓存格式版本，CSV的读取方式改变时递增，使旧缓存失效
+CSV_CACHE_VERSION = 1
+# 缓存目录的容量上限(字节)，超出时删除最久未使用的缓存文件
+CSV_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+def _csv_cache_key(content, table=None):
+    """
+    计算CSV缓存的文件名
+    
+    哈希同时包含缓存格式版本和表结构，表结构或读取方式改变后不会命中旧的缓存
+    
+    参数:
+    - content: CSV文件的字节内容
+    - table: 表名 (可选)
+    
+    返回:
+    - cache_name: 缓存文件名 (不含扩展名)
+    """
+    schema = sorted(TABLE_SCHEMAS.get(table, {}).items())
+    digest = hashlib.sha1(f"{CSV_CACHE_VERSION}|{table}|{schema}|".encode('utf-8'))
+    digest.update(content)
+    cache_name = digest.hexdigest()
+    if table is not None:
+        cache_name = f"{table}-{cache_name}"
+    return cache_name
+
+def _evict_csv_cache(cache_dir, max_bytes, keep=None):
+    """
+    按最近使用时间淘汰缓存文件，直到缓存目录的总大小不超过上限
+    
+    参数:
+    - cache_dir: 缓存目录
+    - max_bytes: 容量上限(字节)
+    - keep: 不淘汰的缓存文件路径 (可选)，通常是刚写入的文件
+    """
+    entries = []
+    with os.scandir(cache_dir) as it:
+        for entry in it:
+            if not entry.name.endswith('.parquet'):
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+    
+    total = sum(size for _, size, _ in entries)
+    # 从最久未使用的文件开始删除
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        if path == keep:
+            continue
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+
+def load_csv_cached(source, cache_dir=None, table=None, max_bytes=None):
+    """
+    通过列式缓存加载CSV数据
+    
+    第一次加载时解析CSV并按文件内容、表结构和缓存版本的SHA-1哈希保存为Parquet文件，
+    列类型随之固定；之后内容相同的文件直接读取Parquet，不再解析CSV。缓存目录超过容量
+    上限时删除最久未使用的文件。缓存写入失败时只返回解析结果
+    
+    参数:
+    - source: CSV文件路径、字节内容，或Streamlit上传的文件对象
+    - cache_dir: 缓存目录 (可选)，默认CSV_CACHE_DIR
+    - table: 表名 (可选)，指定时按TABLE_SCHEMAS中的表结构读取；
+      内容不符合表结构时按默认方式解析，由验证函数报告错误
+    - max_bytes: 缓存目录的容量上限(字节) (可选)，默认CSV_CACHE_MAX_BYTES
+    
+    返回:
+    - df: 加载的DataFrame
+    """
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, 'rb') as f:
+            content = f.read()
+    elif isinstance(source, bytes):
+        content = source
+    else:
+        content = source.getvalue()
+    
+    if cache_dir is None:
+        cache_dir = CSV_CACHE_DIR
+    if max_bytes is None:
+        max_bytes = CSV_CACHE_MAX_BYTES
+    cache_path = os.path.join(cache_dir, f"{_csv_cache_key(content, table)}.parquet")
+    if os.path.exists(cache_path):
+        # 更新修改时间，淘汰时按最近使用排序
+        try:
+            os.utime(cache_path)
+        except OSError:
+            pass
+        return pd.read_parquet(cache_path)
+    
+    df = None
+    if table is not None:
+        try:
+            df = read_typed_csv(io.BytesIO(content), table)
+        except (ValueError, TypeError):
+            df = None
+    if df is None:
+        df = pd.read_csv(io.BytesIO(content))
+    
+    # 先写入临时文件再替换，避免并发读取到不完整的缓存
+    temp_path = f"{cache_path}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        df.to_parquet(temp_path, index=False)
+        os.replace(temp_path, cache_path)
+        _evict_csv_cache(cache_dir, max_bytes, keep=cache_path)
+    except (OSError, ValueError, TypeError, ImportError):
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    return df
+
+def load_sample_data(file_path, table=None):
     """
     加载示例数据
     
     参数:
     - file_path: 示例数据文件路径
+    - table: 表名 (可选)，指定时按TABLE_SCHEMAS中的表结构读取
     
     返回:
     - df: 加载的DataFrame
     """
     try:
-        return pd.read_csv(file_path)
+        return load_csv_cached(file_path, table=table)
     except Exception as e:
         st.error(f"加载示例数据时出错: {e}")
         return None
@@ -334,69 +694,46 @@ def check_data_consistency(production_plan, bom_data, inventory_data):
     
     return len(issues) == 0, issues
 
-def analyze_bom_structure(bom_data):
+def analyze_bom_structure(bom_data, compiled_bom=None):
     """
     分析BOM结构
     
+    物料层级使用CompiledBOM的低层码，即一次Kahn拓扑排序得到的物料在所有BOM中出现的最深层级
+    
     参数:
     - bom_data: BOM数据DataFrame
+    - compiled_bom: 预先编译的BOM索引CompiledBOM (可选)，未提供时从bom_data构建
     
     返回:
-    - analysis_results: 分析结果字典
+    - analysis_results: 分析结果字典，low_level_codes为按物料编码索引的低层码Series
+    
+    抛出:
+    - ValueError: 如果检测到循环引用
     """
-    # 获取所有父项和子项
-    all_parents = set(bom_data['父项编码'])
-    all_children = set(bom_data['子项编码'])
+    if compiled_bom is None:
+        compiled_bom = CompiledBOM(bom_data)
+    
+    # 只统计出现在BOM中的物料
+    has_children = np.diff(compiled_bom.offsets) > 0
+    is_child = np.bincount(compiled_bom.children, minlength=compiled_bom.item_count) > 0
+    in_bom = has_children | is_child
     
     # 计算各种物料类型
-    raw_materials = all_children - all_parents  # 只作为子项的物料（原材料）
-    finished_goods = all_parents - all_children  # 只作为父项的物料（成品）
-    intermediate_materials = all_parents & all_children  # 既是父项又是子项的物料（中间件）
-    
-    # 计算BOM层级
-    max_level = 0
-    level_map = {}
-    
-    # 初始化成品为0级
-    for item in finished_goods:
-        level_map[item] = 0
-    
-    # 计算每个物料的层级
-    def calculate_level(item, current_level=0):
-        nonlocal max_level
-        
-        # 更新最大层级
-        max_level = max(max_level, current_level)
-        
-        # 获取所有子项
-        children = bom_data[bom_data['父项编码'] == item]['子项编码'].unique()
-        
-        for child in children:
-            # 如果子项还没有层级或当前计算的层级更高，则更新
-            if child not in level_map or level_map[child] < current_level + 1:
-                level_map[child] = current_level + 1
-                
-                # 如果子项也是父项，递归计算
-                if child in all_parents:
-                    calculate_level(child, current_level + 1)
-    
-    # 从每个成品开始计算
-    for item in finished_goods:
-        calculate_level(item)
-    
-    # 统计每个层级的物料数量
-    level_counts = {}
-    for item, level in level_map.items():
-        if level not in level_counts:
-            level_counts[level] = 0
-        level_counts[level] += 1
+    raw_materials_count = int(np.count_nonzero(is_child & ~has_children))  # 只作为子项的物料（原材料）
+    finished_goods_count = int(np.count_nonzero(has_children & ~is_child))  # 只作为父项的物料（成品）
+    intermediate_materials_count = int(np.count_nonzero(has_children & is_child))  # 既是父项又是子项的物料（中间件）
+    
+    # 计算BOM层级：成品为0级，每个物料取所有路径中最深的层级
+    llc = compiled_bom.low_level_codes()[in_bom]
+    level_counts = np.bincount(llc)
     
     # 返回分析结果
     return {
-        'raw_materials_count': len(raw_materials),
-        'finished_goods_count': len(finished_goods),
-        'intermediate_materials_count': len(intermediate_materials),
-        'total_items_count': len(all_parents | all_children),
-        'max_bom_level': max_level,
-        'level_distribution': level_counts
+        'raw_materials_count': raw_materials_count,
+        'finished_goods_count': finished_goods_count,
+        'intermediate_materials_count': intermediate_materials_count,
+        'total_items_count': int(np.count_nonzero(in_bom)),
+        'max_bom_level': int(llc.max()) if len(llc) else 0,
+        'level_distribution': {level: int(count) for level, count in enumerate(level_counts) if count > 0},
+        'low_level_codes': pd.Series(llc, index=compiled_bom.codes[in_bom], name='低层码')
     }
\ No newline at end of file